@@ -15,6 +15,7 @@
 #   limitations under the License.
 
 import os
+import threading
 
 __version__ = '1.0.0'
 
@@ -43,19 +44,170 @@ __clean_working_directory_env_key__ = 'APP_CLEAN_WORKDIR'
 # environmental variable for the number of threads to use to build ms2 files
 __ms2_max_threads_env_key__ = 'MS2_MAX_THREADS'
 
-# how long (in seconds) to sleep between checking for new requests to process
-__request_check_delay__ = 10
-
-# array of dicts, each dict: {id: request id, data: the xml data of the request}
-request_queue = []
-
-# dict of:
+# environmental variables for the number of decimal places to write for peak m/z and intensity values in .ms2
+# files. If not set, values are written at full precision
+__ms2_mz_precision_env_key__ = 'MS2_MZ_PRECISION'
+__ms2_intensity_precision_env_key__ = 'MS2_INTENSITY_PRECISION'
+
+# environmental variable for the number of requests to process at the same time
+__max_concurrent_requests_env_key__ = 'MAX_CONCURRENT_REQUESTS'
+
+# environmental variable for the total number of threads to use to build ms2 files across all requests being processed
+__ms2_max_total_threads_env_key__ = 'MS2_MAX_TOTAL_THREADS'
+
+# environmental variable for the number of spectr batches to have in flight at a time for each scan file
+__spectr_max_in_flight_env_key__ = 'SPECTR_MAX_IN_FLIGHT'
+
+# environmental variable for the number of connections to keep open to spectr in each process
+__spectr_pool_size_env_key__ = 'SPECTR_POOL_SIZE'
+
+# environmental variables for the connect and read timeouts (in seconds) for requests to spectr
+__spectr_connect_timeout_env_key__ = 'SPECTR_CONNECT_TIMEOUT'
+__spectr_read_timeout_env_key__ = 'SPECTR_READ_TIMEOUT'
+
+# defaults for the spectr connection pool size and timeouts (in seconds)
+__spectr_default_pool_size__ = 10
+__spectr_default_connect_timeout__ = 10
+__spectr_default_read_timeout__ = 600
+
+# environmental variables for the smallest and largest number of scans to request from spectr at a time. The batch
+# size starts at SPECTR_BATCH_SIZE for each scan file and is adjusted within these bounds, from the time taken and the
+# size of the responses to earlier batches. Both default to SPECTR_BATCH_SIZE, i.e. a fixed batch size
+__spectr_min_batch_size_env_key__ = 'SPECTR_MIN_BATCH_SIZE'
+__spectr_max_batch_size_env_key__ = 'SPECTR_MAX_BATCH_SIZE'
+
+# environmental variables for the time (in seconds) and response size (in MB) to aim for in each request to spectr,
+# when the batch size is adjusted
+__spectr_target_batch_seconds_env_key__ = 'SPECTR_TARGET_BATCH_SECONDS'
+__spectr_target_batch_mb_env_key__ = 'SPECTR_TARGET_BATCH_MB'
+__spectr_default_target_batch_seconds__ = 10
+__spectr_default_target_batch_mb__ = 64
+
+# environmental variables for the number of times a request to spectr that failed with a 502, 503 or 504 error, a
+# timeout or a lost connection is retried (split into two smaller requests each time), and the base of the exponential
+# backoff (in seconds) before each retry
+__spectr_max_retries_env_key__ = 'SPECTR_MAX_RETRIES'
+__spectr_retry_backoff_seconds_env_key__ = 'SPECTR_RETRY_BACKOFF_SECONDS'
+__spectr_default_max_retries__ = 3
+__spectr_default_retry_backoff_seconds__ = 1
+
+# environmental variable for the number of batches of parsed scans that may wait to be written to a .ms2 file. If
+# greater than 0, scans are fetched and parsed in a separate thread while earlier batches are written
+__ms2_write_queue_size_env_key__ = 'MS2_WRITE_QUEUE_SIZE'
+
+# environmental variable for the policy used to choose the next request to process. One of:
+#   'fifo': first in, first out
+#   'sjf': smallest estimated request first, with aging so large requests still run
+#   'fair': round robin between projects
+__request_scheduler_policy_env_key__ = 'REQUEST_SCHEDULER_POLICY'
+__default_request_scheduler_policy__ = 'fifo'
+
+# environmental variable for the aging time (in seconds) of the 'sjf' policy. A request's estimated cost is halved
+# after it has waited this long, and keeps shrinking the longer it waits
+__request_queue_aging_seconds_env_key__ = 'REQUEST_QUEUE_AGING_SECONDS'
+__default_request_queue_aging_seconds__ = 600
+
+# environmental variable for the full path to the directory holding the persistent scan cache. If not set,
+# scans are not cached between requests
+__scan_cache_dir_env_key__ = 'SCAN_CACHE_DIR'
+
+# environmental variable for the maximum size (in MB) of the persistent scan cache
+__scan_cache_max_mb_env_key__ = 'SCAN_CACHE_MAX_MB'
+
+# default maximum size (in MB) of the persistent scan cache
+__scan_cache_default_max_mb__ = 10240
+
+# environmental variable for the full path to the directory holding the cache of libraries built from single scan files.
+# If set, a redundant library is built and cached for each scan file of a request, and those libraries are merged
+# into the redundant library for the request. Scan files with the same PSMs are not rebuilt by later requests
+__library_cache_dir_env_key__ = 'SCAN_FILE_LIBRARY_CACHE_DIR'
+
+# environmental variable for the maximum size (in MB) of the scan file library cache
+__library_cache_max_mb_env_key__ = 'SCAN_FILE_LIBRARY_CACHE_MAX_MB'
+
+# default maximum size (in MB) of the scan file library cache
+__library_cache_default_max_mb__ = 10240
+
+# environmental variable for how the redundant library is built: 'blibbuild' writes .ms2 and .ssl files and runs
+# BlibBuild on them, 'native' writes the library's tables directly from the scan data
+__blib_build_engine_env_key__ = 'BLIB_BUILD_ENGINE'
+__default_blib_build_engine__ = 'blibbuild'
+
+# environmental variable for the score cutoff (0 to 1) passed to BlibBuild with -c, and applied the same way by the
+# native engine. PSMs with a probability of being correct below the cutoff (or a probability of being incorrect above
+# 1 - cutoff) are left out of the library. Scores that are not probabilities are not filtered. Defaults to 0
+__blib_build_score_cutoff_env_key__ = 'BLIB_BUILD_SCORE_CUTOFF'
+__default_blib_build_score_cutoff__ = 0
+
+# environmental variable for the format of the intermediate spectrum files read by BlibBuild: 'ms2' (text, the
+# default), 'mzml' (base64 encoded binary peak arrays) or 'mzml_zlib' (zlib compressed, base64 encoded peak arrays)
+__intermediate_spectrum_format_env_key__ = 'INTERMEDIATE_SPECTRUM_FORMAT'
+__default_intermediate_spectrum_format__ = 'ms2'
+
+# environmental variables for reducing the peaks of each scan before it is written. Each step is skipped if its env var
+# is not set. Keep the N most intense peaks; keep the N most intense peaks in each m/z window of the given width;
+# remove peaks less intense than a fraction (0 to 1) of the most intense peak; remove peaks within the given m/z of
+# the precursor m/z
+__peak_top_n_env_key__ = 'PEAK_TOP_N'
+__peak_top_n_per_window_env_key__ = 'PEAK_TOP_N_PER_WINDOW'
+__peak_window_size_env_key__ = 'PEAK_WINDOW_SIZE_MZ'
+__peak_min_relative_intensity_env_key__ = 'PEAK_MIN_RELATIVE_INTENSITY'
+__peak_precursor_removal_tolerance_env_key__ = 'PEAK_PRECURSOR_REMOVAL_MZ'
+__default_peak_window_size__ = 100.0
+
+# environmental variable for the number of PSMs to keep for each modified peptide and charge of scan files that have a
+# score type, keeping the best scoring. Only the scans of kept PSMs are fetched. 0 (the default) keeps all PSMs
+__psm_preselection_count_env_key__ = 'PSM_PRESELECTION_COUNT'
+
+# environmental variable for the full path to a directory to write a trace of each request to, as
+# <request id>.trace.json in the Chrome trace-event format. If not set, no trace files are written
+__request_trace_dir_env_key__ = 'REQUEST_TRACE_DIR'
+
+# environmental variable for the full path to a SQLite database file to keep the request queue and the status of
+# requests in, so they survive a restart of the service. If not set, they are only kept in memory
+__request_store_path_env_key__ = 'REQUEST_STORE_PATH'
+
+# environmental variable for how long (in seconds) a completed .blib is reused for new requests with the same project
+# id and spectral data. 0 (the default) disables reuse of completed results. Identical requests that are queued or
+# processing are always shared
+__result_retention_seconds_env_key__ = 'RESULT_RETENTION_SECONDS'
+__default_result_retention_seconds__ = 0
+
+# dict of (or SQLiteMapping if a request store path is set, see below):
 #   request id : {
 #       status: one of 'queued', 'processing', 'not found', 'success', 'error'
 #       message: file path if successful, error message otherwise
+#       request_hash: hash of the project id and spectral data of the request
+#       subscriber_count: number of conversion requests sharing this request
+#       completed_at: time the request completed successfully
+#       trace_summary: time spent in each stage of processing, once the request is done
 #   }
 request_status_dict = {}
 
+# dict of: request hash : id of the most recent request with that hash
+request_hash_dict = {}
+
+# held while reading or changing request_queue and request_status_dict, which are shared between the web
+# service threads and the request processing threads
+request_lock = threading.RLock()
+
+# imported here, queue_utils uses the env var names defined above
+from .queue_utils import RequestQueue
+
+# queue of requests waiting to be processed, each a dict:
+#   {id: request id, data: the xml data of the request, project_id: the project id of the request}
+request_queue = RequestQueue(request_lock)
+
+# keep the queue and the status of requests in a SQLite database instead, if configured. Entries of the
+# status dict must be assigned again to be stored once changed, see request_handler.update_request_status
+if os.getenv(__request_store_path_env_key__):
+    from .request_store import SQLiteRequestStore
+
+    request_store = SQLiteRequestStore(os.getenv(__request_store_path_env_key__), request_lock)
+    request_status_dict = request_store.request_status_dict
+    request_hash_dict = request_store.request_hash_dict
+    request_queue = request_store.request_queue
+
 # whether or not the request queue processing has been started up
 request_queue_status = {'started': False}
 
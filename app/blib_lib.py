@@ -0,0 +1,452 @@
+"""Methods for writing redundant .blib spectral libraries directly, without BlibBuild"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import sys
+import zlib
+import sqlite3
+from array import array
+from datetime import datetime
+
+# schema version of the libraries we write (the version adding RefSpectra startTime and endTime),
+# as understood by BlibFilter and Skyline
+_blib_major_version = 1
+_blib_minor_version = 7
+
+# the score types known to BiblioSpec: score type => (id in the ScoreTypes table, probability type)
+score_types = {
+    'UNKNOWN': (0, 'NOT_A_PROBABILITY_VALUE'),
+    'PERCOLATOR QVALUE': (1, 'PROBABILITY_THAT_IDENTIFICATION_IS_INCORRECT'),
+    'PEPTIDE PROPHET SOMETHING': (2, 'PROBABILITY_THAT_IDENTIFICATION_IS_CORRECT'),
+    'SPECTRUM MILL': (3, 'NOT_A_PROBABILITY_VALUE'),
+    'IDPICKER FDR': (4, 'PROBABILITY_THAT_IDENTIFICATION_IS_INCORRECT'),
+    'MASCOT IONS SCORE': (5, 'PROBABILITY_THAT_IDENTIFICATION_IS_INCORRECT'),
+    'TANDEM EXPECTATION VALUE': (6, 'PROBABILITY_THAT_IDENTIFICATION_IS_INCORRECT'),
+    'PROTEIN PILOT CONFIDENCE': (7, 'PROBABILITY_THAT_IDENTIFICATION_IS_CORRECT'),
+    'SCAFFOLD SOMETHING': (8, 'PROBABILITY_THAT_IDENTIFICATION_IS_CORRECT'),
+    'WATERS MSE PEPTIDE SCORE': (9, 'NOT_A_PROBABILITY_VALUE'),
+    'OMSSA EXPECTATION SCORE': (10, 'PROBABILITY_THAT_IDENTIFICATION_IS_INCORRECT'),
+    'PROTEIN PROSPECTOR EXPECTATION SCORE': (11, 'PROBABILITY_THAT_IDENTIFICATION_IS_INCORRECT'),
+    'SEQUEST XCORR': (12, 'NOT_A_PROBABILITY_VALUE'),
+    'MAXQUANT SCORE': (13, 'PROBABILITY_THAT_IDENTIFICATION_IS_INCORRECT'),
+    'MORPHEUS SCORE': (14, 'PROBABILITY_THAT_IDENTIFICATION_IS_INCORRECT'),
+    'MSGF+ SCORE': (15, 'PROBABILITY_THAT_IDENTIFICATION_IS_INCORRECT'),
+    'PEAKS CONFIDENCE SCORE': (16, 'PROBABILITY_THAT_IDENTIFICATION_IS_INCORRECT'),
+    'BYONIC SCORE': (17, 'PROBABILITY_THAT_IDENTIFICATION_IS_INCORRECT'),
+    'PEPTIDE SHAKER CONFIDENCE': (18, 'PROBABILITY_THAT_IDENTIFICATION_IS_CORRECT'),
+    'GENERIC Q-VALUE': (19, 'PROBABILITY_THAT_IDENTIFICATION_IS_INCORRECT')
+}
+
+# the score type of PSMs without one, the same as written to the .ssl files
+default_score_type = 'UNKNOWN'
+
+_blib_schema = """
+    CREATE TABLE LibInfo (
+        libLSID TEXT, createTime TEXT, numSpecs INTEGER, majorVersion INTEGER, minorVersion INTEGER
+    );
+    CREATE TABLE RefSpectra (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, peptideSeq VARCHAR(150), precursorMZ REAL, precursorCharge INTEGER,
+        peptideModSeq VARCHAR(200), prevAA CHAR(1), nextAA CHAR(1), copies INTEGER, numPeaks INTEGER,
+        ionMobility REAL, collisionalCrossSectionSqA REAL, ionMobilityHighEnergyOffset REAL, ionMobilityType TINYINT,
+        retentionTime REAL, startTime REAL, endTime REAL, totalIonCurrent REAL, moleculeName VARCHAR(128),
+        chemicalFormula VARCHAR(128), precursorAdduct VARCHAR(128), inchiKey VARCHAR(128), otherKeys VARCHAR(128),
+        fileID INTEGER, SpecIDinFile VARCHAR(256), score REAL, scoreType TINYINT
+    );
+    CREATE TABLE Modifications (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, RefSpectraID INTEGER, position INTEGER, mass REAL
+    );
+    CREATE TABLE RefSpectraPeaks (RefSpectraID INTEGER, peakMZ BLOB, peakIntensity BLOB);
+    CREATE TABLE RefSpectraPeakAnnotations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, RefSpectraID INTEGER, peakIndex INTEGER, name VARCHAR(256),
+        formula VARCHAR(256), inchiKey VARCHAR(256), otherKeys VARCHAR(256), charge INTEGER, adduct VARCHAR(256),
+        comment VARCHAR(256), mzTheoretical REAL, mzObserved REAL
+    );
+    CREATE TABLE SpectrumSourceFiles (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, fileName VARCHAR(512), idFileName VARCHAR(512), cutoffScore REAL
+    );
+    CREATE TABLE ScoreTypes (id INTEGER PRIMARY KEY, scoreType VARCHAR(128), probabilityType VARCHAR(128));
+    CREATE TABLE IonMobilityTypes (id INTEGER PRIMARY KEY, ionMobilityType VARCHAR(128));
+    CREATE INDEX idxPeptide ON RefSpectra (peptideSeq, precursorCharge);
+    CREATE INDEX idxPeptideMod ON RefSpectra (peptideModSeq, precursorCharge);
+    CREATE INDEX idxRefIdPeaks ON RefSpectraPeaks (RefSpectraID);
+"""
+
+
+def initialize_blib_file(path_to_directory, filename):
+    """Create an empty redundant .blib library at path_to_directory, filename
+
+    Returns:
+        sqlite3.Connection: Connection to the created library for subsequent writes
+    """
+
+    blib_path = os.path.join(path_to_directory, filename)
+    if os.path.exists(blib_path):
+        raise ValueError('Blib file already exists:', blib_path)
+
+    blib_connection = sqlite3.connect(blib_path)
+    blib_connection.execute('PRAGMA synchronous=OFF')
+    blib_connection.execute('PRAGMA journal_mode=MEMORY')
+
+    with blib_connection:
+        blib_connection.executescript(_blib_schema)
+
+        blib_connection.execute(
+            'INSERT INTO LibInfo VALUES (?, ?, 0, ?, ?)',
+            (
+                'urn:lsid:proteome.gs.washington.edu:spectral_library:bibliospec:redundant:' + filename,
+                datetime.now().strftime('%a %b %d %H:%M:%S %Y'),
+                _blib_major_version,
+                _blib_minor_version
+            )
+        )
+        blib_connection.executemany(
+            'INSERT INTO ScoreTypes VALUES (?, ?, ?)',
+            [(score_type_id, score_type, probability_type)
+             for score_type, (score_type_id, probability_type) in score_types.items()]
+        )
+        blib_connection.executemany(
+            'INSERT INTO IonMobilityTypes VALUES (?, ?)',
+            [(0, 'none'), (1, 'driftTime(msec)'), (2, 'inverseK0(Vsec/cm^2)'), (3, 'compensation(V)')]
+        )
+
+    return blib_connection
+
+
+def add_source_file_to_blib_file(blib_connection, spectrum_file_name, id_file_name, score_cutoff=0):
+    """Add a spectrum source file to the library
+
+    Parameters:
+        blib_connection (sqlite3.Connection): Connection to the library
+        spectrum_file_name (string): The name of the file the spectra came from
+        id_file_name (string): The name of the file the peptide identifications came from
+        score_cutoff (float): The score cutoff the PSMs were filtered with, see passes_score_cutoff
+
+    Returns:
+        int: The id of the source file, to pass to write_psms_to_blib_file
+    """
+
+    with blib_connection:
+        cursor = blib_connection.execute(
+            'INSERT INTO SpectrumSourceFiles (fileName, idFileName, cutoffScore) VALUES (?, ?, ?)',
+            (spectrum_file_name, id_file_name, score_cutoff)
+        )
+
+    return cursor.lastrowid
+
+
+def write_spectra_to_blib_file(blib_connection, file_id, scans_and_psms, score_type=default_score_type):
+    """Add one spectrum to the library for each PSM, using the peaks of the scan the PSM was
+    identified from. Matches what BlibBuild adds for the same PSMs in a .ssl file. The spectra
+    are bulk inserted, so call this with a batch of scans at a time.
+
+    Parameters:
+        blib_connection (sqlite3.Connection): Connection to the library
+        file_id (int): The id of the source file, from add_source_file_to_blib_file
+        scans_and_psms (iterable): (MS2ScanData, list of PSM dicts from the request) tuples
+        score_type (string): The score type of the PSMs' scores, one of score_types
+
+    Returns:
+        NoneType
+    """
+
+    if score_type not in score_types:
+        raise ValueError('Unknown score type:', score_type)
+
+    score_type_id = score_types[score_type][0]
+    ref_spectra_rows = []
+    peak_rows = []
+    modification_rows = []
+
+    ref_spectra_id = blib_connection.execute('SELECT COALESCE(MAX(id), 0) FROM RefSpectra').fetchone()[0]
+
+    for ms2_scan, psms in scans_and_psms:
+        peak_mz_blob, peak_intensity_blob = encode_peaks(ms2_scan.peak_list_mz, ms2_scan.peak_list_intensity)
+        num_peaks = len(ms2_scan.peak_list_mz)
+        total_ion_current = sum(ms2_scan.peak_list_intensity)
+        retention_time_minutes = ms2_scan.retention_time_seconds / 60
+
+        for psm in psms:
+            ref_spectra_id += 1
+            peptide_sequence = psm['peptide_sequence']
+            modifications = get_localized_modifications(peptide_sequence, psm.get('modifications'))
+
+            ref_spectra_rows.append((
+                ref_spectra_id,
+                peptide_sequence,
+                ms2_scan.precursor_mz,
+                psm['charge'],
+                build_blib_modified_sequence(peptide_sequence, modifications),
+                num_peaks,
+                retention_time_minutes,
+                total_ion_current,
+                file_id,
+                str(ms2_scan.scan_number),
+                psm.get('score', 0.0),
+                score_type_id
+            ))
+            peak_rows.append((ref_spectra_id, peak_mz_blob, peak_intensity_blob))
+            modification_rows.extend((ref_spectra_id, position, mass) for position, mass in modifications)
+
+    blib_connection.executemany(
+        'INSERT INTO RefSpectra (id, peptideSeq, precursorMZ, precursorCharge, peptideModSeq, prevAA, nextAA, copies, '
+        'numPeaks, ionMobility, collisionalCrossSectionSqA, ionMobilityHighEnergyOffset, ionMobilityType, '
+        'retentionTime, startTime, endTime, totalIonCurrent, moleculeName, chemicalFormula, precursorAdduct, '
+        'inchiKey, otherKeys, fileID, SpecIDinFile, score, scoreType) '
+        'VALUES (?, ?, ?, ?, ?, \'-\', \'-\', 1, ?, 0, 0, 0, 0, ?, NULL, NULL, ?, \'\', \'\', \'\', \'\', \'\', '
+        '?, ?, ?, ?)',
+        ref_spectra_rows
+    )
+    blib_connection.executemany(
+        'INSERT INTO RefSpectraPeaks (RefSpectraID, peakMZ, peakIntensity) VALUES (?, ?, ?)',
+        peak_rows
+    )
+    blib_connection.executemany(
+        'INSERT INTO Modifications (RefSpectraID, position, mass) VALUES (?, ?, ?)',
+        modification_rows
+    )
+
+
+def close_blib_file(blib_connection):
+    """Record the number of spectra in the library, then commit and close it
+
+    Returns:
+        NoneType
+    """
+
+    with blib_connection:
+        blib_connection.execute('UPDATE LibInfo SET numSpecs = (SELECT COUNT(*) FROM RefSpectra)')
+
+    blib_connection.close()
+
+
+def merge_blib_files(path_to_directory, filename, input_filenames):
+    """Create a redundant .blib library containing every spectrum of the input libraries, which
+    must have been written by this module. Much faster than merging with BlibBuild, as the
+    spectra are copied table to table without decoding them.
+
+    Parameters:
+        path_to_directory (string): Full path to the directory of the input and output libraries
+        filename (string): The filename of the library to create
+        input_filenames (list): The filenames of the libraries to merge
+
+    Returns:
+        NoneType
+    """
+
+    blib_connection = initialize_blib_file(path_to_directory, filename)
+
+    try:
+        for input_filename in input_filenames:
+            input_path = os.path.join(path_to_directory, input_filename)
+            blib_connection.execute('ATTACH DATABASE ? AS input_blib', (input_path,))
+
+            with blib_connection:
+                id_offset = blib_connection.execute('SELECT COALESCE(MAX(id), 0) FROM RefSpectra').fetchone()[0]
+                file_id_offset = blib_connection.execute(
+                    'SELECT COALESCE(MAX(id), 0) FROM SpectrumSourceFiles'
+                ).fetchone()[0]
+
+                blib_connection.execute(
+                    'INSERT INTO SpectrumSourceFiles (id, fileName, idFileName, cutoffScore) '
+                    'SELECT id + ?, fileName, idFileName, cutoffScore FROM input_blib.SpectrumSourceFiles',
+                    (file_id_offset,)
+                )
+                blib_connection.execute(
+                    'INSERT INTO RefSpectra SELECT id + ?, peptideSeq, precursorMZ, precursorCharge, peptideModSeq, '
+                    'prevAA, nextAA, copies, numPeaks, ionMobility, collisionalCrossSectionSqA, '
+                    'ionMobilityHighEnergyOffset, ionMobilityType, retentionTime, startTime, endTime, totalIonCurrent, '
+                    'moleculeName, chemicalFormula, precursorAdduct, inchiKey, otherKeys, fileID + ?, SpecIDinFile, '
+                    'score, scoreType FROM input_blib.RefSpectra',
+                    (id_offset, file_id_offset)
+                )
+                blib_connection.execute(
+                    'INSERT INTO RefSpectraPeaks SELECT RefSpectraID + ?, peakMZ, peakIntensity '
+                    'FROM input_blib.RefSpectraPeaks',
+                    (id_offset,)
+                )
+                blib_connection.execute(
+                    'INSERT INTO Modifications (RefSpectraID, position, mass) '
+                    'SELECT RefSpectraID + ?, position, mass FROM input_blib.Modifications',
+                    (id_offset,)
+                )
+
+            blib_connection.execute('DETACH DATABASE input_blib')
+
+    finally:
+        close_blib_file(blib_connection)
+
+
+def encode_peaks(peak_list_mz, peak_list_intensity):
+    """Encode the peaks as blobs the way BiblioSpec stores them: m/z values as little-endian
+    doubles, intensities as little-endian floats, each zlib compressed if that makes it smaller
+
+    Parameters:
+        peak_list_mz (array): array of m/z values from scan
+        peak_list_intensity (array): array of intensities corresponding to m/z array
+
+    Returns:
+        tuple: (m/z blob, intensity blob)
+    """
+
+    mz_values = array('d', peak_list_mz)
+    intensity_values = array('f', peak_list_intensity)
+
+    if sys.byteorder != 'little':
+        mz_values.byteswap()
+        intensity_values.byteswap()
+
+    return _compress_if_smaller(mz_values.tobytes()), _compress_if_smaller(intensity_values.tobytes())
+
+
+def _compress_if_smaller(data):
+    """BiblioSpec tells compressed from uncompressed blobs by comparing the blob size to the
+    uncompressed size, so only use the compressed data if it is smaller"""
+
+    compressed_data = zlib.compress(data)
+
+    if len(compressed_data) < len(data):
+        return compressed_data
+
+    return data
+
+
+def decode_peaks(peak_mz_blob, peak_intensity_blob, num_peaks):
+    """Decode peak blobs as stored by BiblioSpec, see encode_peaks
+
+    Returns:
+        tuple: (array of m/z values, array of intensities)
+    """
+
+    peak_list_mz = array('d', _decompress_if_compressed(peak_mz_blob, num_peaks * 8))
+    peak_list_intensity = array('f', _decompress_if_compressed(peak_intensity_blob, num_peaks * 4))
+
+    if sys.byteorder != 'little':
+        peak_list_mz.byteswap()
+        peak_list_intensity.byteswap()
+
+    return peak_list_mz, peak_list_intensity
+
+
+def _decompress_if_compressed(data, uncompressed_size):
+    if len(data) < uncompressed_size:
+        return zlib.decompress(data)
+
+    return data
+
+
+def get_localized_modifications(peptide_sequence, modifications):
+    """Get the modifications of a PSM as (position, mass) tuples, with n- and c-terminal
+    modifications placed on the first and last residue, as done for the .ssl files. Unlocalized
+    modifications are ignored. The supplied modifications are not changed.
+
+    Parameters:
+        peptide_sequence (string): The naked peptide sequence (no mods)
+        modifications (dict): { position_value: mass }, position values are strings
+
+    Returns:
+        list: (1-based position, mass) tuples sorted by position
+    """
+
+    if modifications is None or len(modifications) < 1:
+        return []
+
+    masses_by_position = {}
+
+    for position_value, mass in modifications.items():
+        if position_value == 'n':
+            position = 1
+        elif position_value == 'c':
+            position = len(peptide_sequence)
+        elif position_value == 'u':
+            continue
+        else:
+            position = int(position_value)
+
+        masses_by_position[position] = masses_by_position.get(position, 0) + mass
+
+    return sorted(masses_by_position.items())
+
+
+def is_lower_score_better(score_type):
+    """Determine whether lower scores are better for the given score type. True for score types
+    that are a probability the identification is incorrect (q-values, expectation values, etc.)
+
+    Returns:
+        bool
+    """
+
+    if score_type not in score_types:
+        raise ValueError('Unknown score type:', score_type)
+
+    return score_types[score_type][1] == 'PROBABILITY_THAT_IDENTIFICATION_IS_INCORRECT'
+
+
+def passes_score_cutoff(score_type, score, score_cutoff):
+    """Determine whether a PSM is kept in the library under BlibBuild's score cutoff (-c). Scores that
+    are a probability the identification is correct must be at least the cutoff, scores that are a
+    probability the identification is incorrect must be at most 1 - cutoff, and other scores are
+    always kept.
+
+    Parameters:
+        score_type (string): The score type of the PSM's score, one of score_types
+        score (float): The score of the PSM
+        score_cutoff (float): The cutoff, between 0 and 1
+
+    Returns:
+        bool
+    """
+
+    if score_type not in score_types:
+        raise ValueError('Unknown score type:', score_type)
+
+    probability_type = score_types[score_type][1]
+
+    if probability_type == 'PROBABILITY_THAT_IDENTIFICATION_IS_CORRECT':
+        return score >= score_cutoff
+
+    if probability_type == 'PROBABILITY_THAT_IDENTIFICATION_IS_INCORRECT':
+        return score <= 1 - score_cutoff
+
+    return True
+
+
+def build_blib_modified_sequence(peptide_sequence, localized_modifications):
+    """Build the peptideModSeq of a spectrum, e.g. "PEP[+16.0]TIDE". BiblioSpec writes
+    modification masses with one decimal place.
+
+    Parameters:
+        peptide_sequence (string): The naked peptide sequence (no mods)
+        localized_modifications (list): (1-based position, mass) tuples sorted by position
+
+    Returns:
+        string
+    """
+
+    if len(localized_modifications) < 1:
+        return peptide_sequence
+
+    parts = []
+    previous_position = 0
+
+    for position, mass in localized_modifications:
+        parts.append(peptide_sequence[previous_position:position])
+        parts.append('[%+.1f]' % mass)
+        previous_position = position
+
+    parts.append(peptide_sequence[previous_position:])
+
+    return ''.join(parts)
+
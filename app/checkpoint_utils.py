@@ -0,0 +1,149 @@
+"""Checkpoints of the work completed for a request, kept in its working directory, so a retried or
+resumed request skips the scan files and stages that are already done"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import json
+from . import general_utils
+
+_checkpoint_filename = 'checkpoint.json'
+
+
+class RequestCheckpoint:
+    """The scan files and stages completed for a request. Scan files are identified by a key of their
+    PSMs and the settings they were written with, see get_scan_file_key, so work done for different
+    data or settings is never reused. Stages are recorded with the keys of the scan files they used."""
+
+    def __init__(self, workdir):
+        """Load the checkpoint in workdir, or create an empty one if there is none
+
+        Parameters:
+            workdir (string): Full path to the working directory of the request
+
+        Returns:
+            RequestCheckpoint object
+        """
+
+        self._checkpoint_path = os.path.join(workdir, _checkpoint_filename)
+        self._workdir = workdir
+
+        if os.path.exists(self._checkpoint_path):
+            with open(self._checkpoint_path) as checkpoint_file:
+                self._state = json.load(checkpoint_file)
+        else:
+            self._state = {'scan_files': {}, 'stages': {}}
+
+    def get_scan_file_result(self, scan_file_key):
+        """Get the result of a completed scan file, if its files are all still in the working directory
+
+        Parameters:
+            scan_file_key (string): The key of the scan file, see get_scan_file_key
+
+        Returns:
+            dict: The dict returned by create_ms2_file or create_redundant_blib_file, or None
+        """
+
+        result_dict = self._state['scan_files'].get(scan_file_key)
+
+        if result_dict is None:
+            return None
+
+        for name, value in result_dict.items():
+            if name.endswith('_file_name') and not os.path.exists(os.path.join(self._workdir, value)):
+                return None
+
+        return result_dict
+
+    def record_scan_file_result(self, scan_file_key, result_dict):
+        """Record that a scan file is complete, and save the checkpoint
+
+        Parameters:
+            scan_file_key (string): The key of the scan file, see get_scan_file_key
+            result_dict (dict): The dict returned by create_ms2_file or create_redundant_blib_file
+
+        Returns:
+            NoneType
+        """
+
+        self._state['scan_files'][scan_file_key] = result_dict
+        self.save()
+
+    def is_stage_done(self, stage_name, scan_file_keys):
+        """Determine whether a stage was completed for the given scan files
+
+        Parameters:
+            stage_name (string): The name of the stage, e.g. 'ssl'
+            scan_file_keys (list): The keys of the scan files of the request, in request order
+
+        Returns:
+            bool
+        """
+        return self._state['stages'].get(stage_name) == scan_file_keys
+
+    def record_stage_done(self, stage_name, scan_file_keys):
+        """Record that a stage is complete for the given scan files, and save the checkpoint
+
+        Parameters:
+            stage_name (string): The name of the stage, e.g. 'ssl'
+            scan_file_keys (list): The keys of the scan files of the request, in request order
+
+        Returns:
+            NoneType
+        """
+
+        self._state['stages'][stage_name] = scan_file_keys
+        self.save()
+
+    def save(self):
+        """Write the checkpoint to the working directory. The previous checkpoint is replaced in one
+        step, so an interrupted write never leaves a partial checkpoint.
+
+        Returns:
+            NoneType
+        """
+
+        temp_path = self._checkpoint_path + '.tmp'
+
+        with open(temp_path, 'w') as checkpoint_file:
+            json.dump(self._state, checkpoint_file)
+
+        os.replace(temp_path, self._checkpoint_path)
+
+
+def has_checkpoint(workdir):
+    """Determine whether workdir holds a checkpoint, i.e. whether its request can be resumed
+
+    Parameters:
+        workdir (string): Full path to the working directory of a request
+
+    Returns:
+        bool
+    """
+    return os.path.exists(os.path.join(workdir, _checkpoint_filename))
+
+
+def get_scan_file_key(spectr_dict, file_id, build_options):
+    """Get the key identifying the files written for one scan file of a request
+
+    Parameters:
+        spectr_dict (dict): The part of the conversion request for a single spectr file id
+        file_id (int): The base of the filenames written for the scan file
+        build_options (list): Any settings that change the files written for the scan file
+
+    Returns:
+        string: The key
+    """
+    return general_utils.hash_scan_file_data(spectr_dict, [build_options, file_id])
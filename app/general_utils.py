@@ -1,13 +1,166 @@
 import uuid
+import json
+import queue
+import hashlib
+import functools
+import threading
+
+# the number of distinct peptide strings to cache, see build_peptide_string_with_mods
+_peptide_string_cache_size = 100000
 
 
 def generate_request_id():
     return str(uuid.uuid4())
 
 
+def hash_request_data(project_id, spectral_data):
+    """Calculate a hash identifying the result of a conversion request. Requests for the same
+    project with the same scan files and PSMs get the same hash, regardless of the order of the
+    scan files, of the PSMs, or of the keys within each PSM.
+
+    Parameters:
+        project_id (int): The limelight project id
+        spectral_data (list): The spectral_data of the request, a list of dicts, one per scan file
+
+    Returns:
+        string: The hex digest of the hash
+    """
+
+    canonical_files = sorted(_get_canonical_scan_file_data(spectr_dict) for spectr_dict in spectral_data)
+
+    return _hash_json([project_id, canonical_files])
+
+
+def is_spectral_data_valid(spectral_data):
+    """Determine whether the spectral_data of a conversion request has the structure the request is
+    hashed and queued by: a list of dicts, one per scan file, each with a spectr_file_id string and a
+    list of PSM dicts that each have a scan_number
+
+    Parameters:
+        spectral_data (list): The spectral_data of the request
+
+    Returns:
+        bool
+    """
+
+    if not isinstance(spectral_data, list):
+        return False
+
+    for spectr_dict in spectral_data:
+        if not isinstance(spectr_dict, dict) or not isinstance(spectr_dict.get('spectr_file_id'), str) \
+                or not isinstance(spectr_dict.get('psms'), list):
+            return False
+
+        for psm in spectr_dict['psms']:
+            if not isinstance(psm, dict) or 'scan_number' not in psm:
+                return False
+
+    return True
+
+
+def hash_scan_file_data(spectr_dict, build_options):
+    """Calculate a hash identifying the library built from one scan file of a conversion request,
+    regardless of the order of the PSMs or of the keys within each PSM
+
+    Parameters:
+        spectr_dict (dict): The part of the conversion request for a single spectr file id
+        build_options (list): Any settings that change the library built from the scan file
+
+    Returns:
+        string: The hex digest of the hash
+    """
+
+    return _hash_json([_get_canonical_scan_file_data(spectr_dict), build_options])
+
+
+def _get_canonical_scan_file_data(spectr_dict):
+    """Get the spectr file id, the sorted, canonically serialized PSMs and the score type (if any)
+    of one scan file
+
+    Returns:
+        list: [spectr file id, sorted list of PSM json strings(, score type)]
+    """
+
+    canonical_data = [
+        spectr_dict['spectr_file_id'],
+        sorted(json.dumps(psm, sort_keys=True, separators=(',', ':')) for psm in spectr_dict['psms'])
+    ]
+
+    if 'score_type' in spectr_dict:
+        canonical_data.append(spectr_dict['score_type'])
+
+    return canonical_data
+
+
+def _hash_json(ob):
+    """Return the sha256 hex digest of the compact JSON serialization of ob"""
+    return hashlib.sha256(json.dumps(ob, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+def iterate_in_background_thread(iterable, max_queued):
+    """Consume the iterable in a separate thread, handing its items to the caller through a
+    bounded queue. Lets the work done producing each item overlap with the caller's work
+    consuming the previous ones, while holding at most max_queued items in memory. Exceptions
+    raised by the iterable are re-raised in the caller.
+
+    Parameters:
+        iterable (iterable): The items to produce in the background
+        max_queued (int): The maximum number of produced items waiting to be consumed
+
+    Returns:
+        generator: Yields the items of the iterable, in order
+    """
+
+    item_queue = queue.Queue(maxsize=max_queued)
+    stop_event = threading.Event()
+    done_marker = object()
+
+    def put(entry):
+        # give up if the consumer has gone away, rather than blocking forever on a full queue
+        while not stop_event.is_set():
+            try:
+                item_queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+
+            put((done_marker, None))
+
+        except BaseException as e:
+            put((None, e))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            item, error = item_queue.get()
+
+            if error is not None:
+                raise error
+
+            if item is done_marker:
+                return
+
+            yield item
+
+    finally:
+        stop_event.set()
+        producer.join()
+
+
 def build_peptide_string_with_mods(peptide_sequence, mods):
     """Build a peptide string from a sequence and set of modifications. E.g., "PEPTIDE" and
-    mods of {'3':28.32} becomes "PEP[28.32]TIDE"
+    mods of {'3':28.32} becomes "PEP[28.32]TIDE". The mods are not changed. Strings are cached,
+    as most PSMs of an export share their sequence and mods with other PSMs.
 
     Parameters:
         peptide_sequence (string): The naked peptide sequence (no mods)
@@ -20,6 +173,18 @@ def build_peptide_string_with_mods(peptide_sequence, mods):
     if mods is None or len(mods) < 1:
         return peptide_sequence
 
+    # the type of each mass is part of the key, as 16 and 16.0 are formatted differently
+    mods_key = tuple((position, mass.__class__, mass) for position, mass in sorted(mods.items()))
+
+    return _build_peptide_string_with_mods(peptide_sequence, mods_key)
+
+
+@functools.lru_cache(maxsize=_peptide_string_cache_size)
+def _build_peptide_string_with_mods(peptide_sequence, mods_key):
+    """Build the peptide string for build_peptide_string_with_mods from its hashable mods key"""
+
+    mods = {position: mass for position, mass_class, mass in mods_key}
+
     # handle terminal mods
     if 'n' in mods:
         if '1' in mods:
@@ -39,28 +204,25 @@ def build_peptide_string_with_mods(peptide_sequence, mods):
 
         del mods['c']
 
-    # we are ignoring unlocalized mods for now
-    # handle unlocalized mods--just set them as n-terminal mods
-    # if 'u' in mods:
-    #     if '1' in mods:
-    #         mods['1'] = mods['1'] + mods['u']
-    #     else:
-    #         mods['1'] = mods['u']
-    #
-    #     del mods['u']
+    # we are ignoring unlocalized mods for now, and any other position outside of the peptide
+    mod_positions = sorted(
+        int(position) for position in mods
+        if position.isdigit() and str(int(position)) == position and 1 <= int(position) <= len(peptide_sequence)
+    )
 
-    output_string = ''
+    parts = []
+    previous_position = 0
 
-    for element in range(0, len(peptide_sequence)):
+    for position in mod_positions:
+        mass = mods[str(position)]
 
-        output_string += peptide_sequence[element]
+        parts.append(peptide_sequence[previous_position:position])
+        parts.append('[+' if mass > 0 else '[')
+        parts.append(str(mass))
+        parts.append(']')
 
-        if str(element + 1) in mods:
-            mass = mods[str(element + 1)]
-            mass_str = str(mass)
-            if mass > 0:
-                mass_str = '+' + mass_str
+        previous_position = position
 
-            output_string += '[' + mass_str + ']'
+    parts.append(peptide_sequence[previous_position:])
 
-    return output_string
+    return ''.join(parts)
@@ -0,0 +1,173 @@
+"""Methods for the on-disk cache of redundant libraries built from single scan files"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import uuid
+from . import __library_cache_dir_env_key__, __library_cache_max_mb_env_key__, __library_cache_default_max_mb__, \
+    general_utils
+
+# file extension of the cached libraries
+_library_extension = '.redundant.blib'
+
+
+def is_library_cache_enabled():
+    """Determine whether per scan file libraries are built and cached. Enabled if the library cache
+    directory env var is set.
+
+    Returns:
+        bool
+    """
+    return os.getenv(__library_cache_dir_env_key__) is not None
+
+
+def get_library_cache_max_bytes():
+    """Get the maximum size of the library cache in bytes. Uses the library cache max MB env var,
+    falls back to the default if not set.
+
+    Returns:
+        int: The maximum size of the library cache in bytes
+    """
+
+    max_mb = os.getenv(__library_cache_max_mb_env_key__)
+
+    if max_mb is None:
+        max_mb = __library_cache_default_max_mb__
+    else:
+        max_mb = int(max_mb)
+
+    return max_mb * 1024 * 1024
+
+
+def get_scan_file_library_key(spectr_dict, build_options):
+    """Get the key of the cached library for one scan file of a request
+
+    Parameters:
+        spectr_dict (dict): The part of the conversion request for a single spectr file id
+        build_options (list): Any settings that change the library built from the scan file
+
+    Returns:
+        string: The key
+    """
+    return general_utils.hash_scan_file_data(spectr_dict, build_options)
+
+
+def retrieve_cached_library(library_key, destination_path):
+    """Place the cached library with the given key at destination_path, hard linking it if possible
+    so that it stays readable even if it is evicted from the cache while in use
+
+    Parameters:
+        library_key (string): The key of the library, see get_scan_file_library_key
+        destination_path (string): Full path to place the library at
+
+    Returns:
+        bool: True if the library was in the cache, False otherwise
+    """
+
+    cached_path = _get_cached_library_path(library_key)
+
+    try:
+        try:
+            os.link(cached_path, destination_path)
+        except OSError as e:
+            if not os.path.exists(cached_path):
+                raise e
+
+            # different file system, fall back to a copy
+            shutil.copyfile(cached_path, destination_path)
+
+    except FileNotFoundError:
+        return False
+
+    # mark as recently used
+    try:
+        os.utime(cached_path)
+    except FileNotFoundError:
+        pass
+
+    return True
+
+
+def add_library_to_cache(library_key, library_path):
+    """Copy the library at library_path into the cache under the given key, then evict the least
+    recently used libraries until the cache is within its size budget
+
+    Parameters:
+        library_key (string): The key of the library, see get_scan_file_library_key
+        library_path (string): Full path to the library to cache
+
+    Returns:
+        NoneType
+    """
+
+    cached_path = _get_cached_library_path(library_key)
+
+    # copy under a temporary name then rename, so other requests never see a partial library
+    temp_path = cached_path + '.' + str(uuid.uuid4()) + '.tmp'
+    shutil.copyfile(library_path, temp_path)
+    os.replace(temp_path, cached_path)
+
+    evict_libraries_over_budget(get_library_cache_max_bytes())
+
+
+def evict_libraries_over_budget(max_bytes):
+    """Remove the least recently used libraries from the cache until its total size is at or
+    below max_bytes
+
+    Parameters:
+        max_bytes (int): The size budget of the cache in bytes
+
+    Returns:
+        NoneType
+    """
+
+    cache_dir = _get_library_cache_dir()
+    libraries = []
+
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(_library_extension):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+
+            libraries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_bytes = sum(library[1] for library in libraries)
+
+    for mtime, size, path in sorted(libraries):
+        if total_bytes <= max_bytes:
+            break
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+        total_bytes -= size
+
+
+def _get_library_cache_dir():
+    cache_dir = os.getenv(__library_cache_dir_env_key__)
+
+    if not os.path.isdir(cache_dir):
+        raise ValueError('Library cache directory does not exist:', cache_dir)
+
+    return cache_dir
+
+
+def _get_cached_library_path(library_key):
+    return os.path.join(_get_library_cache_dir(), library_key + _library_extension)
@@ -0,0 +1,278 @@
+"""Counters and histograms describing the work done by the service, exported in the Prometheus
+text format"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import bisect
+import threading
+
+# upper bounds of the histogram buckets
+_seconds_buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+_bytes_buckets = (1024, 16384, 131072, 1048576, 4194304, 16777216, 67108864, 268435456)
+_scan_count_buckets = (1, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# name => (type, help text, histogram buckets)
+metric_definitions = {
+    'blib_export_spectr_batch_seconds': (
+        'histogram', 'Time to request and read one batch of scans from spectr.', _seconds_buckets
+    ),
+    'blib_export_spectr_batch_bytes': (
+        'histogram', 'Size of the response body of one batch of scans from spectr.', _bytes_buckets
+    ),
+    'blib_export_spectr_batch_scans': (
+        'histogram', 'Scans requested in one request to spectr, as chosen by the batch sizing.', _scan_count_buckets
+    ),
+    'blib_export_spectr_retries_total': (
+        'counter', 'Requests to spectr retried after a 502, 503 or 504 error, a timeout or a lost connection.', None
+    ),
+    'blib_export_spectr_scans_fetched_total': (
+        'counter', 'Scans read from spectr.', None
+    ),
+    'blib_export_scan_cache_hits_total': (
+        'counter', 'Scans read from the scan cache instead of spectr.', None
+    ),
+    'blib_export_spectrum_file_write_seconds': (
+        'histogram', 'Time spent writing scans to the spectrum file (or library) of one scan file.', _seconds_buckets
+    ),
+    'blib_export_scan_file_seconds': (
+        'histogram', 'Time to gather and write all scans of one scan file.', _seconds_buckets
+    ),
+    'blib_export_blib_build_seconds': (
+        'histogram', 'Time to build a redundant library, by BlibBuild or the native engine.', _seconds_buckets
+    ),
+    'blib_export_blib_filter_seconds': (
+        'histogram', 'Time to run BlibFilter.', _seconds_buckets
+    ),
+    'blib_export_move_seconds': (
+        'histogram', 'Time to move a finished library to its final location.', _seconds_buckets
+    ),
+    'blib_export_request_seconds': (
+        'histogram', 'Time to process one request, by outcome.', _seconds_buckets
+    ),
+    'blib_export_requests_total': (
+        'counter', 'Requests processed, by outcome.', None
+    )
+}
+
+# (name, labels) => value for counters, [bucket counts, sum, count] for histograms
+_values = {}
+_values_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    """Start a forked process (e.g. an mpire worker) with a new lock and no values. Another thread of the
+    parent may have held the lock at the time of the fork, and would never release it in the child. Values
+    recorded in a worker are sent to the parent as a snapshot difference, see get_snapshot_difference."""
+
+    global _values, _values_lock
+
+    _values = {}
+    _values_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def increment_counter(name, amount=1, labels=None):
+    """Add amount to the counter with the given name and labels
+
+    Parameters:
+        name (string): The name of the counter, see metric_definitions
+        amount (float): The amount to add
+        labels (dict): Label name => label value, or None
+
+    Returns:
+        NoneType
+    """
+
+    key = (name, _get_labels_key(labels))
+
+    with _values_lock:
+        _values[key] = _values.get(key, 0) + amount
+
+
+def observe_histogram(name, value, labels=None):
+    """Record a value in the histogram with the given name and labels
+
+    Parameters:
+        name (string): The name of the histogram, see metric_definitions
+        value (float): The observed value
+        labels (dict): Label name => label value, or None
+
+    Returns:
+        NoneType
+    """
+
+    key = (name, _get_labels_key(labels))
+    buckets = metric_definitions[name][2]
+
+    with _values_lock:
+        histogram = _values.get(key)
+        if histogram is None:
+            histogram = [[0] * len(buckets), 0.0, 0]
+            _values[key] = histogram
+
+        bucket_index = bisect.bisect_left(buckets, value)
+        if bucket_index < len(buckets):
+            histogram[0][bucket_index] += 1
+
+        histogram[1] += value
+        histogram[2] += 1
+
+
+def get_snapshot():
+    """Get a copy of the current values of all metrics in this process
+
+    Returns:
+        dict: (name, labels) => value
+    """
+
+    with _values_lock:
+        return {key: _copy_value(value) for key, value in _values.items()}
+
+
+def get_snapshot_difference(before, after):
+    """Get what was recorded between two snapshots, e.g. by a worker process, so it can be merged
+    into the metrics of the main process
+
+    Parameters:
+        before (dict): The earlier snapshot
+        after (dict): The later snapshot
+
+    Returns:
+        dict: (name, labels) => value recorded between the snapshots
+    """
+
+    difference = {}
+
+    for key, value in after.items():
+        before_value = before.get(key)
+
+        if before_value is None:
+            difference[key] = value
+        elif isinstance(value, list):
+            if value[2] != before_value[2]:
+                difference[key] = [
+                    [count - before_count for count, before_count in zip(value[0], before_value[0])],
+                    value[1] - before_value[1],
+                    value[2] - before_value[2]
+                ]
+        elif value != before_value:
+            difference[key] = value - before_value
+
+    return difference
+
+
+def merge_snapshot(snapshot):
+    """Add the values of a snapshot (or snapshot difference) to the metrics of this process
+
+    Parameters:
+        snapshot (dict): (name, labels) => value
+
+    Returns:
+        NoneType
+    """
+
+    with _values_lock:
+        for key, value in snapshot.items():
+            current_value = _values.get(key)
+
+            if current_value is None:
+                _values[key] = _copy_value(value)
+            elif isinstance(value, list):
+                for bucket_index, count in enumerate(value[0]):
+                    current_value[0][bucket_index] += count
+
+                current_value[1] += value[1]
+                current_value[2] += value[2]
+            else:
+                _values[key] = current_value + value
+
+
+def render_metrics(gauges=None):
+    """Render all metrics in the Prometheus text exposition format
+
+    Parameters:
+        gauges (list): Extra gauges computed at render time: (name, help text, value) tuples
+
+    Returns:
+        string
+    """
+
+    snapshot = get_snapshot()
+    lines = []
+
+    for name, (metric_type, help_text, buckets) in metric_definitions.items():
+        lines.append('# HELP ' + name + ' ' + help_text)
+        lines.append('# TYPE ' + name + ' ' + metric_type)
+
+        for (key_name, labels_key), value in sorted(snapshot.items(), key=lambda item: item[0][1]):
+            if key_name != name:
+                continue
+
+            if metric_type == 'counter':
+                lines.append(name + _format_labels(labels_key) + ' ' + _format_number(value))
+                continue
+
+            bucket_counts, value_sum, value_count = value
+            cumulative_count = 0
+
+            for bucket, bucket_count in zip(buckets, bucket_counts):
+                cumulative_count += bucket_count
+                lines.append(name + '_bucket' + _format_labels(labels_key + (('le', _format_number(bucket)),)) +
+                             ' ' + str(cumulative_count))
+
+            lines.append(name + '_bucket' + _format_labels(labels_key + (('le', '+Inf'),)) + ' ' + str(value_count))
+            lines.append(name + '_sum' + _format_labels(labels_key) + ' ' + _format_number(value_sum))
+            lines.append(name + '_count' + _format_labels(labels_key) + ' ' + str(value_count))
+
+    for name, help_text, value in gauges or []:
+        lines.append('# HELP ' + name + ' ' + help_text)
+        lines.append('# TYPE ' + name + ' gauge')
+        lines.append(name + ' ' + _format_number(value))
+
+    return '\n'.join(lines) + '\n'
+
+
+def _get_labels_key(labels):
+    if labels is None:
+        return ()
+
+    return tuple(sorted(labels.items()))
+
+
+def _copy_value(value):
+    if isinstance(value, list):
+        return [list(value[0]), value[1], value[2]]
+
+    return value
+
+
+def _format_labels(labels_key):
+    if len(labels_key) < 1:
+        return ''
+
+    return '{' + ','.join(
+        label_name + '="' + str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for label_name, label_value in labels_key
+    ) + '}'
+
+
+def _format_number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return str(value)
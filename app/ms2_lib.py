@@ -19,8 +19,10 @@ from datetime import datetime
 import os
 
 
-def write_scan_to_ms2_file(ms2_file, scan_number, precursor_mz, charge, peak_list_mz, peak_list_intensity):
-    """Write the supplied scan data to the ms2_file
+def write_scan_to_ms2_file(ms2_file, scan_number, precursor_mz, charge, peak_list_mz, peak_list_intensity,
+                           mz_precision=None, intensity_precision=None):
+    """Write the supplied scan data to the ms2_file. The whole scan is formatted in one pass and
+    written with a single call.
 
     Example scan lines:
         S	10	10	636.34
@@ -36,20 +38,70 @@ def write_scan_to_ms2_file(ms2_file, scan_number, precursor_mz, charge, peak_lis
         scan_number (int): Scan number of the scan
         precursor_mz (float): Precursor m/z
         charge (int): Charge for this scan
-        peak_list_mz (list): array of m/z values from scan
-        peak_list_intensity (list): array of intensities corresponding to m/z array
+        peak_list_mz (array): array of m/z values from scan
+        peak_list_intensity (array): array of intensities corresponding to m/z array
+        mz_precision (int): Number of decimal places to write for peak m/z values, None for full precision
+        intensity_precision (int): Number of decimal places to write for peak intensities, None for full precision
 
     Returns:
         NoneType
     """
 
+    ms2_file.write(format_scan_for_ms2_file(
+        scan_number,
+        precursor_mz,
+        charge,
+        peak_list_mz,
+        peak_list_intensity,
+        mz_precision,
+        intensity_precision
+    ))
+
+
+def format_scan_for_ms2_file(scan_number, precursor_mz, charge, peak_list_mz, peak_list_intensity,
+                             mz_precision=None, intensity_precision=None):
+    """Format the supplied scan data as the S, Z and peak lines of a .ms2 file. With no precision
+    given, values are written exactly as str() writes them.
+
+    Parameters:
+        scan_number (int): Scan number of the scan
+        precursor_mz (float): Precursor m/z
+        charge (int): Charge for this scan
+        peak_list_mz (array): array of m/z values from scan
+        peak_list_intensity (array): array of intensities corresponding to m/z array
+        mz_precision (int): Number of decimal places to write for peak m/z values, None for full precision
+        intensity_precision (int): Number of decimal places to write for peak intensities, None for full precision
+
+    Returns:
+        string: The lines for this scan, ending in a newline
+    """
+
     neutral_mass = mass_utils.get_neutral_mass_from_mz_and_charge(precursor_mz, charge)
 
-    ms2_file.write("S\t" + str(scan_number) + "\t" + str(scan_number) + "\t" + str(precursor_mz) + "\n")
-    ms2_file.write("Z\t" + str(charge) + "\t" + str(neutral_mass) + "\n")
+    peak_lines = '\n'.join(map(
+        ' '.join,
+        zip(
+            map(_get_number_formatter(mz_precision), peak_list_mz),
+            map(_get_number_formatter(intensity_precision), peak_list_intensity)
+        )
+    ))
+
+    return "S\t" + str(scan_number) + "\t" + str(scan_number) + "\t" + str(precursor_mz) + "\n" + \
+        "Z\t" + str(charge) + "\t" + str(neutral_mass) + "\n" + \
+        peak_lines + ("\n" if len(peak_lines) > 0 else "")
+
+
+def _get_number_formatter(precision):
+    """Get the function used to format peak values with the given number of decimal places
+
+    Returns:
+        function: Takes a number, returns a string
+    """
+
+    if precision is None:
+        return str
 
-    for mz, intensity in zip(peak_list_mz, peak_list_intensity):
-        ms2_file.write(str(mz) + " " + str(intensity) + "\n")
+    return ('%.' + str(precision) + 'f').__mod__
 
 
 def close_ms2_file(ms2_file):
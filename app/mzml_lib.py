@@ -0,0 +1,212 @@
+"""Methods for writing mzML files with binary encoded peak arrays, an alternative to ms2_lib"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import sys
+import zlib
+import base64
+from array import array
+from xml.sax.saxutils import quoteattr
+
+# width of the spectrum count written in the header, filled in when the file is closed
+_spectrum_count_width = 10
+
+
+class MzMLFile:
+    """An open mzML file and what is needed to write its spectra"""
+
+    __slots__ = ('file', 'spectrum_count', 'spectrum_count_position', 'use_zlib')
+
+    def __init__(self, file, spectrum_count_position, use_zlib):
+        self.file = file
+        self.spectrum_count = 0
+        self.spectrum_count_position = spectrum_count_position
+        self.use_zlib = use_zlib
+
+
+def initialize_mzml_file(path_to_directory, filename, use_zlib=False):
+    """Create a file at path_to_directory, filename and write the mzML header to it
+
+    Parameters:
+        path_to_directory (string): Full path to the directory to create the file in
+        filename (string): The filename of the mzML file
+        use_zlib (bool): Whether to zlib compress the peak arrays
+
+    Returns:
+        MzMLFile: The created file for subsequent writes of scan data
+    """
+
+    mzml_file = open(os.path.join(path_to_directory, filename), 'w')
+
+    mzml_file.write(
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0">\n'
+        '<cvList count="2">\n'
+        '<cv id="MS" fullName="Proteomics Standards Initiative Mass Spectrometry Ontology" '
+        'URI="https://raw.githubusercontent.com/HUPO-PSI/psi-ms-CV/master/psi-ms.obo"/>\n'
+        '<cv id="UO" fullName="Unit Ontology" '
+        'URI="https://raw.githubusercontent.com/bio-ontology-research-group/unit-ontology/master/unit.obo"/>\n'
+        '</cvList>\n'
+        '<fileDescription><fileContent>'
+        '<cvParam cvRef="MS" accession="MS:1000580" name="MSn spectrum" value=""/>'
+        '</fileContent>'
+        # spectrum ids are written as "scan=N", so declare that nativeID format for readers to get the
+        # scan numbers of the .ssl file back from the ids
+        '<sourceFileList count="1"><sourceFile id="SF1" name=' + quoteattr(filename) +
+        ' location=' + quoteattr('file://' + os.path.abspath(path_to_directory)) + '>'
+        '<cvParam cvRef="MS" accession="MS:1000776" name="scan number only nativeID format" value=""/>'
+        '<cvParam cvRef="MS" accession="MS:1000584" name="mzML format" value=""/>'
+        '</sourceFile></sourceFileList></fileDescription>\n'
+        '<softwareList count="1"><software id="limelight_export_blib" version="1.0">'
+        '<userParam name="Limelight blib exporter, Spectr to mzML"/>'
+        '</software></softwareList>\n'
+        '<instrumentConfigurationList count="1"><instrumentConfiguration id="IC1">'
+        '<cvParam cvRef="MS" accession="MS:1000031" name="instrument model" value=""/>'
+        '</instrumentConfiguration></instrumentConfigurationList>\n'
+        '<dataProcessingList count="1"><dataProcessing id="DP1">'
+        '<processingMethod order="1" softwareRef="limelight_export_blib">'
+        '<cvParam cvRef="MS" accession="MS:1000544" name="Conversion to mzML" value=""/>'
+        '</processingMethod></dataProcessing></dataProcessingList>\n'
+        '<run id="run" defaultInstrumentConfigurationRef="IC1" defaultSourceFileRef="SF1">\n'
+        '<spectrumList count="'
+    )
+
+    # the number of spectra is not known yet, so leave room to fill it in on close
+    spectrum_count_position = mzml_file.tell()
+    mzml_file.write('0' * _spectrum_count_width + '" defaultDataProcessingRef="DP1">\n')
+
+    return MzMLFile(mzml_file, spectrum_count_position, use_zlib)
+
+
+def write_scan_to_mzml_file(mzml_file, scan_number, precursor_mz, charge, retention_time_seconds, peak_list_mz,
+                            peak_list_intensity):
+    """Write the supplied scan data to the mzml_file as a single spectrum. m/z values are written as
+    64-bit floats and intensities as 32-bit floats, base64 encoded.
+
+    Parameters:
+        mzml_file (MzMLFile): mzML file we are writing to
+        scan_number (int): Scan number of the scan
+        precursor_mz (float): Precursor m/z
+        charge (int): Charge for this scan
+        retention_time_seconds (float): Retention time of this scan
+        peak_list_mz (array): array of m/z values from scan
+        peak_list_intensity (array): array of intensities corresponding to m/z array
+
+    Returns:
+        NoneType
+    """
+
+    mzml_file.file.write(format_scan_for_mzml_file(
+        mzml_file.spectrum_count,
+        scan_number,
+        precursor_mz,
+        charge,
+        retention_time_seconds,
+        peak_list_mz,
+        peak_list_intensity,
+        mzml_file.use_zlib
+    ))
+
+    mzml_file.spectrum_count += 1
+
+
+def format_scan_for_mzml_file(spectrum_index, scan_number, precursor_mz, charge, retention_time_seconds,
+                              peak_list_mz, peak_list_intensity, use_zlib):
+    """Format the supplied scan data as an mzML spectrum element
+
+    Returns:
+        string: The spectrum element, ending in a newline
+    """
+
+    if charge:
+        charge_param = '<cvParam cvRef="MS" accession="MS:1000041" name="charge state" value="' + str(charge) + '"/>'
+    else:
+        charge_param = ''
+
+    return (
+        '<spectrum index="' + str(spectrum_index) + '" id="scan=' + str(scan_number) + '" defaultArrayLength="' +
+        str(len(peak_list_mz)) + '">'
+        '<cvParam cvRef="MS" accession="MS:1000580" name="MSn spectrum" value=""/>'
+        '<cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="2"/>'
+        '<cvParam cvRef="MS" accession="MS:1000127" name="centroid spectrum" value=""/>'
+        '<scanList count="1">'
+        '<cvParam cvRef="MS" accession="MS:1000795" name="no combination" value=""/>'
+        '<scan><cvParam cvRef="MS" accession="MS:1000016" name="scan start time" value="' +
+        str(retention_time_seconds) + '" unitCvRef="UO" unitAccession="UO:0000010" unitName="second"/></scan>'
+        '</scanList>'
+        '<precursorList count="1"><precursor><selectedIonList count="1"><selectedIon>'
+        '<cvParam cvRef="MS" accession="MS:1000744" name="selected ion m/z" value="' + str(precursor_mz) +
+        '" unitCvRef="MS" unitAccession="MS:1000040" unitName="m/z"/>' + charge_param +
+        '</selectedIon></selectedIonList>'
+        '<activation><cvParam cvRef="MS" accession="MS:1000133" name="collision-induced dissociation" value=""/>'
+        '</activation></precursor></precursorList>'
+        '<binaryDataArrayList count="2">' +
+        _format_binary_data_array(
+            array('d', peak_list_mz),
+            '<cvParam cvRef="MS" accession="MS:1000523" name="64-bit float" value=""/>',
+            '<cvParam cvRef="MS" accession="MS:1000514" name="m/z array" value="" '
+            'unitCvRef="MS" unitAccession="MS:1000040" unitName="m/z"/>',
+            use_zlib
+        ) +
+        _format_binary_data_array(
+            array('f', peak_list_intensity),
+            '<cvParam cvRef="MS" accession="MS:1000521" name="32-bit float" value=""/>',
+            '<cvParam cvRef="MS" accession="MS:1000515" name="intensity array" value="" '
+            'unitCvRef="MS" unitAccession="MS:1000131" unitName="number of detector counts"/>',
+            use_zlib
+        ) +
+        '</binaryDataArrayList></spectrum>\n'
+    )
+
+
+def _format_binary_data_array(values, precision_param, array_type_param, use_zlib):
+    """Format a binaryDataArray element holding the values, encoded in one pass over the array buffer
+
+    Returns:
+        string
+    """
+
+    # mzML binary data is little-endian
+    if sys.byteorder != 'little':
+        values.byteswap()
+
+    data = values.tobytes()
+
+    if use_zlib:
+        data = zlib.compress(data)
+        compression_param = '<cvParam cvRef="MS" accession="MS:1000574" name="zlib compression" value=""/>'
+    else:
+        compression_param = '<cvParam cvRef="MS" accession="MS:1000576" name="no compression" value=""/>'
+
+    encoded_data = base64.b64encode(data).decode('ascii')
+
+    return '<binaryDataArray encodedLength="' + str(len(encoded_data)) + '">' + precision_param + \
+        compression_param + array_type_param + '<binary>' + encoded_data + '</binary></binaryDataArray>'
+
+
+def close_mzml_file(mzml_file):
+    """Write the closing tags and the number of spectra, and close the file
+
+    Returns:
+        NoneType
+    """
+
+    mzml_file.file.write('</spectrumList>\n</run>\n</mzML>\n')
+
+    mzml_file.file.seek(mzml_file.spectrum_count_position)
+    mzml_file.file.write(str(mzml_file.spectrum_count).zfill(_spectrum_count_width))
+
+    mzml_file.file.close()
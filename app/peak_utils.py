@@ -0,0 +1,180 @@
+"""Methods for reducing the peaks of scans before they are written"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import heapq
+from array import array
+from . import __peak_top_n_env_key__, __peak_top_n_per_window_env_key__, __peak_window_size_env_key__, \
+    __peak_min_relative_intensity_env_key__, __peak_precursor_removal_tolerance_env_key__, \
+    __default_peak_window_size__, spectr_utils
+
+
+class PeakFilterSettings:
+    """How the peaks of each scan are reduced. A setting of None disables that step."""
+
+    __slots__ = ('top_n', 'top_n_per_window', 'window_size', 'min_relative_intensity', 'precursor_removal_tolerance')
+
+    def __init__(self, top_n=None, top_n_per_window=None, window_size=None, min_relative_intensity=None,
+                 precursor_removal_tolerance=None):
+        """Create a PeakFilterSettings object
+
+        Parameters:
+            top_n (int): Keep only this many of the most intense peaks
+            top_n_per_window (int): Keep only this many of the most intense peaks in each m/z window
+            window_size (float): Width of the m/z windows for top_n_per_window
+            min_relative_intensity (float): Remove peaks less intense than this fraction of the most intense peak
+            precursor_removal_tolerance (float): Remove peaks within this many m/z of the precursor m/z
+
+        Returns:
+            Populated PeakFilterSettings object
+        """
+        self.top_n = top_n
+        self.top_n_per_window = top_n_per_window
+        self.window_size = window_size
+        self.min_relative_intensity = min_relative_intensity
+        self.precursor_removal_tolerance = precursor_removal_tolerance
+
+
+def get_peak_filter_settings():
+    """Get the peak reduction settings from the env vars
+
+    Returns:
+        PeakFilterSettings: The settings, or None if no peak reduction is configured
+    """
+
+    settings = PeakFilterSettings(
+        top_n=_get_env_value(__peak_top_n_env_key__, int),
+        top_n_per_window=_get_env_value(__peak_top_n_per_window_env_key__, int),
+        window_size=_get_env_value(__peak_window_size_env_key__, float),
+        min_relative_intensity=_get_env_value(__peak_min_relative_intensity_env_key__, float),
+        precursor_removal_tolerance=_get_env_value(__peak_precursor_removal_tolerance_env_key__, float)
+    )
+
+    if settings.top_n is not None and settings.top_n < 1:
+        raise ValueError('Must keep at least one peak:', __peak_top_n_env_key__)
+
+    if settings.top_n_per_window is not None and settings.top_n_per_window < 1:
+        raise ValueError('Must keep at least one peak per window:', __peak_top_n_per_window_env_key__)
+
+    if settings.window_size is None:
+        settings.window_size = __default_peak_window_size__
+    elif settings.window_size <= 0:
+        raise ValueError('Window size must be positive:', __peak_window_size_env_key__)
+
+    if settings.min_relative_intensity is not None and not 0 <= settings.min_relative_intensity <= 1:
+        raise ValueError('Relative intensity must be between 0 and 1:', __peak_min_relative_intensity_env_key__)
+
+    if settings.top_n is None and settings.top_n_per_window is None and settings.min_relative_intensity is None \
+            and settings.precursor_removal_tolerance is None:
+        return None
+
+    return settings
+
+
+def reduce_peaks_for_scans(ms2_scans, settings, dropped_scan_numbers=None):
+    """Reduce the peaks of each scan according to the settings. The scans are not changed, as they
+    may also be held by the scan cache; new MS2ScanData objects are returned. Scans left with no
+    peaks are dropped, as neither BlibBuild nor the native engine should write empty spectra.
+
+    Parameters:
+        ms2_scans (iterable): MS2ScanData objects
+        settings (PeakFilterSettings): How to reduce the peaks
+        dropped_scan_numbers (set): If given, the scan numbers of dropped scans are added to it
+
+    Returns:
+        list: New MS2ScanData objects with the reduced peaks, in the same order
+    """
+
+    reduced_scans = []
+
+    for ms2_scan in ms2_scans:
+        reduced_scan = reduce_peaks(ms2_scan, settings)
+
+        if len(reduced_scan.peak_list_mz) > 0:
+            reduced_scans.append(reduced_scan)
+        elif dropped_scan_numbers is not None:
+            dropped_scan_numbers.add(ms2_scan.scan_number)
+
+    return reduced_scans
+
+
+def reduce_peaks(ms2_scan, settings):
+    """Reduce the peaks of a scan according to the settings. Steps are applied in this order:
+    precursor removal, relative intensity threshold, top N per m/z window, top N. Kept peaks stay
+    in their original order.
+
+    Parameters:
+        ms2_scan (MS2ScanData): The scan
+        settings (PeakFilterSettings): How to reduce the peaks
+
+    Returns:
+        MS2ScanData: A new scan with the kept peaks, which may have no peaks left
+    """
+
+    # without numpy (not a dependency of this service) there is no vectorized selection over the
+    # array('d') buffers, so each step filters a list of peak indices and the peaks are copied once
+
+    peak_list_mz = ms2_scan.peak_list_mz
+    peak_list_intensity = ms2_scan.peak_list_intensity
+    get_intensity = peak_list_intensity.__getitem__
+
+    indices = range(len(peak_list_mz))
+
+    if settings.precursor_removal_tolerance is not None and ms2_scan.precursor_mz is not None:
+        low_mz = ms2_scan.precursor_mz - settings.precursor_removal_tolerance
+        high_mz = ms2_scan.precursor_mz + settings.precursor_removal_tolerance
+        indices = [index for index in indices if not low_mz <= peak_list_mz[index] <= high_mz]
+
+    if settings.min_relative_intensity is not None and len(indices) > 0:
+        min_intensity = max(map(get_intensity, indices)) * settings.min_relative_intensity
+        indices = [index for index in indices if peak_list_intensity[index] >= min_intensity]
+
+    if settings.top_n_per_window is not None:
+        indices_by_window = {}
+        for index in indices:
+            indices_by_window.setdefault(int(peak_list_mz[index] // settings.window_size), []).append(index)
+
+        indices = []
+        for window_indices in indices_by_window.values():
+            if len(window_indices) > settings.top_n_per_window:
+                window_indices = heapq.nlargest(settings.top_n_per_window, window_indices, key=get_intensity)
+
+            indices.extend(window_indices)
+
+        indices.sort()
+
+    if settings.top_n is not None and len(indices) > settings.top_n:
+        indices = sorted(heapq.nlargest(settings.top_n, indices, key=get_intensity))
+
+    return spectr_utils.MS2ScanData(
+        ms2_scan.scan_file_hash_key,
+        ms2_scan.scan_number,
+        ms2_scan.msn_level,
+        ms2_scan.retention_time_seconds,
+        ms2_scan.precursor_charge,
+        ms2_scan.precursor_mz,
+        array('d', map(get_intensity, indices)),
+        array('d', map(peak_list_mz.__getitem__, indices))
+    )
+
+
+def _get_env_value(env_key, value_type):
+    value = os.getenv(env_key)
+
+    if value is None or value == '':
+        return None
+
+    return value_type(value)
@@ -0,0 +1,232 @@
+"""The queue of requests waiting to be processed, and the policies for choosing which runs next"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import time
+import threading
+from . import __request_scheduler_policy_env_key__, __request_queue_aging_seconds_env_key__, \
+    __default_request_scheduler_policy__, __default_request_queue_aging_seconds__
+
+# relative cost of fetching and writing one distinct scan, and of writing one PSM to the SSL
+scan_cost_weight = 1.0
+psm_cost_weight = 0.05
+
+
+def estimate_request_cost(request_data):
+    """Estimate the relative cost of processing a request from its spectral data, based on the
+    number of distinct scans to fetch for each scan file and the number of PSMs
+
+    Parameters:
+        request_data (list): The spectral_data of the request, a list of dicts, one per scan file
+
+    Returns:
+        float: The estimated cost
+    """
+
+    cost = 0.0
+
+    for spectr_dict in request_data:
+        psms = spectr_dict['psms']
+        distinct_scan_count = len({psm['scan_number'] for psm in psms})
+
+        cost += distinct_scan_count * scan_cost_weight + len(psms) * psm_cost_weight
+
+    return cost
+
+
+def order_fifo(entries, active_by_project, now):
+    """First in, first out"""
+    return sorted(entries, key=lambda entry: entry['seq'])
+
+
+def order_shortest_job_first(entries, active_by_project, now):
+    """Cheapest estimated request first. A request's cost is divided by (1 + wait / aging time)
+    so that expensive requests eventually run even while cheaper ones keep arriving."""
+
+    aging_seconds = _get_aging_seconds()
+
+    def aged_cost(entry):
+        return entry['cost'] / (1 + (now - entry['queued_at']) / aging_seconds)
+
+    return sorted(entries, key=lambda entry: (aged_cost(entry), entry['seq']))
+
+
+def order_fair_share(entries, active_by_project, now):
+    """Round robin between projects, so one project submitting many requests does not hold
+    up the others. Requests being processed count against their project. Within a project,
+    requests run first in, first out."""
+
+    rank_by_project = {}
+    keys = {}
+
+    for entry in order_fifo(entries, active_by_project, now):
+        project_id = entry['project_id']
+        rank = rank_by_project.get(project_id, active_by_project.get(project_id, 0))
+        rank_by_project[project_id] = rank + 1
+
+        keys[entry['seq']] = (rank, entry['seq'])
+
+    return sorted(entries, key=lambda entry: keys[entry['seq']])
+
+
+# the available scheduling policies, each a function (entries, active_by_project, now) => ordered entries
+scheduling_policies = {
+    'fifo': order_fifo,
+    'sjf': order_shortest_job_first,
+    'fair': order_fair_share
+}
+
+
+def get_scheduling_policy():
+    """Get the function for the scheduling policy set by env var. Defaults to 'fifo'.
+
+    Returns:
+        function: The scheduling policy
+    """
+
+    policy_name = os.getenv(__request_scheduler_policy_env_key__, __default_request_scheduler_policy__)
+
+    if policy_name not in scheduling_policies:
+        raise ValueError('Got unknown value for env var:', __request_scheduler_policy_env_key__)
+
+    return scheduling_policies[policy_name]
+
+
+def _get_aging_seconds():
+    aging_seconds = float(os.getenv(__request_queue_aging_seconds_env_key__, __default_request_queue_aging_seconds__))
+
+    if aging_seconds <= 0:
+        raise ValueError('Aging time must be positive:', __request_queue_aging_seconds_env_key__)
+
+    return aging_seconds
+
+
+class RequestQueue:
+    """A queue of requests, each a dict: {'id': request_id, 'data': request data, 'project_id': project id}.
+    The order requests are processed in is decided by the configured scheduling policy. Request
+    processors block in get_next until a request is added, so new requests are picked up
+    immediately without polling."""
+
+    def __init__(self, lock=None):
+        """Create an empty RequestQueue
+
+        Parameters:
+            lock (threading.RLock): The lock guarding the queue, shared with any other state that must
+                                    change together with the queue. A new lock is created if None.
+
+        Returns:
+            Empty RequestQueue object
+        """
+        self._entries = []
+        self._next_seq = 0
+        self._active_by_project = {}
+        self._condition = threading.Condition(lock if lock is not None else threading.RLock())
+
+    def append(self, request):
+        """Add a request to the queue and wake up a waiting request processor
+
+        Parameters:
+            request (dict): {'id': request_id, 'data': request data, 'project_id': project id}
+
+        Returns:
+            NoneType
+        """
+
+        entry = {
+            'request': request,
+            'cost': estimate_request_cost(request['data']),
+            'project_id': request.get('project_id'),
+            'queued_at': time.time()
+        }
+
+        with self._condition:
+            entry['seq'] = self._next_seq
+            self._next_seq += 1
+
+            self._entries.append(entry)
+            self._condition.notify()
+
+    def get_next(self):
+        """Remove and return the next request under the scheduling policy, blocking until one is
+        available. The caller must call task_done with the request once it has been processed.
+
+        Returns:
+            dict: {'id': request_id, 'data': request data, 'project_id': project id}
+        """
+
+        with self._condition:
+            while len(self._entries) < 1:
+                self._condition.wait()
+
+            entry = self._get_ordered_entries()[0]
+            self._remove_entry(entry)
+
+            project_id = entry['project_id']
+            self._active_by_project[project_id] = self._active_by_project.get(project_id, 0) + 1
+
+            return entry['request']
+
+    def task_done(self, request):
+        """Record that a request returned by get_next has been processed
+
+        Parameters:
+            request (dict): The request returned by get_next
+
+        Returns:
+            NoneType
+        """
+
+        with self._condition:
+            project_id = request.get('project_id')
+            self._active_by_project[project_id] -= 1
+
+            if self._active_by_project[project_id] < 1:
+                del self._active_by_project[project_id]
+
+    def remove(self, request_id):
+        """Remove the request with the given id from the queue
+
+        Parameters:
+            request_id (string): The request id
+
+        Returns:
+            bool: True if the request was found and removed
+        """
+
+        with self._condition:
+            for entry in self._entries:
+                if entry['request']['id'] == request_id:
+                    self._remove_entry(entry)
+                    return True
+
+            return False
+
+    def _remove_entry(self, entry):
+        self._entries = [queued_entry for queued_entry in self._entries if queued_entry is not entry]
+
+    def _get_ordered_entries(self):
+        return get_scheduling_policy()(self._entries, self._active_by_project, time.time())
+
+    def __iter__(self):
+        """Iterate over a snapshot of the queued requests, in the order the scheduling policy
+        would currently process them"""
+
+        with self._condition:
+            return iter([entry['request'] for entry in self._get_ordered_entries()])
+
+    def __len__(self):
+        with self._condition:
+            return len(self._entries)
@@ -18,18 +18,57 @@ import os
 import time
 import shutil
 import subprocess
+import heapq
+import threading
 import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from mpire import WorkerPool
-from . import __request_check_delay__, __workdir_env_key__, __blib_dir_env_key__, __spectr_batch_size_env_key__, \
+from . import request_lock, __max_concurrent_requests_env_key__, \
+    __ms2_max_total_threads_env_key__, __workdir_env_key__, __blib_dir_env_key__, __spectr_batch_size_env_key__, \
     __blib_build_executable_path_env_key__, __blib_filter_executable_path_env_key__,\
-    __clean_working_directory_env_key__, __ms2_max_threads_env_key__, ssl_lib, ms2_lib, general_utils, spectr_utils
+    __clean_working_directory_env_key__, __ms2_max_threads_env_key__, __spectr_max_in_flight_env_key__, \
+    __ms2_mz_precision_env_key__, __ms2_intensity_precision_env_key__, \
+    __ms2_write_queue_size_env_key__, __blib_build_engine_env_key__, __default_blib_build_engine__, \
+    __blib_build_score_cutoff_env_key__, __default_blib_build_score_cutoff__, \
+    __psm_preselection_count_env_key__, __intermediate_spectrum_format_env_key__, \
+    __default_intermediate_spectrum_format__, ssl_lib, ms2_lib, mzml_lib, blib_lib, general_utils, spectr_utils, \
+    scan_cache, library_cache, peak_utils, metrics, trace_utils, checkpoint_utils
 
 
 def process_request_queue(request_queue, request_status_dict):
-    """Serially process all requests in the request queue
+    """Process all requests in the request queue, running up to the configured number of
+    requests at the same time. Never returns.
 
     Parameters:
-        request_queue (list): The request queue, a list of dicts: {'id': request_id, 'data': xml_request}
+        request_queue (RequestQueue): The request queue of dicts: {'id': request_id, 'data': xml_request}
+        request_status_dict (dict): The dict that stores the status of requests
+
+    Returns:
+        None
+    """
+
+    threads = []
+
+    for i in range(get_max_concurrent_requests()):
+        thread = threading.Thread(
+            target=_process_requests_from_queue,
+            args=(request_queue, request_status_dict),
+            name='request-processor-' + str(i + 1)
+        )
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+
+def _process_requests_from_queue(request_queue, request_status_dict):
+    """Serially process requests taken from the request queue, waiting for new requests whenever
+    the queue is empty. Run by each request processing thread.
+
+    Parameters:
+        request_queue (RequestQueue): The request queue of dicts: {'id': request_id, 'data': xml_request}
         request_status_dict (dict): The dict that stores the status of requests
 
     Returns:
@@ -37,145 +76,647 @@ def process_request_queue(request_queue, request_status_dict):
     """
 
     while True:
-        while len(request_queue) > 0:
-            request = request_queue.pop(0)
+        request = request_queue.get_next()
+        process_request(request, request_status_dict, request_queue)
+
+
+def update_request_status(request_status_dict, request_id, **status_values):
+    """Update the status entry for the given request, holding the request lock so that concurrent
+    request processors and web requests see consistent values. The entry is assigned again, so the
+    change is also stored when the status dict is kept in the request store.
+
+    Parameters:
+        request_status_dict (dict): The dict that stores the status of requests
+        request_id (string): The request id
+        status_values: The keys and values to set, e.g. status='error', message='Failed'
 
-            process_request(request, request_status_dict)
+    Returns:
+        NoneType
+    """
 
-        time.sleep(__request_check_delay__)
+    with request_lock:
+        request_status_dict[request_id] = dict(request_status_dict[request_id], **status_values)
 
 
-def process_request(request, request_status_dict):
+def process_request(request, request_status_dict, request_queue=None):
     """Process the given request. Should not ever raise an exception. Will update the
-    request status dict appropriately.
+    request status dict appropriately. The final status of the request is published only
+    once its working directory has been cleaned and, if request_queue is given, task_done
+    has been called for it, so an identical request submitted after it failed can queue it
+    again (see web_service_utils.submit_conversion_request) without racing this attempt.
 
     Parameters:
         request (dict): A dict: {'id': request_id, 'data': xml_request}
         request_status_dict (dict): The dict that stores the status of requests
+        request_queue (RequestQueue): The queue the request was taken from with get_next, or None
 
     Returns:
         None
     """
 
     workdir = None
+    start_time = time.perf_counter()
+    trace = trace_utils.RequestTrace()
+    trace_start_time = time.time()
 
     try:
 
-        request_status_dict[request['id']]['status'] = 'processing'
-        request_status_dict[request['id']]['end_user_message'] = 'Exporting SSL and gathering scans.'
+        update_request_status(
+            request_status_dict,
+            request['id'],
+            status='processing',
+            end_user_message='Exporting SSL and gathering scans.'
+        )
 
+        step_start_time = time.time()
         final_blib_filename = request['id'] + '.blib'
         verify_blib_destination(final_blib_filename)
         workdir = get_workdir(request)
+        checkpoint = checkpoint_utils.RequestCheckpoint(workdir)
+        trace.add_span('workdir setup', 'stage', step_start_time)
 
-        ssl_file_name = 'export.ssl'
-        ssl_file = ssl_lib.initialize_ssl_file(workdir, ssl_file_name)
+        # only the scans of PSMs that may be chosen by BlibFilter are fetched
+        request_data = preselect_psms(request['data'], get_psm_preselection_count())
+        redundant_blib_filename = request['id'] + '.redundant.blib'
+        scan_file_keys = get_scan_file_keys(request_data)
+
+        if checkpoint.is_stage_done('redundant blib', scan_file_keys) and \
+                os.path.exists(os.path.join(workdir, redundant_blib_filename)):
+            # built by an earlier attempt at this request
+            pass
+        elif library_cache.is_library_cache_enabled():
+            build_redundant_blib_from_scan_file_libraries(
+                request,
+                request_data,
+                redundant_blib_filename,
+                workdir,
+                request_status_dict,
+                trace,
+                checkpoint,
+                scan_file_keys
+            )
+        elif get_blib_build_engine() == 'native':
+            step_start_time = time.time()
+            library_file_entries = list(zip(request_data, range(1, len(request_data) + 1)))
+            result_dicts = process_scan_files(
+                request,
+                create_redundant_blib_file,
+                library_file_entries,
+                workdir,
+                request_status_dict,
+                trace,
+                checkpoint,
+                scan_file_keys
+            )
+            trace.add_span('scan files', 'stage', step_start_time)
+
+            # merge the per scan file libraries, in request order
+            update_request_status(request_status_dict, request['id'], end_user_message='Generating redundant blib file')
+            step_start_time = time.time()
+            merge_redundant_blib_files(
+                [result_dicts[spectr_dict['spectr_file_id']]['blib_file_name'] for spectr_dict in request_data],
+                redundant_blib_filename,
+                workdir
+            )
+            trace.add_span('blib build', 'stage', step_start_time)
+        else:
+            ssl_file_name = 'export.ssl'
+
+            step_start_time = time.time()
+            ms2_file_entries = list(zip(request_data, range(1, len(request_data) + 1)))
+            result_dicts = process_scan_files(
+                request,
+                create_ms2_file,
+                ms2_file_entries,
+                workdir,
+                request_status_dict,
+                trace,
+                checkpoint,
+                scan_file_keys
+            )
+            trace.add_span('scan files', 'stage', step_start_time)
+
+            # combine the .ssl files written for each scan file, in request order
+            if not checkpoint.is_stage_done('ssl', scan_file_keys) or \
+                    not os.path.exists(os.path.join(workdir, ssl_file_name)):
+                step_start_time = time.time()
+                ssl_lib.concatenate_ssl_files(
+                    workdir,
+                    ssl_file_name,
+                    [result_dicts[spectr_dict['spectr_file_id']]['ssl_file_name'] for spectr_dict in request_data]
+                )
+                checkpoint.record_stage_done('ssl', scan_file_keys)
+                trace.add_span('ssl', 'stage', step_start_time)
 
-        request_data = request['data']
+            # create redundant blib
+            update_request_status(request_status_dict, request['id'], end_user_message='Generating redundant blib file')
+            step_start_time = time.time()
+            execute_blib_build_conversion(
+                redundant_blib_filename,
+                ssl_file_name,
+                workdir
+            )
+            trace.add_span('blib build', 'stage', step_start_time)
 
-        percent_per_file = 100 / len(request_data)
-        percent_done = 0
-        request_status_dict[request['id']]['end_user_message'] = 'Exporting scan files: 0% complete...'
+        checkpoint.record_stage_done('redundant blib', scan_file_keys)
 
-        # hold the data returned from processing each ms2
-        result_dicts = {}
+        # filter redundant blib into final blib
+        update_request_status(request_status_dict, request['id'], end_user_message='Generating filtered blib file')
+        step_start_time = time.time()
+        execute_blib_filter(
+            redundant_blib_filename,
+            final_blib_filename,
+            workdir
+        )
+        metrics.observe_histogram('blib_export_blib_filter_seconds', time.time() - step_start_time)
+        trace.add_span('blib filter', 'stage', step_start_time)
 
-        max_threads = get_ms2_max_threads()
+        # move to final location
+        update_request_status(request_status_dict, request['id'], end_user_message='Moving .blib to final location')
+        blib_destination_path = os.getenv(__blib_dir_env_key__)
+        step_start_time = time.time()
+        move_blib_to_final_destination(
+            workdir,
+            request_status_dict[request['id']]['project_id'],
+            final_blib_filename
+        )
+        metrics.observe_histogram('blib_export_move_seconds', time.time() - step_start_time)
+        trace.add_span('move', 'stage', step_start_time)
+
+        outcome = 'success'
+        final_status_values = {'status': 'success', 'message': request['id'] + '.blib', 'completed_at': time.time()}
+
+    except Exception as e:
+        outcome = 'error'
+        final_status_values = {'status': 'error', 'message': str(e)}
+
+        # print stack trace
+        traceback.print_exc()
 
-        # create each ms2 file using a multiprocessing workerpool
+    try:
+        _record_request_outcome(outcome, start_time)
+        _record_request_trace(request['id'], request_status_dict, trace, trace_start_time)
+
+        clean_workdir(workdir, success=outcome == 'success')
+
+    finally:
+        try:
+            if request_queue is not None:
+                request_queue.task_done(request)
+        finally:
+            update_request_status(request_status_dict, request['id'], **final_status_values)
+
+
+def _record_request_outcome(outcome, start_time):
+    metrics.increment_counter('blib_export_requests_total', labels={'outcome': outcome})
+    metrics.observe_histogram('blib_export_request_seconds', time.perf_counter() - start_time,
+                              labels={'outcome': outcome})
+
+
+def _record_request_trace(request_id, request_status_dict, trace, trace_start_time):
+    """Add the summary of the trace of a finished request to its status, and write the trace file if
+    configured. A trace that can't be written must not fail the request, so errors are only printed.
+
+    Returns:
+        NoneType
+    """
+
+    trace.add_span('request', 'request', trace_start_time, {'request_id': request_id})
+    update_request_status(request_status_dict, request_id, trace_summary=trace_utils.summarize_trace(trace))
+
+    if trace_utils.is_trace_file_enabled():
+        try:
+            trace_utils.write_trace_file(request_id, trace)
+        except Exception:
+            traceback.print_exc()
+
+
+def process_scan_files(request, scan_file_function, file_entries, workdir, request_status_dict, trace, checkpoint,
+                       scan_file_keys):
+    """Run scan_file_function for each of the given scan files, using a multiprocessing workerpool
+    if configured. Updates the end user message of the request as files are completed. Scan files
+    completed by an earlier attempt at the request are skipped, and each completed file is recorded
+    in the checkpoint.
+
+    Parameters:
+        request (dict): A dict: {'id': request_id, 'data': xml_request}
+        scan_file_function (function): create_ms2_file or create_redundant_blib_file
+        file_entries (list): A list of tuples: (spectr_dict, file_id), see create_ms2_file
+        workdir (string): Full path to the working directory
+        request_status_dict (dict): The dict that stores the status of requests
+        trace (trace_utils.RequestTrace): The trace of the request, spans for each scan file are added to it
+        checkpoint (checkpoint_utils.RequestCheckpoint): The checkpoint of the request
+        scan_file_keys (list): The keys of all scan files of the request, see get_scan_file_keys
+
+    Returns:
+        dict: spectr file id => the dict returned by scan_file_function for that file
+    """
+
+    # hold the data returned from processing each ms2
+    result_dicts = {}
+    remaining_file_entries = []
+
+    for spectr_dict, file_id in file_entries:
+        result_dict = checkpoint.get_scan_file_result(scan_file_keys[file_id - 1])
+
+        if result_dict is None:
+            remaining_file_entries.append((spectr_dict, file_id))
+        else:
+            result_dicts[result_dict['spectr_file_id']] = result_dict
+
+    file_entries = remaining_file_entries
+    if len(file_entries) < 1:
+        return result_dicts
+
+    percent_per_file = 100 / len(file_entries)
+    percent_done = 0
+    update_request_status(
+        request_status_dict,
+        request['id'],
+        end_user_message='Exporting scan files: 0% complete...'
+    )
+
+    # take as many ms2 workers as are free, up to our own limit, so concurrent requests
+    # never use more than the global limit between them
+    max_threads = ms2_worker_budget.acquire(min(get_ms2_max_threads(), len(file_entries)))
+
+    try:
+        # process each scan file using a multiprocessing workerpool
         if max_threads > 1:
+            file_ids = {spectr_dict['spectr_file_id']: file_id for spectr_dict, file_id in file_entries}
+
             with WorkerPool(n_jobs=max_threads, pass_worker_id=False) as pool:
-                for result_dict in pool.imap_unordered(create_ms2_file, zip(request_data, range(1, len(request_data) + 1), [workdir] * len(request_data)), iterable_len=len(request_data), progress_bar=False):
+                for result_dict, worker_metrics, worker_trace_events in pool.imap_unordered(
+                        _run_scan_file_function_in_worker,
+                        [(scan_file_function, spectr_dict, file_id, workdir) for spectr_dict, file_id in file_entries],
+                        iterable_len=len(file_entries),
+                        progress_bar=False
+                ):
+                    # metrics and spans recorded in worker processes are only seen here
+                    metrics.merge_snapshot(worker_metrics)
+                    trace.add_events(worker_trace_events)
+
                     percent_done += percent_per_file
-                    request_status_dict[request['id']]['end_user_message'] = 'Exporting scan files: ' +\
-                                                                             str(round(percent_done, 1)) +\
-                                                                             '% complete...'
+                    update_request_status(
+                        request_status_dict,
+                        request['id'],
+                        end_user_message='Exporting scan files: ' + str(round(percent_done, 1)) + '% complete...'
+                    )
 
                     result_dicts[result_dict['spectr_file_id']] = result_dict
+                    checkpoint.record_scan_file_result(
+                        scan_file_keys[file_ids[result_dict['spectr_file_id']] - 1],
+                        result_dict
+                    )
         else:
-            counter = 1
-            for spectr_dict in request_data:
-                request_status_dict[request['id']]['end_user_message'] = 'Exporting scan files: ' + \
-                                                                         str(round(percent_done, 1)) + \
-                                                                         '% complete...'
-                result_dict = create_ms2_file(spectr_dict, counter, workdir)
+            for spectr_dict, file_id in file_entries:
+                update_request_status(
+                    request_status_dict,
+                    request['id'],
+                    end_user_message='Exporting scan files: ' + str(round(percent_done, 1)) + '% complete...'
+                )
+                result_dict = scan_file_function(spectr_dict, file_id, workdir, trace)
                 result_dicts[result_dict['spectr_file_id']] = result_dict
+                checkpoint.record_scan_file_result(scan_file_keys[file_id - 1], result_dict)
 
                 percent_done += percent_per_file
-                counter += 1
 
-        for spectr_dict in request_data:
-            spectr_file_id = spectr_dict['spectr_file_id']
-            ms2_file_name = result_dicts[spectr_file_id]['ms2_file_name']
-            retention_time_dict = result_dicts[spectr_file_id]['retention_times']
+    finally:
+        ms2_worker_budget.release(max_threads)
 
-            # write out lines to ssl file
-            for psm in spectr_dict['psms']:
-                scan_number = psm['scan_number']
-                charge = psm['charge']
-                retention_time_minutes = retention_time_dict[scan_number] / 60
+    return result_dicts
 
-                if 'modifications' not in psm:
-                    psm['modifications'] = {}
 
-                peptide_sequence = general_utils.build_peptide_string_with_mods(
-                    psm['peptide_sequence'],
-                    psm['modifications']
-                )
+def _run_scan_file_function_in_worker(scan_file_function, spectr_dict, file_id, workdir):
+    """Run scan_file_function in a worker process, returning its result and the metrics and spans it recorded
 
-                ssl_lib.write_psm_to_ssl_file(
-                    ssl_file,
-                    ms2_file_name,
-                    scan_number,
-                    charge,
-                    peptide_sequence,
-                    retention_time_minutes
-                )
+    Returns:
+        tuple: (the dict returned by scan_file_function, metrics recorded while it ran, its trace events)
+    """
+
+    metrics_before = metrics.get_snapshot()
+    trace = trace_utils.RequestTrace()
+    result_dict = scan_file_function(spectr_dict, file_id, workdir, trace)
+
+    return result_dict, metrics.get_snapshot_difference(metrics_before, metrics.get_snapshot()), trace.get_events()
+
+
+def write_ssl_file(workdir, ssl_file_name, spectrum_file_name, spectr_dict, retention_time_dict):
+    """Write the .ssl file listing the PSMs of a single scan file
+
+    Parameters:
+        workdir (string): Full path to the working directory
+        ssl_file_name (string): The filename of the .ssl file to write
+        spectrum_file_name (string): The filename of the .ms2 or .mzML file holding the scans of the PSMs
+        spectr_dict (dict): The part of the conversion request for the scan file
+        retention_time_dict (dict): scan number => retention time in seconds, for each scan of the PSMs
+
+    Returns:
+        NoneType
+    """
+
+    ssl_file = ssl_lib.initialize_ssl_file(workdir, ssl_file_name)
 
-            # done iterating over PSMs in this scan file
+    try:
+        score_type = spectr_dict.get('score_type', blib_lib.default_score_type)
+
+        # write out lines to ssl file
+        for psm in spectr_dict['psms']:
+            scan_number = psm['scan_number']
+            charge = psm['charge']
+            retention_time_minutes = retention_time_dict[scan_number] / 60
+
+            peptide_sequence = general_utils.build_peptide_string_with_mods(
+                psm['peptide_sequence'],
+                psm.get('modifications')
+            )
+
+            ssl_lib.write_psm_to_ssl_file(
+                ssl_file,
+                spectrum_file_name,
+                scan_number,
+                charge,
+                peptide_sequence,
+                retention_time_minutes,
+                score_type,
+                psm.get('score', 0.0)
+            )
 
-        # done iterating over scan files
+    finally:
         ssl_lib.close_ssl_file(ssl_file)
 
-        # create redundant blib
-        request_status_dict[request['id']]['end_user_message'] = 'Generating redundant blib file'
-        redundant_blib_filename = request['id'] + '.redundant.blib'
-        execute_blib_build_conversion(
-            redundant_blib_filename,
-            ssl_file_name,
-            workdir
-        )
 
-        # filter redundant blib into final blib
-        request_status_dict[request['id']]['end_user_message'] = 'Generating filtered blib file'
-        execute_blib_filter(
-            redundant_blib_filename,
-            final_blib_filename,
-            workdir
-        )
+def build_redundant_blib_from_scan_file_libraries(request, request_data, redundant_blib_filename, workdir,
+                                                  request_status_dict, trace, checkpoint, scan_file_keys):
+    """Build the redundant library for the request by merging one redundant library per scan file.
+    Libraries for scan files with the same PSMs as an earlier request are taken from the library
+    cache; the others are built with the configured engine and added to the cache.
 
-        # move to final location
-        request_status_dict[request['id']]['end_user_message'] = 'Moving .blib to final location'
-        blib_destination_path = os.getenv(__blib_dir_env_key__)
-        move_blib_to_final_destination(
-            workdir,
-            request_status_dict[request['id']]['project_id'],
-            final_blib_filename
-        )
+    Parameters:
+        request (dict): A dict: {'id': request_id, 'data': xml_request}
+        request_data (list): The parts of the conversion request for each scan file, after preselect_psms
+        redundant_blib_filename (string): The filename of the redundant blib to create
+        workdir (string): Full path to the working directory
+        request_status_dict (dict): The dict that stores the status of requests
+        trace (trace_utils.RequestTrace): The trace of the request
+        checkpoint (checkpoint_utils.RequestCheckpoint): The checkpoint of the request
+        scan_file_keys (list): The keys of all scan files of the request, see get_scan_file_keys
 
-        request_status_dict[request['id']]['status'] = 'success'
-        request_status_dict[request['id']]['message'] = request['id'] + '.blib'
+    Returns:
+        NoneType
+    """
 
-        clean_workdir(workdir, success=True)
+    blib_build_engine = get_blib_build_engine()
+    build_options = get_build_options()
 
-    except Exception as e:
-        request_status_dict[request['id']]['status'] = 'error'
-        request_status_dict[request['id']]['message'] = str(e)
+    library_filenames = []
+    libraries_to_build = []
 
-        # print stack trace
-        traceback.print_exc()
+    for file_number, spectr_dict in enumerate(request_data, start=1):
+        library_filename = str(file_number) + '.redundant.blib'
+        library_key = library_cache.get_scan_file_library_key(spectr_dict, build_options)
 
-        clean_workdir(workdir, success=False)
+        # may be a link to the cached library itself, left by an earlier attempt at the request
+        remove_stale_file(workdir, library_filename)
+
+        if not library_cache.retrieve_cached_library(library_key, os.path.join(workdir, library_filename)):
+            libraries_to_build.append((spectr_dict, file_number, library_filename, library_key))
+
+        library_filenames.append(library_filename)
+
+    if len(libraries_to_build) > 0:
+        file_entries = [(library_to_build[0], library_to_build[1]) for library_to_build in libraries_to_build]
+
+        step_start_time = time.time()
+        if blib_build_engine == 'native':
+            process_scan_files(request, create_redundant_blib_file, file_entries, workdir, request_status_dict, trace,
+                               checkpoint, scan_file_keys)
+        else:
+            result_dicts = process_scan_files(request, create_ms2_file, file_entries, workdir, request_status_dict,
+                                              trace, checkpoint, scan_file_keys)
+        trace.add_span('scan files', 'stage', step_start_time)
+
+        for build_count, (spectr_dict, file_number, library_filename, library_key) in enumerate(libraries_to_build):
+            if blib_build_engine != 'native':
+                update_request_status(
+                    request_status_dict,
+                    request['id'],
+                    end_user_message='Generating redundant blib file for scan file ' + str(build_count + 1) +
+                                     ' of ' + str(len(libraries_to_build))
+                )
+
+                step_start_time = time.time()
+                ssl_file_name = result_dicts[spectr_dict['spectr_file_id']]['ssl_file_name']
+                execute_blib_build_conversion(library_filename, ssl_file_name, workdir)
+                trace.add_span('blib build', 'stage', step_start_time)
+
+            library_cache.add_library_to_cache(library_key, os.path.join(workdir, library_filename))
+
+    # merge the per scan file libraries
+    update_request_status(request_status_dict, request['id'], end_user_message='Generating redundant blib file')
+    step_start_time = time.time()
+    merge_redundant_blib_files(library_filenames, redundant_blib_filename, workdir)
+    trace.add_span('blib build', 'stage', step_start_time)
+
+
+def get_build_options():
+    """Get the settings that change the spectrum files or libraries written for each scan file
+
+    Returns:
+        list: The settings, for use in the keys of the library cache and of request checkpoints
+    """
+
+    blib_build_engine = get_blib_build_engine()
+
+    # anything that changes the contents of the spectrum files changes the library
+    if blib_build_engine == 'native':
+        build_options = [blib_build_engine]
+    elif get_intermediate_spectrum_format() == 'ms2':
+        build_options = [get_ms2_precision(__ms2_mz_precision_env_key__),
+                         get_ms2_precision(__ms2_intensity_precision_env_key__)]
+    else:
+        build_options = [get_intermediate_spectrum_format()]
+
+    # as does the score cutoff, and reducing the peaks
+    build_options.append(get_blib_build_score_cutoff())
+
+    peak_filter_settings = peak_utils.get_peak_filter_settings()
+    if peak_filter_settings is not None:
+        build_options.append([getattr(peak_filter_settings, name) for name in peak_utils.PeakFilterSettings.__slots__])
+
+    return build_options
+
+
+def get_scan_file_keys(request_data):
+    """Get the checkpoint keys of the scan files of a request, see checkpoint_utils.get_scan_file_key
+
+    Parameters:
+        request_data (list): The parts of the conversion request for each scan file, after preselect_psms
+
+    Returns:
+        list: The keys, in request order (the scan file with file id 1 first)
+    """
+
+    build_options = get_build_options()
+
+    return [
+        checkpoint_utils.get_scan_file_key(spectr_dict, file_id, build_options)
+        for file_id, spectr_dict in enumerate(request_data, start=1)
+    ]
+
+
+def merge_redundant_blib_files(library_filenames, redundant_blib_filename, workdir):
+    """Merge the given per scan file redundant libraries into the redundant library for the request,
+    with BlibBuild or natively depending on the configured engine
+
+    Parameters:
+        library_filenames (list): The filenames of the libraries to merge
+        redundant_blib_filename (string): The filename of the redundant blib to create
+        workdir (string): Full path to the working directory
+
+    Returns:
+        NoneType
+    """
+
+    if len(library_filenames) == 1:
+        os.rename(os.path.join(workdir, library_filenames[0]), os.path.join(workdir, redundant_blib_filename))
+    elif get_blib_build_engine() == 'native':
+        remove_stale_file(workdir, redundant_blib_filename)
+        start_time = time.perf_counter()
+        blib_lib.merge_blib_files(workdir, redundant_blib_filename, library_filenames)
+        metrics.observe_histogram('blib_export_blib_build_seconds', time.perf_counter() - start_time,
+                                  labels={'engine': 'native'})
+    else:
+        execute_blib_build_merge(library_filenames, redundant_blib_filename, workdir)
+
+
+def get_blib_build_engine():
+    """Get how redundant libraries are built, 'blibbuild' or 'native'. Defaults to 'blibbuild' if no
+    env var is set
+
+    Returns:
+        string: the engine
+    """
+
+    blib_build_engine = os.getenv(__blib_build_engine_env_key__, __default_blib_build_engine__)
+
+    if blib_build_engine not in ('blibbuild', 'native'):
+        raise ValueError('Got unknown value for env var:', __blib_build_engine_env_key__)
+
+    return blib_build_engine
+
+
+def get_blib_build_score_cutoff():
+    """Get the score cutoff PSMs must pass to be added to the redundant library, see
+    blib_lib.passes_score_cutoff. Defaults to 0 if no env var is set
+
+    Returns:
+        float: the cutoff, between 0 and 1
+    """
+
+    score_cutoff = float(os.getenv(__blib_build_score_cutoff_env_key__, __default_blib_build_score_cutoff__))
+
+    if score_cutoff < 0 or score_cutoff > 1:
+        raise ValueError('Got value outside of 0 to 1 for env var:', __blib_build_score_cutoff_env_key__)
+
+    return score_cutoff
+
+
+def get_max_concurrent_requests():
+    """Get the number of requests to process at the same time. Defaults to 1 if no env var is set
+
+    Returns:
+        int: the number of requests to process at the same time
+    """
+
+    max_concurrent_requests = os.getenv(__max_concurrent_requests_env_key__)
+
+    if max_concurrent_requests is None:
+        max_concurrent_requests = 1
+    else:
+        max_concurrent_requests = int(max_concurrent_requests)
+
+    if max_concurrent_requests < 1:
+        raise ValueError('Must process at least one request at a time:', __max_concurrent_requests_env_key__)
+
+    return max_concurrent_requests
+
+
+def get_ms2_max_total_threads():
+    """Get the total number of threads to use to build ms2 files across all requests being
+    processed. Defaults to the per-request limit if no env var is set
+
+    Returns:
+        int: the total number of threads to use
+    """
+
+    max_total_threads = os.getenv(__ms2_max_total_threads_env_key__)
+
+    if max_total_threads is None:
+        max_total_threads = get_ms2_max_threads()
+    else:
+        max_total_threads = int(max_total_threads)
+
+    return max(max_total_threads, 1)
+
+
+class MS2WorkerBudget:
+    """Hands out ms2 worker slots to requests being processed concurrently, so that the total
+    number of ms2 workers never goes over a global limit"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._in_use = 0
+
+    def acquire(self, max_count):
+        """Block until at least one worker slot is free, then take as many free slots as possible,
+        up to max_count
+
+        Parameters:
+            max_count (int): The most slots the caller can use
+
+        Returns:
+            int: The number of slots taken, always at least 1
+        """
+
+        with self._condition:
+            total = get_ms2_max_total_threads()
+
+            while self._in_use >= total:
+                self._condition.wait()
+
+            count = max(1, min(max_count, total - self._in_use))
+            self._in_use += count
+
+            return count
+
+    def get_in_use(self):
+        """Get the number of worker slots currently taken
+
+        Returns:
+            int
+        """
+
+        with self._condition:
+            return self._in_use
+
+    def release(self, count):
+        """Return slots taken with acquire
+
+        Parameters:
+            count (int): The number of slots to return
+
+        Returns:
+            NoneType
+        """
+
+        with self._condition:
+            self._in_use -= count
+            self._condition.notify_all()
+
+
+# shared by all request processing threads
+ms2_worker_budget = MS2WorkerBudget()
 
 
 def get_ms2_max_threads():
@@ -195,6 +736,154 @@ def get_ms2_max_threads():
     return max_threads
 
 
+def get_ms2_precision(env_key):
+    """Get the number of decimal places to write for a peak value in .ms2 files. Defaults to None
+    (full precision) if the env var is not set
+
+    Parameters:
+        env_key (string): The env var holding the precision
+
+    Returns:
+        int: the number of decimal places, or None
+    """
+
+    precision = os.getenv(env_key)
+
+    if precision is None:
+        return None
+
+    precision = int(precision)
+    if precision < 0:
+        raise ValueError('Precision must not be negative:', env_key)
+
+    return precision
+
+
+def get_ms2_write_queue_size():
+    """Get the number of parsed batches of scans that may wait to be written to a .ms2 file. Defaults
+    to 0 (fetching and writing are not overlapped) if no env var is set
+
+    Returns:
+        int: the maximum number of batches waiting to be written
+    """
+
+    write_queue_size = os.getenv(__ms2_write_queue_size_env_key__)
+
+    if write_queue_size is None:
+        write_queue_size = 0
+    else:
+        write_queue_size = int(write_queue_size)
+
+    return write_queue_size
+
+
+def get_spectr_max_in_flight():
+    """Get the number of spectr batches to request at the same time for each scan file. Defaults to 1
+    (batches are requested one after another) if no env var is set
+
+    Returns:
+        int: the number of batches to have in flight at a time
+    """
+
+    max_in_flight = os.getenv(__spectr_max_in_flight_env_key__)
+
+    if max_in_flight is None:
+        max_in_flight = 1
+    else:
+        max_in_flight = int(max_in_flight)
+
+    return max_in_flight
+
+
+def get_psm_preselection_count():
+    """Get the number of PSMs to keep for each modified peptide and charge. Defaults to 0 (keep all
+    PSMs) if no env var is set
+
+    Returns:
+        int: the number of PSMs to keep, or 0 to keep all
+    """
+
+    preselection_count = os.getenv(__psm_preselection_count_env_key__)
+
+    if preselection_count is None:
+        preselection_count = 0
+    else:
+        preselection_count = int(preselection_count)
+
+    if preselection_count < 0:
+        raise ValueError('PSM preselection count must not be negative:', __psm_preselection_count_env_key__)
+
+    return preselection_count
+
+
+def preselect_psms(request_data, max_psms_per_peptide):
+    """Keep only the best scoring PSMs for each modified peptide and charge, as BlibFilter keeps only
+    one spectrum for each. PSMs of scan files with a score type are grouped across scan files sharing
+    that score type; PSMs without a score type are all kept. Peptides are grouped the way BlibFilter
+    groups them, by the modified sequence stored in the library. The request data is not changed.
+
+    Parameters:
+        request_data (list): The parts of the conversion request for each scan file
+        max_psms_per_peptide (int): The number of PSMs to keep for each modified peptide and charge,
+                                    0 to keep all PSMs
+
+    Returns:
+        list: The parts of the conversion request for each scan file, with only the kept PSMs
+    """
+
+    if max_psms_per_peptide < 1:
+        return request_data
+
+    # (score type, modified sequence, charge) => list of (score, scan file index, psm index)
+    psm_groups = {}
+
+    for spectr_index, spectr_dict in enumerate(request_data):
+        score_type = spectr_dict.get('score_type')
+        if score_type is None:
+            continue
+
+        for psm_index, psm in enumerate(spectr_dict['psms']):
+            if 'score' not in psm:
+                raise ValueError('PSM is missing a score for score type:', score_type)
+
+            modified_sequence = blib_lib.build_blib_modified_sequence(
+                psm['peptide_sequence'],
+                blib_lib.get_localized_modifications(psm['peptide_sequence'], psm.get('modifications'))
+            )
+            psm_groups.setdefault((score_type, modified_sequence, psm['charge']), []).append(
+                (psm['score'], spectr_index, psm_index)
+            )
+
+    kept_psms = set()
+
+    for (score_type, modified_sequence, charge), scored_psms in psm_groups.items():
+        # sorted is stable, so ties keep request order
+        if blib_lib.is_lower_score_better(score_type):
+            scored_psms = sorted(scored_psms, key=lambda scored_psm: scored_psm[0])
+        else:
+            scored_psms = sorted(scored_psms, key=lambda scored_psm: -scored_psm[0])
+
+        kept_psms.update((spectr_index, psm_index) for score, spectr_index, psm_index in
+                         scored_psms[:max_psms_per_peptide])
+
+    preselected_data = []
+
+    for spectr_index, spectr_dict in enumerate(request_data):
+        if spectr_dict.get('score_type') is None:
+            preselected_data.append(spectr_dict)
+            continue
+
+        preselected_dict = dict(spectr_dict)
+        preselected_dict['psms'] = [psm for psm_index, psm in enumerate(spectr_dict['psms'])
+                                    if (spectr_index, psm_index) in kept_psms]
+
+        # a scan file may be left without PSMs if better ones were found in other scan files
+        if len(preselected_dict['psms']) > 0:
+            preselected_data.append(preselected_dict)
+
+    return preselected_data
+
+
 def get_distinct_scans_from_request_data(request_data_spectr_chunk):
     """Get sorted list of all distinct scan numbers in the given spectr chunk of the request data
 
@@ -238,6 +927,8 @@ def execute_blib_filter(redundant_blib_filename, final_blib_filename, workdir):
     if not blib_filter_executable.endswith('BlibFilter'):
         raise ValueError('Blib filter executable must have the name BlibFilter.')
 
+    remove_stale_file(workdir, final_blib_filename)
+
     result = subprocess.run(
         [blib_filter_executable, redundant_blib_filename, final_blib_filename],
         cwd=workdir,
@@ -265,6 +956,31 @@ def execute_blib_build_conversion(library_name, ssl_file_name, workdir):
         NoneType
     """
 
+    _execute_blib_build([ssl_file_name], library_name, workdir)
+
+
+def execute_blib_build_merge(input_library_names, library_name, workdir):
+    """Merge the given .blib spectral libraries into a single .blib spectral library
+
+    Parameters:
+        input_library_names (list): The filenames of the .blib files to merge
+        library_name (string): The file name of the merged .blib file
+        workdir (string): Full path to where the .blib files are located
+
+    Returns:
+        NoneType
+    """
+
+    _execute_blib_build(input_library_names, library_name, workdir)
+
+
+def _execute_blib_build(input_file_names, library_name, workdir):
+    """Run BlibBuild on the given input files (.ssl or .blib) to produce library_name
+
+    Returns:
+        NoneType
+    """
+
     blib_executable = os.getenv(__blib_build_executable_path_env_key__)
     if not os.path.exists(blib_executable):
         raise ValueError('Could not find BlibOut executable:', blib_executable)
@@ -272,12 +988,19 @@ def execute_blib_build_conversion(library_name, ssl_file_name, workdir):
     if not blib_executable.endswith('BlibBuild'):
         raise ValueError('Blib executable must have the name BlibBuild.')
 
+    # BlibBuild adds to an existing library
+    remove_stale_file(workdir, library_name)
+
+    # always pass the cutoff, BlibBuild's own default drops PSMs with probability scores below 0.99
+    start_time = time.perf_counter()
     result = subprocess.run(
-        [blib_executable, '-H', '-K', ssl_file_name, library_name],
+        [blib_executable, '-H', '-K', '-c', str(get_blib_build_score_cutoff())] + input_file_names + [library_name],
         cwd=workdir,
         capture_output=True,
         text=True
     )
+    metrics.observe_histogram('blib_export_blib_build_seconds', time.perf_counter() - start_time,
+                              labels={'engine': 'blibbuild'})
     print(result.stdout)
     print(result.stderr)
 
@@ -325,6 +1048,24 @@ def move_blib_to_final_destination(workdir, project_id, blib_file_name):
     verify_file_exists(os.path.join(workdir, os.path.join(blib_destination_dir, blib_file_name)))
 
 
+def remove_stale_file(workdir, file_name):
+    """Remove a file left in the working directory by an earlier, unfinished attempt at the request,
+    if there is one
+
+    Parameters:
+        workdir (string): Full path to the working directory
+        file_name (string): The filename of the file about to be written
+
+    Returns:
+        NoneType
+    """
+
+    file_path = os.path.join(workdir, file_name)
+
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+
 def verify_file_exists(file_path):
     """Verify the file at the given path exists, raise exception if not
 
@@ -339,63 +1080,511 @@ def verify_file_exists(file_path):
         raise ValueError('Expected file not found:', file_path)
 
 
-def create_ms2_file(spectr_dict, ms2_file_id, workdir):
-    """Create a MS2 file from a spectr file id for the given scans
+def create_ms2_file(spectr_dict, ms2_file_id, workdir, trace=None):
+    """Create a spectrum file (.ms2, or .mzML if configured) from a spectr file id for the given scans,
+    and the .ssl file listing the PSMs of the scan file
 
     Parameters:
         spectr_dict (dict): The part of the conversion request for a single spectr file id
-        ms2_file_id (int): The base of the filename to use for the ms2 file (e.g., 1 = '1.ms2'
+        ms2_file_id (int): The base of the filename to use for the spectrum and ssl files (e.g., 1 = '1.ms2'
         workdir (string): Full path to the working directory
+        trace (trace_utils.RequestTrace): The trace to add spans for this scan file to, or None
 
     Returns:
-        dict: The retention times found for each scan in the form of:
+        dict: The files created, in the form of:
             {
                 'spectr_file_id': <spectr file id>,
-                'ms2_file_name': <ms2 file name>,
-                'retention_times': {
-                    <scan number>: <retention time in s>,
-                }
+                'spectrum_file_name': <ms2 or mzML file name>,
+                'ssl_file_name': <ssl file name>
             },
     """
 
+    if trace is None:
+        trace = trace_utils.RequestTrace()
+
+    start_time = time.perf_counter()
+    trace_start_time = time.time()
+    write_seconds = 0.0
+
+    spectr_file_id = spectr_dict['spectr_file_id']
+    spectrum_format = get_intermediate_spectrum_format()
+    ssl_file_name = str(ms2_file_id) + '.ssl'
+    retention_time_dict = {}
+    dropped_scan_numbers = set()
+
+    mz_precision = get_ms2_precision(__ms2_mz_precision_env_key__)
+    intensity_precision = get_ms2_precision(__ms2_intensity_precision_env_key__)
+
+    scan_batches = iterate_scan_batches_for_scan_file(spectr_dict, trace, dropped_scan_numbers)
+
+    if spectrum_format == 'ms2':
+        spectrum_file_name = str(ms2_file_id) + '.ms2'
+        spectrum_file = ms2_lib.initialize_ms2_file(workdir, spectrum_file_name)
+    else:
+        spectrum_file_name = str(ms2_file_id) + '.mzML'
+        spectrum_file = mzml_lib.initialize_mzml_file(workdir, spectrum_file_name, spectrum_format == 'mzml_zlib')
+
+    try:
+        for scan_data in scan_batches:
+            for ms2_scan in scan_data:
+                # scans may be parsed as they are iterated, so only time the writes
+                write_start_time = time.perf_counter()
+
+                if spectrum_format == 'ms2':
+                    ms2_lib.write_scan_to_ms2_file(
+                        spectrum_file,
+                        ms2_scan.scan_number,
+                        ms2_scan.precursor_mz,
+                        ms2_scan.precursor_charge,
+                        ms2_scan.peak_list_mz,
+                        ms2_scan.peak_list_intensity,
+                        mz_precision,
+                        intensity_precision
+                    )
+                else:
+                    mzml_lib.write_scan_to_mzml_file(
+                        spectrum_file,
+                        ms2_scan.scan_number,
+                        ms2_scan.precursor_mz,
+                        ms2_scan.precursor_charge,
+                        ms2_scan.retention_time_seconds,
+                        ms2_scan.peak_list_mz,
+                        ms2_scan.peak_list_intensity
+                    )
+
+                write_seconds += time.perf_counter() - write_start_time
+                retention_time_dict[ms2_scan.scan_number] = ms2_scan.retention_time_seconds
+
+    finally:
+        # stops any fetching still in progress
+        scan_batches.close()
+
+        if spectrum_format == 'ms2':
+            ms2_lib.close_ms2_file(spectrum_file)
+        else:
+            mzml_lib.close_mzml_file(spectrum_file)
+
+    # leave out the PSMs of scans with no peaks left after peak reduction, they were not written
+    if len(dropped_scan_numbers) > 0:
+        spectr_dict = dict(spectr_dict, psms=[
+            psm for psm in spectr_dict['psms'] if psm['scan_number'] not in dropped_scan_numbers
+        ])
+
+    # write the PSMs here, while the retention times are at hand
+    ssl_start_time = time.time()
+    write_ssl_file(workdir, ssl_file_name, spectrum_file_name, spectr_dict, retention_time_dict)
+    trace.add_span('ssl', 'batch', ssl_start_time, {'psm_count': len(spectr_dict['psms'])})
+
+    metrics.observe_histogram('blib_export_spectrum_file_write_seconds', write_seconds)
+    metrics.observe_histogram('blib_export_scan_file_seconds', time.perf_counter() - start_time)
+    trace.add_span('scan file', 'scan file', trace_start_time, {'spectr_file_id': spectr_file_id,
+                                                                 'file_id': ms2_file_id})
+
+    return {
+        'spectr_file_id': spectr_file_id,
+        'spectrum_file_name': spectrum_file_name,
+        'ssl_file_name': ssl_file_name
+    }
+
+
+def get_intermediate_spectrum_format():
+    """Get the format of the spectrum files written for BlibBuild, one of 'ms2', 'mzml' or 'mzml_zlib'.
+    Defaults to 'ms2' if no env var is set
+
+    Returns:
+        string: the format
+    """
+
+    spectrum_format = os.getenv(__intermediate_spectrum_format_env_key__, __default_intermediate_spectrum_format__)
+
+    if spectrum_format not in ('ms2', 'mzml', 'mzml_zlib'):
+        raise ValueError('Got unknown value for env var:', __intermediate_spectrum_format_env_key__)
+
+    return spectrum_format
+
+
+def create_redundant_blib_file(spectr_dict, blib_file_id, workdir, trace=None):
+    """Create a redundant .blib library directly from a spectr file id for the given PSMs, without
+    writing .ms2 and .ssl files or running BlibBuild
+
+    Parameters:
+        spectr_dict (dict): The part of the conversion request for a single spectr file id
+        blib_file_id (int): The base of the filename to use for the library (e.g., 1 = '1.redundant.blib')
+        workdir (string): Full path to the working directory
+        trace (trace_utils.RequestTrace): The trace to add spans for this scan file to, or None
+
+    Returns:
+        dict: {'spectr_file_id': <spectr file id>, 'blib_file_name': <library file name>}
+    """
+
+    if trace is None:
+        trace = trace_utils.RequestTrace()
+
+    start_time = time.perf_counter()
+    trace_start_time = time.time()
+    write_seconds = 0.0
+
+    spectr_file_id = spectr_dict['spectr_file_id']
+    blib_file_name = str(blib_file_id) + '.redundant.blib'
+    score_type = spectr_dict.get('score_type', blib_lib.default_score_type)
+    score_cutoff = get_blib_build_score_cutoff()
+
+    # leave out the PSMs BlibBuild would leave out, their scans are not fetched
+    spectr_dict = dict(spectr_dict, psms=[
+        psm for psm in spectr_dict['psms']
+        if blib_lib.passes_score_cutoff(score_type, psm.get('score', 0.0), score_cutoff)
+    ])
+
+    psms_by_scan_number = {}
+    for psm in spectr_dict['psms']:
+        psms_by_scan_number.setdefault(psm['scan_number'], []).append(psm)
+
+    dropped_scan_numbers = set()
+    scan_batches = iterate_scan_batches_for_scan_file(spectr_dict, trace, dropped_scan_numbers)
+
+    remove_stale_file(workdir, blib_file_name)
+    blib_connection = blib_lib.initialize_blib_file(workdir, blib_file_name)
+
+    try:
+        # record the source file the same way BlibBuild does for the .ms2 file of this scan file
+        file_id = blib_lib.add_source_file_to_blib_file(
+            blib_connection,
+            os.path.join(workdir, str(blib_file_id) + '.ms2'),
+            os.path.join(workdir, str(blib_file_id) + '.ssl'),
+            score_cutoff
+        )
+
+        written_scan_numbers = set()
+
+        for scan_data in scan_batches:
+            scans_and_psms = []
+
+            for ms2_scan in scan_data:
+                scans_and_psms.append((ms2_scan, psms_by_scan_number[ms2_scan.scan_number]))
+                written_scan_numbers.add(ms2_scan.scan_number)
+
+            write_start_time = time.perf_counter()
+            blib_lib.write_spectra_to_blib_file(blib_connection, file_id, scans_and_psms, score_type)
+            write_seconds += time.perf_counter() - write_start_time
+
+    finally:
+        # stops any fetching still in progress
+        scan_batches.close()
+        blib_lib.close_blib_file(blib_connection)
+
+    # scans with no peaks left after peak reduction are not written on purpose
+    missing_scan_numbers = psms_by_scan_number.keys() - written_scan_numbers - dropped_scan_numbers
+    if len(missing_scan_numbers) > 0:
+        raise ValueError('Did not get scan data for scans:', spectr_file_id, sorted(missing_scan_numbers))
+
+    metrics.observe_histogram('blib_export_spectrum_file_write_seconds', write_seconds)
+    metrics.observe_histogram('blib_export_scan_file_seconds', time.perf_counter() - start_time)
+    trace.add_span('scan file', 'scan file', trace_start_time, {'spectr_file_id': spectr_file_id,
+                                                                 'file_id': blib_file_id})
+
+    return {
+        'spectr_file_id': spectr_file_id,
+        'blib_file_name': blib_file_name
+    }
+
+
+def iterate_scan_batches_for_scan_file(spectr_dict, trace, dropped_scan_numbers=None):
+    """Get the scan data for all distinct scans of the PSMs of a scan file, in batches, reading what
+    we can from the scan cache and requesting the remainder from spectr. Uses the configured number
+    of spectr requests in flight, and fetches in a background thread if a write queue is configured.
+    The returned generator must be closed once done with, to stop any fetching still in progress.
+
+    Parameters:
+        spectr_dict (dict): The part of the conversion request for a single spectr file id
+        trace (trace_utils.RequestTrace): The trace to add a span for each batch read ahead of the writes to
+        dropped_scan_numbers (set): If given, the scan numbers of scans dropped for having no peaks left after
+            peak reduction are added to it. Only complete once the generator is exhausted
+
+    Returns:
+        generator: Yields an iterable of MS2ScanData objects for each batch, in scan order
+    """
+
     spectr_file_id = spectr_dict['spectr_file_id']
-    ms2_file_name = str(ms2_file_id) + '.ms2'
     scans_to_add = get_distinct_scans_from_request_data(spectr_dict)
 
     scan_count_per_call = os.getenv(__spectr_batch_size_env_key__)
     if scan_count_per_call is None:
         raise ValueError('Missing environmental variable:', __spectr_batch_size_env_key__)
 
-    retention_time_dict = {}
-    scan_count_per_call = int(scan_count_per_call)
+    # the batch size is adjusted for each scan file, as scan sizes and spectr response times differ between files
+    batch_sizer = spectr_utils.create_batch_sizer(int(scan_count_per_call))
+
+    # only scans not already in the scan cache are requested from spectr
+    cached_scan_numbers = scan_cache.get_cached_scan_numbers(spectr_file_id)
+    scan_sets = iterate_scan_batches(scans_to_add, cached_scan_numbers, batch_sizer)
+
+    max_in_flight = get_spectr_max_in_flight()
+    scan_batches = iterate_scan_data_for_scan_batches(
+        spectr_file_id,
+        scan_sets,
+        cached_scan_numbers,
+        max_in_flight,
+        trace,
+        batch_sizer
+    )
+
+    # reduce the peaks of each batch, if configured. Scans are cached with all of their peaks
+    peak_filter_settings = peak_utils.get_peak_filter_settings()
+    if peak_filter_settings is not None:
+        scan_batches = iterate_reduced_scan_batches(scan_batches, peak_filter_settings, dropped_scan_numbers)
+
+    # fetch and parse in a separate thread while earlier batches are written, if configured
+    write_queue_size = get_ms2_write_queue_size()
+    if write_queue_size > 0:
+        scan_batches = general_utils.iterate_in_background_thread(
+            _iterate_read_scan_batches(scan_batches, trace if max_in_flight <= 1 else None),
+            write_queue_size
+        )
+
+        return _iterate_traced_scan_batches(scan_batches, trace, 'write batch', False)
+
+    if max_in_flight > 1:
+        return _iterate_traced_scan_batches(scan_batches, trace, 'write batch', False)
+
+    # batches that are not read ahead are fetched and parsed as they are consumed
+    return _iterate_traced_scan_batches(scan_batches, trace, 'fetch, parse and write batch', True)
+
+
+def _iterate_traced_scan_batches(scan_batches, trace, span_name, include_read):
+    """Pass through each batch of scans, adding a span to the trace for the time the consumer spends
+    on each batch, and for the time to get the batch if include_read is True
+
+    Returns:
+        generator: Yields the batches of scan_batches
+    """
+
+    try:
+        batch_start_time = time.time()
+
+        for scan_data in scan_batches:
+            if not include_read:
+                batch_start_time = time.time()
+
+            yield scan_data
+
+            trace.add_span(span_name, 'batch', batch_start_time)
+            batch_start_time = time.time()
+
+    finally:
+        scan_batches.close()
+
 
-    scan_sets = [scans_to_add[i:i + scan_count_per_call] for i in range(0, len(scans_to_add), scan_count_per_call)]
+def _iterate_read_scan_batches(scan_batches, trace):
+    """Fully read each batch of scans, adding a span for each read to the trace if one is given
 
-    ms2_file = ms2_lib.initialize_ms2_file(workdir, ms2_file_name)
+    Returns:
+        generator: Yields a list of MS2ScanData objects for each batch
+    """
 
     try:
+        while True:
+            batch_start_time = time.time()
+
+            scan_data = next(scan_batches, None)
+            if scan_data is None:
+                return
+
+            scan_data = list(scan_data)
+
+            if trace is not None:
+                trace.add_span('fetch and parse batch', 'batch', batch_start_time, {'scan_count': len(scan_data)})
+
+            yield scan_data
+
+    finally:
+        scan_batches.close()
+
+
+def iterate_reduced_scan_batches(scan_batches, peak_filter_settings, dropped_scan_numbers=None):
+    """Reduce the peaks of each batch of scans, see peak_utils.reduce_peaks_for_scans. Scans left
+    with no peaks are dropped
+
+    Parameters:
+        scan_batches (generator): Yields an iterable of MS2ScanData objects for each batch
+        peak_filter_settings (peak_utils.PeakFilterSettings): How to reduce the peaks
+        dropped_scan_numbers (set): If given, the scan numbers of dropped scans are added to it
+
+    Returns:
+        generator: Yields a list of MS2ScanData objects with reduced peaks for each batch
+    """
+
+    try:
+        for scan_data in scan_batches:
+            yield peak_utils.reduce_peaks_for_scans(scan_data, peak_filter_settings, dropped_scan_numbers)
+
+    finally:
+        scan_batches.close()
+
+
+def iterate_scan_batches(scans_to_add, cached_scan_numbers, batch_sizer):
+    """Split the sorted scan numbers into consecutive batches. Each batch contains at most batch size
+    scans that must be requested from spectr and at most batch size scans that are already cached,
+    so that spectr requests stay full-sized when some of the scans are cached. The batch size is
+    taken from batch_sizer as each batch is started, so it follows the requests made so far.
+
+    Parameters:
+        scans_to_add (list): Sorted list of the scan numbers to add to the ms2 file
+        cached_scan_numbers (set): The scan numbers for this file that are in the scan cache
+        batch_sizer (spectr_utils.SpectrBatchSizer): Chooses the number of scans to request from spectr at a time
+
+    Returns:
+        generator: Yields a list of scan numbers for each batch, in scan order
+    """
+
+    scan_array = []
+    cached_count = 0
+    uncached_count = 0
+    batch_size = batch_sizer.batch_size
+
+    for scan_number in scans_to_add:
+        scan_array.append(scan_number)
+
+        if scan_number in cached_scan_numbers:
+            cached_count += 1
+        else:
+            uncached_count += 1
+
+        if cached_count >= batch_size or uncached_count >= batch_size:
+            yield scan_array
+            scan_array = []
+            cached_count = 0
+            uncached_count = 0
+            batch_size = batch_sizer.batch_size
+
+    if len(scan_array) > 0:
+        yield scan_array
+
+
+def iterate_scan_data_for_scan_batches(spectr_file_id, scan_sets, cached_scan_numbers, max_in_flight, trace=None,
+                                       batch_sizer=None):
+    """Get the scan data for each batch of scans, yielding the batches in the order they appear in
+    scan_sets. If max_in_flight is 1, the scans of each batch are parsed lazily as they are consumed.
+    If max_in_flight is greater than 1, up to that many batches are requested from spectr at the same
+    time using a thread pool.
+
+    Parameters:
+        spectr_file_id (string): The spectral file hash key for the spectral file
+        scan_sets (iterable): Lists of scan numbers, see iterate_scan_batches
+        cached_scan_numbers (set): The scan numbers for this file that were in the scan cache
+        max_in_flight (int): The maximum number of batches to request at the same time
+        trace (trace_utils.RequestTrace): The trace to add a span for each batch requested at the same time to,
+            or None
+        batch_sizer (spectr_utils.SpectrBatchSizer): The batch sizer to record each spectr request with, or None
+
+    Returns:
+        generator: Yields an iterable of MS2ScanData objects for each batch, in scan order
+    """
+
+    if max_in_flight <= 1:
         for scan_array in scan_sets:
-            scan_data = spectr_utils.get_scan_data_for_scan_numbers(spectr_file_id, scan_array)
+            yield get_scan_data_for_scan_batch(spectr_file_id, scan_array, cached_scan_numbers, batch_sizer)
 
-            for ms2_scan in scan_data:
-                ms2_lib.write_scan_to_ms2_file(
-                    ms2_file,
-                    ms2_scan.scan_number,
-                    ms2_scan.precursor_mz,
-                    ms2_scan.precursor_charge,
-                    ms2_scan.peak_list_mz,
-                    ms2_scan.peak_list_intensity
-                )
-                retention_time_dict[ms2_scan.scan_number] = ms2_scan.retention_time_seconds
+        return
+
+    executor = ThreadPoolExecutor(max_workers=max_in_flight)
+    futures = deque()
+    scan_set_iterator = iter(scan_sets)
+
+    try:
+        # fill the window, then submit a new batch each time the oldest batch is consumed
+        for scan_array in scan_set_iterator:
+            futures.append(executor.submit(_get_scan_data_list_for_scan_batch, spectr_file_id, scan_array,
+                                           cached_scan_numbers, trace, batch_sizer))
+            if len(futures) >= max_in_flight:
+                break
+
+        while len(futures) > 0:
+            future = futures.popleft()
+
+            next_scan_array = next(scan_set_iterator, None)
+            if next_scan_array is not None:
+                futures.append(executor.submit(_get_scan_data_list_for_scan_batch, spectr_file_id, next_scan_array,
+                                               cached_scan_numbers, trace, batch_sizer))
+
+            yield future.result()
 
     finally:
-        ms2_lib.close_ms2_file(ms2_file)
+        executor.shutdown(wait=True, cancel_futures=True)
 
-    return {
-        'spectr_file_id': spectr_file_id,
-        'ms2_file_name': ms2_file_name,
-        'retention_times': retention_time_dict
-    }
+
+def get_scan_data_for_scan_batch(spectr_file_id, scan_array, cached_scan_numbers, batch_sizer=None):
+    """Get the scan data for a batch of scans, reading what we can from the scan cache and requesting
+    the remainder from spectr. Scans requested from spectr are parsed as they are consumed from the
+    returned iterator, and are added to the scan cache once the batch has been read.
+
+    Parameters:
+        spectr_file_id (string): The spectral file hash key for the spectral file
+        scan_array (list): The scan numbers in this batch
+        cached_scan_numbers (set): The scan numbers for this file that were in the scan cache
+        batch_sizer (spectr_utils.SpectrBatchSizer): The batch sizer to record the spectr request with, or None
+
+    Returns:
+        iterator: MS2ScanData objects for this batch, in scan order
+    """
+
+    cached_scans = scan_cache.get_cached_scans(
+        spectr_file_id,
+        [scan_number for scan_number in scan_array if scan_number in cached_scan_numbers]
+    )
+
+    metrics.increment_counter('blib_export_scan_cache_hits_total', len(cached_scans))
+
+    # scans may have been evicted since we checked the cache, so check what was actually returned
+    missing_scans = [scan_number for scan_number in scan_array if scan_number not in cached_scans]
+
+    if len(missing_scans) < 1:
+        return iter([cached_scans[scan_number] for scan_number in scan_array if scan_number in cached_scans])
+
+    return heapq.merge(
+        sorted(cached_scans.values(), key=_get_scan_number),
+        _iterate_and_cache_spectr_scans(spectr_file_id, missing_scans, batch_sizer),
+        key=_get_scan_number
+    )
+
+
+def _get_scan_data_list_for_scan_batch(spectr_file_id, scan_array, cached_scan_numbers, trace, batch_sizer):
+    """Fully read the scan data for a batch of scans, see get_scan_data_for_scan_batch, adding a span
+    for the read to the trace if one is given
+
+    Returns:
+        list: MS2ScanData objects for this batch, in scan order
+    """
+
+    batch_start_time = time.time()
+    scan_data = list(get_scan_data_for_scan_batch(spectr_file_id, scan_array, cached_scan_numbers, batch_sizer))
+
+    if trace is not None:
+        trace.add_span('fetch and parse batch', 'batch', batch_start_time, {'scan_count': len(scan_data)})
+
+    return scan_data
+
+
+def _iterate_and_cache_spectr_scans(spectr_file_id, scan_numbers, batch_sizer):
+    """Stream the given scans from spectr, adding them to the scan cache once all have been read
+
+    Returns:
+        generator: Yields a MS2ScanData object for each scan
+    """
+
+    cache_enabled = scan_cache.is_scan_cache_enabled()
+    fetched_scans = []
+
+    for ms2_scan in spectr_utils.iterate_scan_data_for_scan_numbers(spectr_file_id, scan_numbers, batch_sizer):
+        if cache_enabled:
+            fetched_scans.append(ms2_scan)
+
+        yield ms2_scan
+
+    scan_cache.add_scans_to_cache(fetched_scans)
+
+
+def _get_scan_number(ms2_scan):
+    return ms2_scan.scan_number
 
 
 def clean_workdir(workdir, success):
@@ -470,7 +1659,8 @@ def verify_blib_destination(blib_filename):
 
 
 def get_workdir(request):
-    """Create and return the path to the work directory
+    """Create and return the path to the work directory, or return the work directory of an earlier
+    attempt at the request if it holds a checkpoint
 
     Parameters:
         request (dict): A dict: {'id': request_id, 'data': xml_request}
@@ -489,6 +1679,11 @@ def get_workdir(request):
         raise ValueError('Work directory is a file, not a directory:', os.getenv(__workdir_env_key__))
 
     workdir = os.path.join(os.getenv(__workdir_env_key__), request['id'])
+
+    # the work directory of an earlier attempt at this request is reused, so the work it completed is not repeated
+    if checkpoint_utils.has_checkpoint(workdir):
+        return workdir
+
     if os.path.exists(workdir):
         raise ValueError('Work directory already exists:', workdir)
 
@@ -496,4 +1691,23 @@ def get_workdir(request):
     if not os.path.exists(workdir):
         raise ValueError('Failed to create work directory:', workdir)
 
+    checkpoint_utils.RequestCheckpoint(workdir).save()
+
     return workdir
+
+
+def is_request_resumable(request_id):
+    """Determine whether the work directory of an earlier attempt at the request is still there, so
+    processing it again resumes that attempt
+
+    Parameters:
+        request_id (string): The request id
+
+    Returns:
+        bool
+    """
+
+    if os.getenv(__workdir_env_key__) is None:
+        return False
+
+    return checkpoint_utils.has_checkpoint(os.path.join(os.getenv(__workdir_env_key__), request_id))
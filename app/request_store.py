@@ -0,0 +1,277 @@
+"""A durable request queue and request status store in a local SQLite database, so queued requests
+and completed results survive a restart of the service"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import json
+import time
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+from .queue_utils import RequestQueue, estimate_request_cost
+
+
+class SQLiteRequestStore:
+    """The SQLite database holding the request queue, the request statuses and the request hashes.
+    The database is in WAL mode, so status reads don't wait on writes."""
+
+    def __init__(self, database_path, lock):
+        """Open (or create) the database and load the queued requests. Requests that were being
+        processed when the service stopped are queued again.
+
+        Parameters:
+            database_path (string): Full path to the SQLite database file
+            lock (threading.RLock): The request lock, shared with the request queue
+
+        Returns:
+            SQLiteRequestStore with request_queue, request_status_dict and request_hash_dict attributes
+        """
+
+        self.connection = sqlite3.connect(database_path, check_same_thread=False, isolation_level=None)
+        self.connection_lock = threading.Lock()
+
+        with self.connection_lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.executescript(
+                'CREATE TABLE IF NOT EXISTS request_status (request_id TEXT PRIMARY KEY, project_id INTEGER, '
+                'status TEXT, entry TEXT NOT NULL);'
+                'CREATE INDEX IF NOT EXISTS request_status_project_id ON request_status (project_id);'
+                'CREATE INDEX IF NOT EXISTS request_status_status ON request_status (status);'
+                'CREATE TABLE IF NOT EXISTS request_hash (request_hash TEXT PRIMARY KEY, entry TEXT NOT NULL);'
+                'CREATE TABLE IF NOT EXISTS request_queue (seq INTEGER PRIMARY KEY, request_id TEXT NOT NULL UNIQUE, '
+                'project_id INTEGER, cost REAL NOT NULL, queued_at REAL NOT NULL, '
+                'is_processing INTEGER NOT NULL DEFAULT 0, data TEXT NOT NULL);'
+                'CREATE INDEX IF NOT EXISTS request_queue_project_id ON request_queue (project_id);'
+            )
+
+        self.request_status_dict = SQLiteMapping(self, 'request_status', 'request_id', ('project_id', 'status'))
+        self.request_hash_dict = SQLiteMapping(self, 'request_hash', 'request_hash')
+        self.request_queue = SQLiteRequestQueue(self, lock)
+
+        # requests that were being processed have been queued again
+        for request in self.request_queue:
+            status_entry = self.request_status_dict.get(request['id'])
+
+            if status_entry is not None and status_entry['status'] == 'processing':
+                status_entry['status'] = 'queued'
+                self.request_status_dict[request['id']] = status_entry
+
+    def execute(self, sql, parameters=()):
+        """Run a statement and return all of its rows
+
+        Parameters:
+            sql (string): The statement
+            parameters (tuple): The values of its parameters
+
+        Returns:
+            list: The rows, as tuples
+        """
+
+        with self.connection_lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+
+class SQLiteMapping(MutableMapping):
+    """A dict-like table of JSON values. Values are read from the database on every access, so a
+    value changed in place must be assigned again to be stored."""
+
+    def __init__(self, store, table, key_column, indexed_value_keys=()):
+        """Create a mapping over an existing table
+
+        Parameters:
+            store (SQLiteRequestStore): The store holding the table
+            table (string): The table name
+            key_column (string): The name of the key column
+            indexed_value_keys (tuple): Keys of the (dict) values that are also stored in their own columns,
+                                        of the same names, so they can be indexed
+
+        Returns:
+            SQLiteMapping object
+        """
+        self._store = store
+        self._table = table
+        self._key_column = key_column
+        self._indexed_value_keys = indexed_value_keys
+
+    def __getitem__(self, key):
+        rows = self._store.execute(
+            'SELECT entry FROM ' + self._table + ' WHERE ' + self._key_column + ' = ?', (key,)
+        )
+
+        if len(rows) < 1:
+            raise KeyError(key)
+
+        return json.loads(rows[0][0])
+
+    def __setitem__(self, key, value):
+        columns = (self._key_column,) + self._indexed_value_keys + ('entry',)
+        values = (key,) + tuple(value.get(value_key) for value_key in self._indexed_value_keys) + \
+            (json.dumps(value),)
+
+        self._store.execute(
+            'INSERT OR REPLACE INTO ' + self._table + ' (' + ', '.join(columns) + ') VALUES (' +
+            ', '.join('?' * len(columns)) + ')',
+            values
+        )
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+
+        self._store.execute('DELETE FROM ' + self._table + ' WHERE ' + self._key_column + ' = ?', (key,))
+
+    def __contains__(self, key):
+        return len(self._store.execute(
+            'SELECT 1 FROM ' + self._table + ' WHERE ' + self._key_column + ' = ?', (key,)
+        )) > 0
+
+    def __iter__(self):
+        return iter([row[0] for row in self._store.execute('SELECT ' + self._key_column + ' FROM ' + self._table)])
+
+    def __len__(self):
+        return self._store.execute('SELECT COUNT(*) FROM ' + self._table)[0][0]
+
+    def values(self):
+        return [json.loads(row[0]) for row in self._store.execute('SELECT entry FROM ' + self._table)]
+
+    def count_values_with(self, value_key, value):
+        """Count the values with the given value for one of the indexed value keys, without reading the values
+
+        Parameters:
+            value_key (string): One of the indexed value keys, e.g. 'status'
+            value: The value to count, e.g. 'processing'
+
+        Returns:
+            int: The number of matching values
+        """
+
+        if value_key not in self._indexed_value_keys:
+            raise ValueError('Not an indexed value key:', value_key)
+
+        return self._store.execute(
+            'SELECT COUNT(*) FROM ' + self._table + ' WHERE ' + value_key + ' = ?', (value,)
+        )[0][0]
+
+
+class SQLiteRequestQueue(RequestQueue):
+    """A RequestQueue kept in the database. Only what the scheduling policies need is held in memory;
+    the data of each request is read from the database when the request is taken from the queue. A
+    request stays in the database until task_done, so requests being processed when the service
+    stops are queued again when it starts."""
+
+    def __init__(self, store, lock=None):
+        """Load the queued requests from the database
+
+        Parameters:
+            store (SQLiteRequestStore): The store holding the request_queue table
+            lock (threading.RLock): The lock guarding the queue, see RequestQueue
+
+        Returns:
+            SQLiteRequestQueue object
+        """
+
+        super().__init__(lock)
+        self._store = store
+
+        store.execute('UPDATE request_queue SET is_processing = 0')
+
+        for seq, request_id, project_id, cost, queued_at in store.execute(
+                'SELECT seq, request_id, project_id, cost, queued_at FROM request_queue ORDER BY seq'):
+            self._entries.append({
+                'request': {'id': request_id, 'project_id': project_id},
+                'cost': cost,
+                'project_id': project_id,
+                'queued_at': queued_at,
+                'seq': seq
+            })
+            self._next_seq = seq + 1
+
+    def append(self, request):
+        """Add a request to the queue and the database, and wake up a waiting request processor
+
+        Parameters:
+            request (dict): {'id': request_id, 'data': request data, 'project_id': project id}
+
+        Returns:
+            NoneType
+        """
+
+        project_id = request.get('project_id')
+        entry = {
+            'request': {'id': request['id'], 'project_id': project_id},
+            'cost': estimate_request_cost(request['data']),
+            'project_id': project_id,
+            'queued_at': time.time()
+        }
+
+        with self._condition:
+            entry['seq'] = self._next_seq
+            self._next_seq += 1
+
+            self._store.execute(
+                'INSERT INTO request_queue (seq, request_id, project_id, cost, queued_at, data) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (entry['seq'], request['id'], project_id, entry['cost'], entry['queued_at'],
+                 json.dumps(request['data']))
+            )
+
+            self._entries.append(entry)
+            self._condition.notify()
+
+    def get_next(self):
+        """Remove and return the next request under the scheduling policy, with its data, blocking until
+        one is available. The caller must call task_done with the request once it has been processed.
+
+        Returns:
+            dict: {'id': request_id, 'data': request data, 'project_id': project id}
+        """
+
+        request = super().get_next()
+
+        data = self._store.execute('SELECT data FROM request_queue WHERE request_id = ?', (request['id'],))[0][0]
+        self._store.execute('UPDATE request_queue SET is_processing = 1 WHERE request_id = ?', (request['id'],))
+
+        return {'id': request['id'], 'data': json.loads(data), 'project_id': request['project_id']}
+
+    def task_done(self, request):
+        """Record that a request returned by get_next has been processed, removing it from the database
+
+        Parameters:
+            request (dict): The request returned by get_next
+
+        Returns:
+            NoneType
+        """
+
+        super().task_done(request)
+        self._store.execute('DELETE FROM request_queue WHERE request_id = ?', (request['id'],))
+
+    def remove(self, request_id):
+        """Remove the request with the given id from the queue and the database
+
+        Parameters:
+            request_id (string): The request id
+
+        Returns:
+            bool: True if the request was found and removed
+        """
+
+        with self._condition:
+            if not super().remove(request_id):
+                return False
+
+            self._store.execute('DELETE FROM request_queue WHERE request_id = ?', (request_id,))
+            return True
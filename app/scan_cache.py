@@ -0,0 +1,344 @@
+"""Methods for the persistent, on-disk cache of scan data retrieved from spectr"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import time
+import zlib
+import sqlite3
+import threading
+from array import array
+from contextlib import contextmanager
+from . import __scan_cache_dir_env_key__, __scan_cache_max_mb_env_key__, __scan_cache_default_max_mb__, \
+    spectr_utils
+
+# name of the sqlite database file in the scan cache directory
+_cache_db_filename = 'scan_cache.sqlite'
+
+# maximum number of values to bind to a single sqlite statement
+_max_statement_params = 500
+
+# maximum number of idle connections kept open for reuse in each process. Connections are checked out
+# by the fetching threads for each use, so only as many are open as are used at the same time
+_max_idle_connections = 4
+
+# idle connections of this process, see _pooled_connection
+_idle_connections = []
+_idle_connections_lock = threading.Lock()
+
+# connections inherited from the parent by a forked mpire worker. They must not be used or closed in the
+# child, so they are only kept referenced
+_inherited_connections = []
+
+
+def _reset_connections_after_fork():
+    global _idle_connections, _idle_connections_lock
+
+    _inherited_connections.extend(_idle_connections)
+    _idle_connections = []
+    _idle_connections_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_connections_after_fork)
+
+
+def is_scan_cache_enabled():
+    """Determine whether the scan cache is enabled. It is enabled if the scan cache
+    directory env var is set.
+
+    Returns:
+        bool
+    """
+    return os.getenv(__scan_cache_dir_env_key__) is not None
+
+
+def get_scan_cache_max_bytes():
+    """Get the maximum size of the scan cache in bytes. Uses the scan cache max MB env var,
+    falls back to the default if not set.
+
+    Returns:
+        int: The maximum size of the scan cache in bytes
+    """
+
+    max_mb = os.getenv(__scan_cache_max_mb_env_key__)
+
+    if max_mb is None:
+        max_mb = __scan_cache_default_max_mb__
+    else:
+        max_mb = int(max_mb)
+
+    if max_mb < 1:
+        raise ValueError('Scan cache size must be at least 1 MB:', __scan_cache_max_mb_env_key__)
+
+    return max_mb * 1024 * 1024
+
+
+def get_cached_scan_numbers(spectr_file_id):
+    """Get all scan numbers currently in the cache for the given spectr file
+
+    Parameters:
+        spectr_file_id (string): The spectral file hash key for the spectral file
+
+    Returns:
+        set: The scan numbers in the cache for this file. Empty if the cache is disabled
+    """
+
+    if not is_scan_cache_enabled():
+        return set()
+
+    with _pooled_connection() as connection:
+        cursor = connection.execute('SELECT scan_number FROM scans WHERE spectr_file_id = ?', (spectr_file_id,))
+
+        return {row[0] for row in cursor}
+
+
+def get_cached_scans(spectr_file_id, scan_numbers):
+    """Get the cached scan data for the given scan numbers. Scans not in the cache are
+    not returned. Marks every returned scan as recently used.
+
+    Parameters:
+        spectr_file_id (string): The spectral file hash key for the spectral file
+        scan_numbers (list): The scan numbers to get from the cache
+
+    Returns:
+        dict: scan number => MS2ScanData for each scan that was found in the cache
+    """
+
+    cached_scans = {}
+
+    if not is_scan_cache_enabled() or len(scan_numbers) < 1:
+        return cached_scans
+
+    with _pooled_connection() as connection:
+        for i in range(0, len(scan_numbers), _max_statement_params):
+            scan_number_chunk = scan_numbers[i:i + _max_statement_params]
+            placeholders = ','.join('?' * len(scan_number_chunk))
+
+            cursor = connection.execute(
+                'SELECT scan_number, msn_level, retention_time_seconds, precursor_charge, precursor_mz, peak_count, '
+                'peaks FROM scans WHERE spectr_file_id = ? AND scan_number IN (' + placeholders + ')',
+                [spectr_file_id] + list(scan_number_chunk)
+            )
+
+            for row in cursor:
+                cached_scans[row[0]] = _build_ms2_scan_data_from_row(spectr_file_id, row)
+
+        # mark the returned scans as recently used
+        if len(cached_scans) > 0:
+            now = time.time()
+            with connection:
+                connection.executemany(
+                    'UPDATE scans SET last_access = ? WHERE spectr_file_id = ? AND scan_number = ?',
+                    [(now, spectr_file_id, scan_number) for scan_number in cached_scans]
+                )
+
+    return cached_scans
+
+
+def add_scans_to_cache(ms2_scans):
+    """Add the given scans to the cache, then evict the least recently used scans until the
+    cache is within its size budget. Scans already in the cache are left as they are.
+
+    Parameters:
+        ms2_scans (list): The MS2ScanData objects to add to the cache
+
+    Returns:
+        NoneType
+    """
+
+    if not is_scan_cache_enabled() or len(ms2_scans) < 1:
+        return
+
+    now = time.time()
+    rows = []
+
+    for ms2_scan in ms2_scans:
+        peaks = _encode_peaks(ms2_scan.peak_list_mz, ms2_scan.peak_list_intensity)
+        rows.append((
+            ms2_scan.scan_file_hash_key,
+            ms2_scan.scan_number,
+            ms2_scan.msn_level,
+            ms2_scan.retention_time_seconds,
+            ms2_scan.precursor_charge,
+            ms2_scan.precursor_mz,
+            len(ms2_scan.peak_list_mz),
+            peaks,
+            len(peaks),
+            now
+        ))
+
+    with _pooled_connection() as connection, connection:
+        connection.executemany(
+            'INSERT OR IGNORE INTO scans (spectr_file_id, scan_number, msn_level, retention_time_seconds, '
+            'precursor_charge, precursor_mz, peak_count, peaks, byte_size, last_access) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            rows
+        )
+
+    evict_scans_over_budget(get_scan_cache_max_bytes())
+
+
+def evict_scans_over_budget(max_bytes):
+    """Remove the least recently used scans from the cache until the total size of the
+    cached peak data is at or below max_bytes
+
+    Parameters:
+        max_bytes (int): The size budget of the cache in bytes
+
+    Returns:
+        NoneType
+    """
+
+    with _pooled_connection() as connection, connection:
+        total_bytes = connection.execute('SELECT total_bytes FROM cache_info').fetchone()[0]
+
+        if total_bytes <= max_bytes:
+            return
+
+        bytes_to_free = total_bytes - max_bytes
+        bytes_freed = 0
+        rowids_to_delete = []
+
+        for rowid, byte_size in connection.execute('SELECT rowid, byte_size FROM scans ORDER BY last_access'):
+            rowids_to_delete.append((rowid,))
+            bytes_freed += byte_size
+
+            if bytes_freed >= bytes_to_free:
+                break
+
+        connection.executemany('DELETE FROM scans WHERE rowid = ?', rowids_to_delete)
+
+
+def _encode_peaks(peak_list_mz, peak_list_intensity):
+    """Pack the peak arrays into a compressed blob of doubles, all m/z values followed by
+    all intensities. Doubles preserve the values exactly as received from spectr.
+
+    Returns:
+        bytes
+    """
+    return zlib.compress(peak_list_mz.tobytes() + peak_list_intensity.tobytes())
+
+
+def _decode_peaks(peaks, peak_count):
+    """Unpack a blob created by _encode_peaks
+
+    Returns:
+        tuple: (peak_list_mz, peak_list_intensity) as array('d')
+    """
+
+    values = array('d')
+    values.frombytes(zlib.decompress(peaks))
+
+    return values[:peak_count], values[peak_count:]
+
+
+def _build_ms2_scan_data_from_row(spectr_file_id, row):
+    """Build a MS2ScanData from a row selected from the scans table
+
+    Returns:
+        spectr_utils.MS2ScanData
+    """
+
+    scan_number, msn_level, retention_time_seconds, precursor_charge, precursor_mz, peak_count, peaks = row
+    peak_list_mz, peak_list_intensity = _decode_peaks(peaks, peak_count)
+
+    return spectr_utils.MS2ScanData(
+        scan_file_hash_key=spectr_file_id,
+        scan_number=scan_number,
+        msn_level=msn_level,
+        retention_time_seconds=retention_time_seconds,
+        precursor_charge=precursor_charge,
+        precursor_mz=precursor_mz,
+        peak_list_intensity=peak_list_intensity,
+        peak_list_mz=peak_list_mz
+    )
+
+
+@contextmanager
+def _pooled_connection():
+    """Check out a sqlite connection to the scan cache for the duration of a with block. An idle
+    connection of this process is reused if there is one. Once done, the connection is kept for reuse,
+    or closed if enough connections are already idle.
+
+    Returns:
+        generator: Yields a sqlite3.Connection
+    """
+
+    with _idle_connections_lock:
+        connection = _idle_connections.pop() if len(_idle_connections) > 0 else None
+
+    if connection is None:
+        connection = _create_connection()
+
+    try:
+        yield connection
+
+    finally:
+        with _idle_connections_lock:
+            keep_connection = len(_idle_connections) < _max_idle_connections
+            if keep_connection:
+                _idle_connections.append(connection)
+
+        if not keep_connection:
+            connection.close()
+
+
+def _create_connection():
+    """Open a sqlite connection to the scan cache, creating the database if necessary. The connection
+    may be used by any thread of this process, one thread at a time.
+
+    Returns:
+        sqlite3.Connection
+    """
+
+    cache_dir = os.getenv(__scan_cache_dir_env_key__)
+    if not os.path.isdir(cache_dir):
+        raise ValueError('Scan cache directory does not exist:', cache_dir)
+
+    connection = sqlite3.connect(os.path.join(cache_dir, _cache_db_filename), timeout=60, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+
+    with connection:
+        connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS scans (
+                spectr_file_id TEXT NOT NULL,
+                scan_number INTEGER NOT NULL,
+                msn_level INTEGER,
+                retention_time_seconds REAL,
+                precursor_charge INTEGER,
+                precursor_mz REAL,
+                peak_count INTEGER NOT NULL,
+                peaks BLOB NOT NULL,
+                byte_size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS scans_file_scan_idx ON scans (spectr_file_id, scan_number);
+            CREATE INDEX IF NOT EXISTS scans_last_access_idx ON scans (last_access);
+
+            CREATE TABLE IF NOT EXISTS cache_info (total_bytes INTEGER NOT NULL);
+            INSERT INTO cache_info (total_bytes) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM cache_info);
+
+            CREATE TRIGGER IF NOT EXISTS scans_insert_size AFTER INSERT ON scans BEGIN
+                UPDATE cache_info SET total_bytes = total_bytes + NEW.byte_size;
+            END;
+            CREATE TRIGGER IF NOT EXISTS scans_delete_size AFTER DELETE ON scans BEGIN
+                UPDATE cache_info SET total_bytes = total_bytes - OLD.byte_size;
+            END;
+            """
+        )
+
+    return connection
@@ -15,9 +15,62 @@
 #   limitations under the License.
 
 import os
+import time
+import codecs
+import random
+import threading
 import requests
 import json
-from . import __spectr_get_scan_data_env_key__
+from array import array
+from requests.adapters import HTTPAdapter
+from . import __spectr_get_scan_data_env_key__, __spectr_pool_size_env_key__, __spectr_connect_timeout_env_key__, \
+    __spectr_read_timeout_env_key__, __spectr_default_pool_size__, __spectr_default_connect_timeout__, \
+    __spectr_default_read_timeout__, __spectr_min_batch_size_env_key__, __spectr_max_batch_size_env_key__, \
+    __spectr_target_batch_seconds_env_key__, __spectr_target_batch_mb_env_key__, \
+    __spectr_default_target_batch_seconds__, __spectr_default_target_batch_mb__, __spectr_max_retries_env_key__, \
+    __spectr_retry_backoff_seconds_env_key__, __spectr_default_max_retries__, \
+    __spectr_default_retry_backoff_seconds__, metrics
+
+# one pooled session per process, mpire workers must not share connections with their parent
+_session_holder = {'pid': None, 'session': None}
+_session_lock = threading.Lock()
+
+
+def _reset_session_after_fork():
+    """Start a forked process (e.g. an mpire worker) with a new session lock and no session. Another thread
+    of the parent may have held the lock at the time of the fork, and would never release it in the child."""
+
+    global _session_lock
+
+    _session_lock = threading.Lock()
+    _session_holder['pid'] = None
+    _session_holder['session'] = None
+
+
+os.register_at_fork(after_in_child=_reset_session_after_fork)
+
+# number of bytes to read at a time when streaming a response from spectr
+_stream_chunk_size = 65536
+
+_json_decoder = json.JSONDecoder()
+
+
+class SpectrServerError(ValueError):
+    """Raised for a 502, 503 or 504 response from spectr, which may succeed if tried again. Other 5xx
+    responses, e.g. for an invalid spectr file id, are not retried."""
+
+
+# response status codes of spectr (or a proxy in front of it) being briefly unavailable
+_transient_status_codes = (502, 503, 504)
+
+
+# failures of a request to spectr that may succeed if the request is tried again
+_retryable_exceptions = (
+    SpectrServerError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError
+)
 
 
 def generate_ob_for_post_request(scan_file_hash_key, scan_numbers):
@@ -47,19 +100,304 @@ def get_scan_data_for_scan_numbers(scan_file_hash_key, scan_numbers):
         list: An array of MS2ScanData objects, one for each scan
     """
 
+    return list(iterate_scan_data_for_scan_numbers(scan_file_hash_key, scan_numbers))
+
+
+def iterate_scan_data_for_scan_numbers(scan_file_hash_key, scan_numbers, batch_sizer=None):
+    """Get scan data from spectr for the given scan numbers and file hash. The response is parsed
+    one scan at a time as it streams in, so only one decoded scan is held in memory at a time.
+    If the request fails with a 502, 503 or 504 error, a timeout or a lost connection, the scans not yet
+    read are requested again as two smaller requests, after a backoff, up to the configured number of
+    retries.
+
+    Parameters:
+        scan_file_hash_key (string): The spectral file hash key for the spectral file
+        scan_numbers (list): The scan numbers in the file we want to get
+        batch_sizer (SpectrBatchSizer): The batch sizer to record each request with, or None
+
+    Returns:
+        generator: Yields a MS2ScanData object for each scan, in the order returned by spectr
+    """
+
     # request the scan data from spectr
     spectr_url = os.environ.get(__spectr_get_scan_data_env_key__)
     if spectr_url is None:
         raise ValueError('No ' + __spectr_get_scan_data_env_key__ + ' env variable is set.')
 
+    yield from _iterate_scan_data_with_retries(spectr_url, scan_file_hash_key, scan_numbers, batch_sizer, 0)
+
+
+def _iterate_scan_data_with_retries(spectr_url, scan_file_hash_key, scan_numbers, batch_sizer, retry_count):
+    """Request the scans from spectr, splitting the scans not yet read into two requests and trying
+    again after a failure that may be transient, see iterate_scan_data_for_scan_numbers
+
+    Returns:
+        generator: Yields a MS2ScanData object for each scan
+    """
+
+    read_scan_numbers = set()
+
+    try:
+        for ms2_scan in _iterate_scan_data_for_request(spectr_url, scan_file_hash_key, scan_numbers, batch_sizer):
+            read_scan_numbers.add(ms2_scan.scan_number)
+            yield ms2_scan
+
+        return
+
+    except _retryable_exceptions as e:
+        if retry_count >= get_spectr_max_retries():
+            raise
+
+        print('Retrying request to spectr for', len(scan_numbers) - len(read_scan_numbers), 'scans of',
+              scan_file_hash_key, 'after error:', e)
+
+        metrics.increment_counter(
+            'blib_export_spectr_retries_total',
+            labels={'reason': 'server error' if isinstance(e, SpectrServerError) else 'timeout or connection'}
+        )
+
+    if batch_sizer is not None:
+        batch_sizer.record_failure()
+
+    time.sleep(get_spectr_retry_backoff_seconds(retry_count))
+
+    remaining_scan_numbers = [scan_number for scan_number in scan_numbers if scan_number not in read_scan_numbers]
+    split_index = (len(remaining_scan_numbers) + 1) // 2
+
+    for retry_scan_numbers in (remaining_scan_numbers[:split_index], remaining_scan_numbers[split_index:]):
+        if len(retry_scan_numbers) > 0:
+            yield from _iterate_scan_data_with_retries(spectr_url, scan_file_hash_key, retry_scan_numbers,
+                                                       batch_sizer, retry_count + 1)
+
+
+def _iterate_scan_data_for_request(spectr_url, scan_file_hash_key, scan_numbers, batch_sizer):
+    """Send a single request to spectr for the scans and parse the response as it streams in
+
+    Returns:
+        generator: Yields a MS2ScanData object for each scan
+    """
+
     # the xml we're sending in the post request
     ob_for_post = generate_ob_for_post_request(scan_file_hash_key, scan_numbers)
+    metrics.observe_histogram('blib_export_spectr_batch_scans', len(scan_numbers))
 
     # send the post request
+    start_time = time.perf_counter()
     headers = {'Content-Type': 'application/json'}
-    response = requests.post(spectr_url, json=ob_for_post, headers=headers)
+    response = get_spectr_session().post(
+        spectr_url,
+        json=ob_for_post,
+        headers=headers,
+        timeout=get_spectr_timeout(),
+        stream=True
+    )
+
+    # always close the response so the connection is returned to the pool
+    try:
+        if response.status_code != 200:
+            handle_spectr_error(response, scan_file_hash_key)
+
+        scan_count = 0
+
+        for ms2_scan in iterate_spectr_success(response, scan_file_hash_key):
+            scan_count += 1
+            yield ms2_scan
+
+        # only batches that were read to the end are recorded
+        batch_seconds = time.perf_counter() - start_time
+        metrics.observe_histogram('blib_export_spectr_batch_seconds', batch_seconds)
+        metrics.observe_histogram('blib_export_spectr_batch_bytes', response.raw.tell())
+        metrics.increment_counter('blib_export_spectr_scans_fetched_total', scan_count)
+
+        if batch_sizer is not None:
+            batch_sizer.record_batch(len(scan_numbers), batch_seconds, response.raw.tell())
+
+    finally:
+        response.close()
+
+
+def get_spectr_session():
+    """Get the requests.Session used to talk to spectr in this process. The session keeps
+    connections alive and reuses them across batches and requests. It is safe to share between
+    threads; a new session is created in each new process.
+
+    Returns:
+        requests.Session
+    """
+
+    with _session_lock:
+        if _session_holder['pid'] != os.getpid():
+            pool_size = _get_int_env_var(__spectr_pool_size_env_key__, __spectr_default_pool_size__)
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+            _session_holder['pid'] = os.getpid()
+            _session_holder['session'] = session
+
+        return _session_holder['session']
+
+
+def get_spectr_timeout():
+    """Get the (connect, read) timeout in seconds to use for requests to spectr
+
+    Returns:
+        tuple: (connect timeout, read timeout)
+    """
+
+    return (
+        _get_int_env_var(__spectr_connect_timeout_env_key__, __spectr_default_connect_timeout__),
+        _get_int_env_var(__spectr_read_timeout_env_key__, __spectr_default_read_timeout__)
+    )
+
+
+def get_spectr_max_retries():
+    """Get the number of times a failed request to spectr is retried. Defaults to 3 if no env var is set
+
+    Returns:
+        int
+    """
+
+    max_retries = _get_int_env_var(__spectr_max_retries_env_key__, __spectr_default_max_retries__)
+
+    if max_retries < 0:
+        raise ValueError('Got negative value for env var:', __spectr_max_retries_env_key__)
+
+    return max_retries
+
+
+def get_spectr_retry_backoff_seconds(retry_count):
+    """Get the time to wait before retrying a failed request to spectr. The time doubles with each
+    retry of the same scans, and half of it is random, so requests that failed together are not all
+    retried at the same moment.
+
+    Parameters:
+        retry_count (int): The number of times the scans have been retried already
+
+    Returns:
+        float: The time to wait, in seconds
+    """
+
+    backoff_seconds = float(os.getenv(__spectr_retry_backoff_seconds_env_key__,
+                                      __spectr_default_retry_backoff_seconds__)) * 2 ** retry_count
+
+    return backoff_seconds / 2 + random.uniform(0, backoff_seconds / 2)
+
+
+def create_batch_sizer(batch_size):
+    """Create the batch sizer for the requests to spectr for one scan file, with the configured bounds
+    and targets
+
+    Parameters:
+        batch_size (int): The number of scans in the first batch, SPECTR_BATCH_SIZE
+
+    Returns:
+        SpectrBatchSizer
+    """
+
+    min_batch_size = _get_int_env_var(__spectr_min_batch_size_env_key__, batch_size)
+    max_batch_size = _get_int_env_var(__spectr_max_batch_size_env_key__, batch_size)
+
+    if min_batch_size < 1:
+        raise ValueError('Got value less than 1 for env var:', __spectr_min_batch_size_env_key__)
 
-    return parse_spectr_response(response, scan_file_hash_key)
+    if max_batch_size < min_batch_size:
+        raise ValueError('Must not be less than ' + __spectr_min_batch_size_env_key__ + ':',
+                         __spectr_max_batch_size_env_key__)
+
+    return SpectrBatchSizer(
+        batch_size,
+        min_batch_size,
+        max_batch_size,
+        float(os.getenv(__spectr_target_batch_seconds_env_key__, __spectr_default_target_batch_seconds__)),
+        float(os.getenv(__spectr_target_batch_mb_env_key__, __spectr_default_target_batch_mb__)) * 1024 * 1024
+    )
+
+
+class SpectrBatchSizer:
+    """Chooses the number of scans to request from spectr at a time for one scan file. After each
+    request, the batch size moves toward the size expected to take the target time and to give the
+    target response size, at most doubling or halving at a time. The batch size halves after a failed
+    request. It always stays within the configured bounds. Safe to share between threads."""
+
+    def __init__(self, batch_size, min_batch_size, max_batch_size, target_seconds, target_bytes):
+        """Create a SpectrBatchSizer object
+
+        Parameters:
+            batch_size (int): The number of scans in the first batch
+            min_batch_size (int): The smallest batch size to use
+            max_batch_size (int): The largest batch size to use
+            target_seconds (float): The time to aim for in each request
+            target_bytes (float): The response size to aim for in each request
+
+        Returns:
+            SpectrBatchSizer object
+        """
+        self._min_batch_size = min_batch_size
+        self._max_batch_size = max_batch_size
+        self._target_seconds = target_seconds
+        self._target_bytes = target_bytes
+        self._batch_size = self._clamp(batch_size)
+        self._lock = threading.Lock()
+
+    @property
+    def batch_size(self):
+        """The number of scans to request in the next batch"""
+        return self._batch_size
+
+    def record_batch(self, scan_count, seconds, byte_count):
+        """Adjust the batch size after a request that was read to the end
+
+        Parameters:
+            scan_count (int): The number of scans requested
+            seconds (float): The time from sending the request to reading the end of the response
+            byte_count (int): The size of the response
+
+        Returns:
+            NoneType
+        """
+
+        if scan_count < 1:
+            return
+
+        best_batch_size = min(
+            self._target_seconds * scan_count / max(seconds, 1e-6),
+            self._target_bytes * scan_count / max(byte_count, 1)
+        )
+
+        with self._lock:
+            best_batch_size = min(max(best_batch_size, self._batch_size / 2), self._batch_size * 2)
+            self._batch_size = self._clamp(int(best_batch_size))
+
+    def record_failure(self):
+        """Halve the batch size after a failed request
+
+        Returns:
+            NoneType
+        """
+
+        with self._lock:
+            self._batch_size = self._clamp(self._batch_size // 2)
+
+    def _clamp(self, batch_size):
+        return min(max(batch_size, self._min_batch_size), self._max_batch_size)
+
+
+def _get_int_env_var(env_key, default_value):
+    """Get the value of the given env var as an int, or the default value if it is not set
+
+    Returns:
+        int
+    """
+
+    value = os.getenv(env_key)
+
+    if value is None:
+        return default_value
+
+    return int(value)
 
 
 def parse_spectr_response(response, scan_file_hash_key):
@@ -115,51 +453,186 @@ def handle_spectr_success(response, scan_file_hash_key):
         list: An array of MS2ScanData objects, one for each scan
     """
 
-    ms2_scan_data_objects = []
+    return list(iterate_spectr_success(response, scan_file_hash_key))
 
-    response_ob = json.loads(response.text)
 
-    if 'scans' not in response_ob:
-        raise ValueError('Got spectr success, but found no scan elements in response', response.content)
+def iterate_spectr_success(response, scan_file_hash_key):
+    """Parse a response that is a spectr success one scan at a time, as the response body
+    is read. See handle_spectr_success for the format of the response.
 
-    scans = response_ob['scans']
+    Parameters:
+        response (requests.Response): The requests.Response from the spectr get data query
+        scan_file_hash_key (string): The spectral file hash key for the spectral file
+
+    Returns:
+        generator: Yields a MS2ScanData object for each scan
+    """
 
-    if len(scans) < 1:
-        raise ValueError('Got spectr success, but found no scan elements in response', response.content)
+    found_scans = False
+    reader = _JSONStreamReader(response.iter_content(chunk_size=_stream_chunk_size))
 
-    # parse each scan element, add it to the list of MS2ScanData objects we're returning
-    for scan_ob in scans:
-        msn_level = scan_ob['level']
-        scan_number = scan_ob['scanNumber']
-        retention_time_seconds = scan_ob['retentionTime']
-        precursor_charge = scan_ob['precursorCharge']
-        precursor_mz = scan_ob['precursor_M_Over_Z']
-        peak_list_intensity = []
-        peak_list_mz = []
+    for scan_ob in _iterate_scan_obs_from_json_stream(reader):
+        found_scans = True
+        yield _build_ms2_scan_data_from_scan_ob(scan_ob, scan_file_hash_key)
 
-        peaks = scan_ob['peaks']
+    if not found_scans:
+        raise ValueError('Got spectr success, but found no scan elements in response for spectr file ' +
+                         scan_file_hash_key)
 
-        if peaks is None or len(peaks) < 1:
-            raise ValueError('Found no peaks in scan ' + str(scan_number) + ' for spectr file ' + scan_file_hash_key)
 
-        for peak_ob in peaks:
-            peak_list_intensity.append(peak_ob['intensity'])
-            peak_list_mz.append(peak_ob['mz'])
+def _build_ms2_scan_data_from_scan_ob(scan_ob, scan_file_hash_key):
+    """Build a MS2ScanData object from a single decoded scan element of a spectr response,
+    copying the peaks into compact arrays of doubles
 
-        ms2_scan_data = MS2ScanData(
-            scan_file_hash_key=scan_file_hash_key,
-            scan_number=scan_number,
-            msn_level=msn_level,
-            precursor_charge=precursor_charge,
-            precursor_mz=precursor_mz,
-            retention_time_seconds=retention_time_seconds,
-            peak_list_intensity=peak_list_intensity,
-            peak_list_mz=peak_list_mz
-        )
+    Parameters:
+        scan_ob (dict): A decoded scan element
+        scan_file_hash_key (string): The spectral file hash key for the spectral file
+
+    Returns:
+        MS2ScanData
+    """
 
-        ms2_scan_data_objects.append(ms2_scan_data)
+    scan_number = scan_ob['scanNumber']
+    peaks = scan_ob['peaks']
 
-    return ms2_scan_data_objects
+    if peaks is None or len(peaks) < 1:
+        raise ValueError('Found no peaks in scan ' + str(scan_number) + ' for spectr file ' + scan_file_hash_key)
+
+    return MS2ScanData(
+        scan_file_hash_key=scan_file_hash_key,
+        scan_number=scan_number,
+        msn_level=scan_ob['level'],
+        precursor_charge=scan_ob['precursorCharge'],
+        precursor_mz=scan_ob['precursor_M_Over_Z'],
+        retention_time_seconds=scan_ob['retentionTime'],
+        peak_list_intensity=array('d', [peak_ob['intensity'] for peak_ob in peaks]),
+        peak_list_mz=array('d', [peak_ob['mz'] for peak_ob in peaks])
+    )
+
+
+def _iterate_scan_obs_from_json_stream(reader):
+    """Walk the top level object of a spectr response, yielding each element of the
+    'scans' array as it is decoded. All other top level values are decoded and discarded.
+
+    Parameters:
+        reader (_JSONStreamReader): Reader positioned at the start of the response
+
+    Returns:
+        generator: Yields a dict for each scan element
+    """
+
+    reader.expect('{')
+
+    if reader.peek() == '}':
+        return
+
+    while True:
+        key = reader.decode_value()
+        reader.expect(':')
+
+        if key == 'scans' and reader.peek() == '[':
+            reader.expect('[')
+
+            if reader.peek() == ']':
+                reader.expect(']')
+            else:
+                while True:
+                    yield reader.decode_value()
+
+                    if reader.peek() == ',':
+                        reader.expect(',')
+                    else:
+                        reader.expect(']')
+                        break
+        else:
+            reader.decode_value()
+
+        if reader.peek() == ',':
+            reader.expect(',')
+        else:
+            reader.expect('}')
+            return
+
+
+class _JSONStreamReader:
+    """Incrementally decodes JSON values from an iterator of bytes, keeping only the
+    undecoded remainder of the stream in memory"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        self._exhausted = False
+
+    def peek(self):
+        """Return the next non-whitespace character without consuming it, None at the end of the stream"""
+
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in ' \t\n\r':
+                self._pos += 1
+
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+
+            if not self._read_more(_stream_chunk_size):
+                return None
+
+    def expect(self, char):
+        """Consume the next non-whitespace character, which must be char"""
+
+        found = self.peek()
+        if found != char:
+            raise ValueError('Error parsing spectr response. Expected ' + repr(char) + ', found ' + repr(found))
+
+        self._pos += 1
+
+    def decode_value(self):
+        """Decode and consume the next complete JSON value"""
+
+        if self.peek() is None:
+            raise ValueError('Error parsing spectr response. Unexpected end of response.')
+
+        while True:
+            try:
+                value, end = _json_decoder.raw_decode(self._buffer, self._pos)
+
+                # a number at the very end of the buffer may continue in the next chunk
+                if end < len(self._buffer) or self._exhausted:
+                    self._pos = end
+                    return value
+
+            except json.JSONDecodeError:
+                if self._exhausted:
+                    raise
+
+            # read at least as much as is pending, so re-decoding a large value is amortized linear
+            self._read_more(max(_stream_chunk_size, len(self._buffer) - self._pos))
+
+    def _read_more(self, min_chars):
+        """Append at least min_chars to the buffer (unless the stream ends), discarding
+        consumed text. Returns False if nothing could be read."""
+
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+        chars_read = 0
+
+        while chars_read < min_chars:
+            chunk = next(self._chunks, None)
+
+            if chunk is None:
+                text = self._text_decoder.decode(b'', final=True)
+                self._exhausted = True
+            else:
+                text = self._text_decoder.decode(chunk)
+
+            self._buffer += text
+            chars_read += len(text)
+
+            if self._exhausted:
+                break
+
+        return chars_read > 0
 
 
 def handle_spectr_error(response, scan_file_hash_key):
@@ -173,6 +646,9 @@ def handle_spectr_error(response, scan_file_hash_key):
         NoneType
     """
 
+    if response.status_code in _transient_status_codes:
+        raise SpectrServerError('Got ' + str(response.status_code) + ' error. Spectr may be unavailable.')
+
     if str(response.status_code).startswith('5'):
         raise ValueError('Got ' + str(response.status_code) + ' error. May be an invalid spectr file id.')
 
@@ -187,7 +663,34 @@ def handle_spectr_error(response, scan_file_hash_key):
     raise ValueError(error_text)
 
 
+def _as_peak_array(values):
+    """Return the given peak values as an array('d'), without copying if they already are one
+
+    Returns:
+        array
+    """
+
+    if isinstance(values, array) and values.typecode == 'd':
+        return values
+
+    return array('d', values)
+
+
 class MS2ScanData:
+    """Scan data for a single scan. Peaks are held in compact array('d') buffers rather than
+    lists of floats, and __slots__ avoids a per-object __dict__."""
+
+    __slots__ = (
+        '_scan_file_hash_key',
+        '_scan_number',
+        '_msn_level',
+        '_precursor_charge',
+        '_precursor_mz',
+        '_retention_time_seconds',
+        '_peak_list_intensity',
+        '_peak_list_mz'
+    )
+
     def __init__(self,
                  scan_file_hash_key,
                  scan_number,
@@ -205,8 +708,8 @@ class MS2ScanData:
             retention_time_seconds (float): Retention time of this scan in seconds
             precursor_charge (int): Estimated charge of precursor ion
             precursor_mz (float): Measured m/z of precursor ion
-            peak_list_intensity (list): An array of peak list intensities
-            peak_list_mz (list): An array of peak list mz values
+            peak_list_intensity (array): An array of peak list intensities, lists are converted to array('d')
+            peak_list_mz (array): An array of peak list mz values, lists are converted to array('d')
 
         Returns:
             Populated MS2ScanData object
@@ -217,8 +720,8 @@ class MS2ScanData:
         self._precursor_charge = precursor_charge
         self._precursor_mz = precursor_mz
         self._retention_time_seconds = retention_time_seconds
-        self._peak_list_intensity = peak_list_intensity
-        self._peak_list_mz = peak_list_mz
+        self._peak_list_intensity = _as_peak_array(peak_list_intensity)
+        self._peak_list_mz = _as_peak_array(peak_list_mz)
 
     @property
     def scan_file_hash_key(self):
@@ -274,7 +777,7 @@ class MS2ScanData:
 
     @peak_list_intensity.setter
     def peak_list_intensity(self, value):
-        self._peak_list_intensity = value
+        self._peak_list_intensity = _as_peak_array(value)
 
     @property
     def peak_list_mz(self):
@@ -282,4 +785,4 @@ class MS2ScanData:
 
     @peak_list_mz.setter
     def peak_list_mz(self, value):
-        self._peak_list_mz = value
+        self._peak_list_mz = _as_peak_array(value)
@@ -15,9 +15,11 @@
 #   limitations under the License.
 
 import os.path
+import shutil
 
 
-def write_psm_to_ssl_file(ssl_file, ms2_filename, scan_number, charge, sequence, retention_time_minutes):
+def write_psm_to_ssl_file(ssl_file, ms2_filename, scan_number, charge, sequence, retention_time_minutes,
+                          score_type='UNKNOWN', score=0.0):
     """Create a psm entry to the ssl file.
 
     Returns:
@@ -29,13 +31,34 @@ def write_psm_to_ssl_file(ssl_file, ms2_filename, scan_number, charge, sequence,
         str(scan_number) + "\t" +
         str(charge) + "\t" +
         str(sequence) + "\t" +
-        "UNKNOWN\t" +
-        "0.0\t" +
+        score_type + "\t" +
+        str(score) + "\t" +
         str(retention_time_minutes) +
         "\n"
     )
 
 
+def concatenate_ssl_files(path_to_directory, filename, input_filenames):
+    """Create a new .ssl file at path_to_directory listing the PSMs of all of the given .ssl files,
+    in the order given
+
+    Returns:
+        NoneType
+    """
+
+    ssl_file = initialize_ssl_file(path_to_directory, filename)
+
+    try:
+        for input_filename in input_filenames:
+            with open(os.path.join(path_to_directory, input_filename), 'r') as input_ssl_file:
+                # skip the header line
+                input_ssl_file.readline()
+                shutil.copyfileobj(input_ssl_file, ssl_file)
+
+    finally:
+        close_ssl_file(ssl_file)
+
+
 def initialize_ssl_file(path_to_directory, filename):
     """Create a new .ssl file at path_to_directory
 
@@ -0,0 +1,172 @@
+"""Per-request traces of the time spent in each stage of processing, written in the Chrome
+trace-event format (viewable in chrome://tracing or Perfetto)"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import json
+import time
+import threading
+from . import __request_trace_dir_env_key__
+
+# the number of slowest scan files listed in a trace summary
+_summary_scan_file_count = 3
+
+
+class RequestTrace:
+    """The spans recorded while processing one request. Spans are recorded with wall clock times
+    and the process and thread ids they ran in, so spans recorded in worker processes can be added
+    to the trace of the request. Spans on the same thread nest by time, forming the span tree."""
+
+    def __init__(self):
+        """Create an empty RequestTrace
+
+        Returns:
+            Empty RequestTrace object
+        """
+        self._events = []
+        self._lock = threading.Lock()
+
+    def add_span(self, name, category, start_time, args=None):
+        """Record a span that started at start_time and ends now
+
+        Parameters:
+            name (string): The name of the span
+            category (string): The kind of span: 'request', 'stage', 'scan file' or 'batch'
+            start_time (float): When the span started, from time.time()
+            args (dict): Any details to show with the span, or None
+
+        Returns:
+            NoneType
+        """
+
+        end_time = time.time()
+
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': round(start_time * 1000000),
+            'dur': round((end_time - start_time) * 1000000),
+            'pid': os.getpid(),
+            'tid': threading.get_ident()
+        }
+
+        if args is not None:
+            event['args'] = args
+
+        with self._lock:
+            self._events.append(event)
+
+    def add_events(self, events):
+        """Add spans recorded by another RequestTrace, e.g. in a worker process
+
+        Parameters:
+            events (list): The events, from get_events
+
+        Returns:
+            NoneType
+        """
+
+        with self._lock:
+            self._events.extend(events)
+
+    def get_events(self):
+        """Get the recorded spans as Chrome trace events
+
+        Returns:
+            list: Chrome trace 'X' (complete) events
+        """
+
+        with self._lock:
+            return list(self._events)
+
+
+def is_trace_file_enabled():
+    """Determine whether trace files are written. Enabled if the trace directory env var is set.
+
+    Returns:
+        bool
+    """
+    return os.getenv(__request_trace_dir_env_key__) is not None
+
+
+def write_trace_file(request_id, trace):
+    """Write the trace of a request to '<request id>.trace.json' in the trace directory
+
+    Parameters:
+        request_id (string): The request id
+        trace (RequestTrace): The trace of the request
+
+    Returns:
+        string: Full path to the written trace file
+    """
+
+    trace_dir = os.getenv(__request_trace_dir_env_key__)
+    if not os.path.isdir(trace_dir):
+        raise ValueError('Trace directory does not exist:', trace_dir)
+
+    trace_path = os.path.join(trace_dir, request_id + '.trace.json')
+
+    with open(trace_path, 'w') as trace_file:
+        json.dump({'traceEvents': trace.get_events(), 'displayTimeUnit': 'ms'}, trace_file)
+
+    return trace_path
+
+
+def summarize_trace(trace):
+    """Summarize a trace for the status response: the total time, the time in each stage of the
+    request, and the slowest scan files
+
+    Parameters:
+        trace (RequestTrace): The trace of the request
+
+    Returns:
+        dict: {
+            'total_seconds': <seconds>,
+            'stage_seconds': {<stage name>: <seconds>},
+            'slowest_scan_files': [{'spectr_file_id': <id>, 'seconds': <seconds>, 'pid': <process id>}]
+        }
+    """
+
+    events = trace.get_events()
+    stage_seconds = {}
+    scan_file_events = []
+    total_seconds = 0.0
+
+    for event in events:
+        seconds = event['dur'] / 1000000
+
+        if event['cat'] == 'request':
+            total_seconds = seconds
+        elif event['cat'] == 'stage':
+            stage_seconds[event['name']] = round(stage_seconds.get(event['name'], 0.0) + seconds, 3)
+        elif event['cat'] == 'scan file':
+            scan_file_events.append(event)
+
+    scan_file_events.sort(key=lambda scan_file_event: scan_file_event['dur'], reverse=True)
+
+    return {
+        'total_seconds': round(total_seconds, 3),
+        'stage_seconds': stage_seconds,
+        'slowest_scan_files': [
+            {
+                'spectr_file_id': scan_file_event['args']['spectr_file_id'],
+                'seconds': round(scan_file_event['dur'] / 1000000, 3),
+                'pid': scan_file_event['pid']
+            }
+            for scan_file_event in scan_file_events[:_summary_scan_file_count]
+        ]
+    }
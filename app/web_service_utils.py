@@ -14,8 +14,130 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import os
+import time
+from . import __blib_dir_env_key__, __result_retention_seconds_env_key__, __default_result_retention_seconds__, \
+    general_utils, request_handler
+from .request_store import SQLiteMapping
+
+
+def submit_conversion_request(project_id, spectral_data, request_hash, request_queue, request_status_dict,
+                              request_hash_dict):
+    """Add a conversion request to the request queue, unless an identical request (same project id
+    and spectral data) is already queued or processing, or completed recently enough that its .blib
+    can be reused. In that case the id of the existing request is returned and no new work is done.
+    An identical request that failed, but whose work directory was kept, is queued again under its
+    own id, so it resumes from its checkpoint. The request lock must be held, so a request processor
+    does not take a newly queued request before its status is written.
 
-def _generate_json_for_status_request(request_id, status_text, message_text=None):
+    Parameters:
+        project_id (int): The limelight project id
+        spectral_data (list): The spectral_data of the request, a list of dicts, one per scan file
+        request_hash (string): The hash of the request, see general_utils.hash_request_data
+        request_queue (RequestQueue): The request queue of dicts: {'id': request_id, 'data': xml_request}
+        request_status_dict (dict): The dict that stores the status of requests
+        request_hash_dict (dict): The dict of request hash => request id
+
+    Returns:
+        tuple: (request id, bool: whether the request id is shared with an existing request)
+    """
+
+    shared_request_id = get_shared_request_id(request_hash, request_status_dict, request_hash_dict)
+    if shared_request_id is not None and request_status_dict[shared_request_id]['status'] == 'error':
+        request_queue.append({'id': shared_request_id, 'data': spectral_data, 'project_id': project_id})
+        request_status_dict[shared_request_id] = {
+            'project_id': project_id,
+            'status': 'queued',
+            'message': None,
+            'request_hash': request_hash,
+            'subscriber_count': request_status_dict[shared_request_id]['subscriber_count'] + 1
+        }
+        return shared_request_id, True
+
+    if shared_request_id is not None:
+        request_handler.update_request_status(
+            request_status_dict,
+            shared_request_id,
+            subscriber_count=request_status_dict[shared_request_id]['subscriber_count'] + 1
+        )
+        return shared_request_id, True
+
+    request_id = general_utils.generate_request_id()
+
+    # queue the request first: if it can't be queued (e.g. its cost can't be estimated), no status or
+    # hash entry is left behind for it
+    request_queue.append({'id': request_id, 'data': spectral_data, 'project_id': project_id})
+
+    request_status_dict[request_id] = {
+        'project_id': project_id,
+        'status': 'queued',
+        'message': None,
+        'request_hash': request_hash,
+        'subscriber_count': 1
+    }
+    request_hash_dict[request_hash] = request_id
+
+    return request_id, False
+
+
+def get_shared_request_id(request_hash, request_status_dict, request_hash_dict):
+    """Get the id of an existing request with the given hash that a new request can share: one that is
+    queued or processing, that succeeded within the retention time and whose .blib still exists, or
+    that failed and can be resumed from its work directory
+
+    Parameters:
+        request_hash (string): The hash of the new request, see general_utils.hash_request_data
+        request_status_dict (dict): The dict that stores the status of requests
+        request_hash_dict (dict): The dict of request hash => request id
+
+    Returns:
+        string: The id of the request to share, or None
+    """
+
+    request_id = request_hash_dict.get(request_hash)
+    if request_id is None or request_id not in request_status_dict:
+        return None
+
+    status_entry = request_status_dict[request_id]
+
+    if status_entry['status'] in ('queued', 'processing'):
+        return request_id
+
+    if status_entry['status'] == 'success' and is_result_reusable(status_entry):
+        return request_id
+
+    if status_entry['status'] == 'error' and request_handler.is_request_resumable(request_id):
+        return request_id
+
+    return None
+
+
+def is_result_reusable(status_entry):
+    """Determine whether the .blib of a successful request may be reused for a new request
+
+    Parameters:
+        status_entry (dict): The entry for the request in the request_status_dict
+
+    Returns:
+        bool
+    """
+
+    retention_seconds = float(os.getenv(__result_retention_seconds_env_key__, __default_result_retention_seconds__))
+
+    if retention_seconds <= 0 or 'completed_at' not in status_entry:
+        return False
+
+    if time.time() - status_entry['completed_at'] > retention_seconds:
+        return False
+
+    blib_dir = os.getenv(__blib_dir_env_key__)
+    if blib_dir is None:
+        return False
+
+    return os.path.exists(os.path.join(blib_dir, str(status_entry['project_id']), status_entry['message']))
+
+
+def _generate_json_for_status_request(request_id, status_text, message_text=None, trace_summary=None):
     """Generate the JSON to return for request status of blib conversion
 
     Generated JSON in the form of:
@@ -24,12 +146,14 @@ def _generate_json_for_status_request(request_id, status_text, message_text=None
       'status': <status string>,
       'error_message': <optional, error message if status is error>
       'blib_file_name': <optional, the file name of the created blib file if success>
+      'trace_summary': <optional, time spent in each stage of processing, once the request is done>
     }
 
     Parameters:
         request_id (string): The unique key for the request
         status_text (string): The status text (e.g. 'success', 'error', 'queued', 'not found')
         message_text (string): The path to the blib file (if success), error message if error, otherwise None
+        trace_summary (dict): The summary of the trace of the request, see trace_utils.summarize_trace, or None
 
     Returns:
         dict: A dict representing the assembled JSON object
@@ -49,6 +173,9 @@ def _generate_json_for_status_request(request_id, status_text, message_text=None
     elif status_text == 'processing' and message_text is not None:
         response_json['end_user_message'] = message_text
 
+    if trace_summary is not None:
+        response_json['trace_summary'] = trace_summary
+
     return response_json
 
 
@@ -57,7 +184,7 @@ def get_json_for_status_request(status_request_data, request_queue, request_stat
 
     Parameters:
         status_request_data (dict): A string containing the request as json
-        request_queue (list): The request queue, an array of dicts: {'id': request_id, 'data': xml_request}
+        request_queue (RequestQueue): The request queue of dicts: {'id': request_id, 'data': xml_request}
         request_status_dict (dict): A dict containing status information
 
     Returns:
@@ -70,23 +197,24 @@ def get_json_for_status_request(status_request_data, request_queue, request_stat
     if request_id not in request_status_dict:
         return _generate_json_for_status_request(request_id, 'not found')
 
-    if project_id != request_status_dict[request_id]['project_id']:
+    status_entry = request_status_dict[request_id]
+
+    if project_id != status_entry['project_id']:
         return _generate_json_for_status_request(request_id, 'error', 'Project id does not match.')
 
-    if request_status_dict[request_id]['status'] == 'queued':
-        queue_position = get_queue_position(request_id, request_queue)
-        request_status_dict[request_id]['message'] = str(queue_position)
+    message = status_entry['message']
+
+    if status_entry['status'] == 'queued':
+        message = str(get_queue_position(request_id, request_queue))
 
-    if request_status_dict[request_id]['status'] == 'processing':
-        if 'end_user_message' in request_status_dict[request_id]:
-            request_status_dict[request_id]['message'] = request_status_dict[request_id]['end_user_message']
-        else:
-            request_status_dict[request_id]['message'] = 'Processing request'
+    if status_entry['status'] == 'processing':
+        message = status_entry.get('end_user_message', 'Processing request')
 
     return _generate_json_for_status_request(
         request_id,
-        request_status_dict[request_id]['status'],
-        request_status_dict[request_id]['message']
+        status_entry['status'],
+        message,
+        status_entry.get('trace_summary')
     )
 
 
@@ -95,7 +223,7 @@ def get_queue_position(request_id, request_queue):
 
     Parameters:
         request_id (string): The request id
-        request_queue (list): The request queue, an array of dicts: {'id': request_id, 'data': xml_request}
+        request_queue (RequestQueue): The request queue of dicts: {'id': request_id, 'data': xml_request}
 
     Returns:
         int: The 1-based position of the request_id in the request queue
@@ -107,13 +235,43 @@ def get_queue_position(request_id, request_queue):
     raise ValueError('Did not find request in request queue')
 
 
-def cancel_conversion_request(cancel_request_data, request_queue, request_status_dict):
-    """Remove the supplied request_id from the request_queue and request_status_dict
+def get_gauges_for_metrics(request_queue, request_status_dict):
+    """Get the current queue depth, requests being processed and ms2 workers in use, to be exported
+    with the other metrics. The request lock must be held.
+
+    Parameters:
+        request_queue (RequestQueue): The request queue of dicts: {'id': request_id, 'data': xml_request}
+        request_status_dict (dict): The dict that stores the status of requests
+
+    Returns:
+        list: (name, help text, value) tuples, see metrics.render_metrics
+    """
+
+    if isinstance(request_status_dict, SQLiteMapping):
+        # counted by the indexed status column, the stored statuses are never all read
+        processing_count = request_status_dict.count_values_with('status', 'processing')
+    else:
+        processing_count = sum(
+            1 for status_entry in request_status_dict.values() if status_entry['status'] == 'processing'
+        )
+
+    return [
+        ('blib_export_queue_depth', 'Requests waiting to be processed.', len(request_queue)),
+        ('blib_export_requests_processing', 'Requests being processed.', processing_count),
+        ('blib_export_active_workers', 'Scan file workers in use across all requests.',
+         request_handler.ms2_worker_budget.get_in_use())
+    ]
+
+
+def cancel_conversion_request(cancel_request_data, request_queue, request_status_dict, request_hash_dict):
+    """Remove the supplied request_id from the request_queue and request_status_dict. If the request
+    is shared by other conversion requests, it is left in place for them.
 
     Parameters:
         cancel_request_data (dict): The cancel request: {'request_id': request_id, 'project_id': project_id}
-        request_queue (list): The request queue, an array of dicts: {'id': request_id, 'data': xml_request}
+        request_queue (RequestQueue): The request queue of dicts: {'id': request_id, 'data': xml_request}
         request_status_dict (dict): The dict that stores the status of requests
+        request_hash_dict (dict): The dict of request hash => request id
 
     Returns:
         dict: A simple dict in the form of {'cancel_message': <cancel message>}
@@ -128,21 +286,22 @@ def cancel_conversion_request(cancel_request_data, request_queue, request_status
     if project_id != request_status_dict[request_id]['project_id']:
         return {'cancel_message': 'Project id does not match.'}
 
-    # get index of request to remove
-    idx = 0
-    found = False
-    for request in request_queue:
-        if request['id'] == request_id:
-            found = True
-            break
+    status_entry = request_status_dict[request_id]
 
-        idx += 1
+    if status_entry['status'] == 'queued' and status_entry.get('subscriber_count', 1) > 1:
+        request_handler.update_request_status(
+            request_status_dict,
+            request_id,
+            subscriber_count=status_entry['subscriber_count'] - 1
+        )
+        return {'cancel_message': 'Removed.'}
 
-    if not found:
+    if not request_queue.remove(request_id):
         return {'cancel_message': 'Request id not found.'}
-    else:
-        request_queue.pop(idx)
 
     del request_status_dict[request_id]
 
+    if request_hash_dict.get(status_entry.get('request_hash')) == request_id:
+        del request_hash_dict[status_entry['request_hash']]
+
     return {'cancel_message': 'Removed.'}
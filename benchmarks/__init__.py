@@ -0,0 +1,31 @@
+"""Benchmarks of the export, run against local stand-ins for spectr, BlibBuild and BlibFilter"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import tempfile
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+stub_bin_dir = os.path.join(repo_dir, 'benchmarks', 'stub_bin')
+
+# app requires these when imported, so set them before any benchmark imports it. The end-to-end runs
+# set their own spectr URL and directories
+os.environ.setdefault('SPECTR_BATCH_SIZE', '100')
+os.environ.setdefault('WEBAPP_PORT', '0')
+os.environ.setdefault('SPECTR_GET_SCAN_DATA_URL', 'http://127.0.0.1/')
+os.environ.setdefault('APP_WORKDIR', tempfile.gettempdir())
+os.environ.setdefault('BLIB_DIR', tempfile.gettempdir())
+os.environ.setdefault('BLIB_BUILD_EXEC_PATH', os.path.join(stub_bin_dir, 'BlibBuild'))
+os.environ.setdefault('BLIB_FILTER_EXEC_PATH', os.path.join(stub_bin_dir, 'BlibFilter'))
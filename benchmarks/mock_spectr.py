@@ -0,0 +1,219 @@
+"""A local stand-in for spectr that serves synthetic scans in the getScanDataFromScanNumbers_JSON
+response format, with configurable peak counts, latency and error rate
+
+Run on its own with:
+    python -m benchmarks.mock_spectr --port 8080 --peaks 200 --latency 0.05
+"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# number of distinct peak lists generated for each peak count, shared between scans
+_peak_list_variant_count = 64
+
+
+class MockSpectrSettings:
+    """How the mock spectr server responds"""
+
+    __slots__ = ('peaks_per_scan', 'latency_seconds', 'latency_seconds_per_scan', 'error_rate', 'seed')
+
+    def __init__(self, peaks_per_scan=100, latency_seconds=0.0, latency_seconds_per_scan=0.0, error_rate=0.0,
+                 seed=1):
+        """Create a MockSpectrSettings object
+
+        Parameters:
+            peaks_per_scan (int): The number of peaks in each scan
+            latency_seconds (float): Time to wait before responding to each request
+            latency_seconds_per_scan (float): Additional time to wait for each scan requested
+            error_rate (float): Fraction of requests answered with a 503 error, between 0 and 1
+            seed (int): Seed for the random peaks and errors, so runs are repeatable
+
+        Returns:
+            Populated MockSpectrSettings object
+        """
+        self.peaks_per_scan = peaks_per_scan
+        self.latency_seconds = latency_seconds
+        self.latency_seconds_per_scan = latency_seconds_per_scan
+        self.error_rate = error_rate
+        self.seed = seed
+
+
+class MockSpectrServer:
+    """A mock spectr server running in a background thread"""
+
+    def __init__(self, settings, port=0):
+        """Start serving on 127.0.0.1:port, or a free port if port is 0
+
+        Parameters:
+            settings (MockSpectrSettings): How the server responds
+            port (int): The port to listen on
+
+        Returns:
+            Running MockSpectrServer object
+        """
+
+        self.settings = settings
+        self.request_count = 0
+        self.error_count = 0
+
+        self._random = random.Random(settings.seed)
+        self._lock = threading.Lock()
+        self._peak_lists = generate_peak_lists(settings.peaks_per_scan, settings.seed)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), _build_request_handler_class(self))
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        """The URL to use for SPECTR_GET_SCAN_DATA_URL"""
+        return 'http://127.0.0.1:' + str(self._server.server_port) + '/spectr/query/getScanDataFromScanNumbers_JSON'
+
+    def stop(self):
+        """Stop serving and wait for the server thread to exit"""
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def respond(self, request_ob):
+        """Get the status code and body to send for a decoded request
+
+        Parameters:
+            request_ob (dict): The decoded request, see spectr_utils.generate_ob_for_post_request
+
+        Returns:
+            tuple: (status code, response body as bytes)
+        """
+
+        scan_numbers = [int(scan_number) for scan_number in request_ob['scanNumbers']]
+
+        with self._lock:
+            self.request_count += 1
+            is_error = self._random.random() < self.settings.error_rate
+            if is_error:
+                self.error_count += 1
+
+        time.sleep(self.settings.latency_seconds + self.settings.latency_seconds_per_scan * len(scan_numbers))
+
+        if is_error:
+            return 503, b'Service Unavailable'
+
+        return 200, build_spectr_response_body(scan_numbers, self._peak_lists)
+
+
+def build_spectr_response_body(scan_numbers, peak_lists):
+    """Build the body of a successful spectr response for the given scans
+
+    Parameters:
+        scan_numbers (list): The scan numbers to include
+        peak_lists (list): JSON peak lists to choose from, see generate_peak_lists
+
+    Returns:
+        bytes: The response body
+    """
+
+    return (
+        '{"status_scanFileAPIKeyNotFound":null,"scans":[' +
+        ','.join(_format_scan(scan_number, peak_lists) for scan_number in scan_numbers) + ']}'
+    ).encode('utf-8')
+
+
+def _format_scan(scan_number, peak_lists):
+    return (
+        '{"level":2,"scanNumber":' + str(scan_number) +
+        ',"retentionTime":' + repr(scan_number * 0.25 + 0.4104105) +
+        ',"totalIonCurrent_ForScan":1.6223904E7,"ionInjectionTime":50.0,"isCentroid":1,"parentScanNumber":null'
+        ',"precursorCharge":' + str(2 + scan_number % 3) +
+        ',"precursor_M_Over_Z":' + repr(400 + (scan_number % 5000) * 0.2345678) +
+        ',"peaks":' + peak_lists[scan_number % len(peak_lists)] + '}'
+    )
+
+
+def generate_peak_lists(peaks_per_scan, seed):
+    """Generate JSON peak lists with peaks_per_scan peaks each, sorted by m/z
+
+    Parameters:
+        peaks_per_scan (int): The number of peaks in each peak list
+        seed (int): Seed for the random peaks
+
+    Returns:
+        list: JSON strings
+    """
+
+    peak_random = random.Random(seed)
+    peak_lists = []
+
+    for _ in range(_peak_list_variant_count):
+        peak_mzs = sorted(100 + peak_random.random() * 1900 for _ in range(peaks_per_scan))
+        peak_lists.append('[' + ','.join(
+            '{"mz":' + repr(peak_mz) + ',"intensity":' + repr(round(peak_random.expovariate(1e-4), 3)) + '}'
+            for peak_mz in peak_mzs
+        ) + ']')
+
+    return peak_lists
+
+
+def _build_request_handler_class(mock_server):
+    class MockSpectrRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            request_ob = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            status_code, body = mock_server.respond(request_ob)
+
+            self.send_response(status_code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MockSpectrRequestHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve synthetic scans in the spectr response format.')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--peaks', type=int, default=100, help='peaks per scan')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait for each request')
+    parser.add_argument('--latency-per-scan', type=float, default=0.0, help='seconds to wait for each scan')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with a 503')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    server = MockSpectrServer(
+        MockSpectrSettings(args.peaks, args.latency, args.latency_per_scan, args.error_rate, args.seed),
+        args.port
+    )
+    print('Serving mock spectr at:', server.url, flush=True)
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""End-to-end throughput benchmark. Runs process_request on synthetic requests of several shapes
+against the mock spectr server and the stub BlibBuild and BlibFilter executables, and reports scans
+per second, the time spent in each stage and peak memory use.
+
+Each run is done in a fresh process, so its peak memory use is its own. Settings such as
+MS2_MAX_THREADS and SPECTR_BATCH_SIZE (default 100) are taken from the environment, e.g.:
+    MS2_MAX_THREADS=4 SPECTR_BATCH_SIZE=200 python -m benchmarks.run_end_to_end --shapes many_files
+"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from benchmarks import repo_dir, stub_bin_dir
+from app import __spectr_batch_size_env_key__, __spectr_get_scan_data_env_key__, __workdir_env_key__, \
+    __blib_dir_env_key__, __blib_build_executable_path_env_key__, __blib_filter_executable_path_env_key__, \
+    __ms2_max_threads_env_key__, __ms2_max_total_threads_env_key__, __spectr_max_in_flight_env_key__, \
+    __ms2_write_queue_size_env_key__, __blib_build_engine_env_key__, __intermediate_spectrum_format_env_key__, \
+    request_handler
+from benchmarks.mock_spectr import MockSpectrServer, MockSpectrSettings
+
+# settings reported with the results
+_reported_env_keys = (
+    __ms2_max_threads_env_key__, __ms2_max_total_threads_env_key__, __spectr_batch_size_env_key__,
+    __spectr_max_in_flight_env_key__, __ms2_write_queue_size_env_key__, __blib_build_engine_env_key__,
+    __intermediate_spectrum_format_env_key__
+)
+
+# name => (scan files, PSMs per scan file, PSMs per scan, peaks per scan)
+request_shapes = {
+    'small': (2, 500, 1, 100),
+    'many_files': (20, 200, 1, 100),
+    'large_files': (2, 5000, 2, 100),
+    'high_res': (4, 1000, 1, 1000)
+}
+
+_peptide_sequences = ('PEPTIDEK', 'AVGLLSEEGR', 'MLSTDFCR', 'QWNEVLTK', 'TTSGVSLGR', 'YNCEEHLAR')
+
+
+def build_request_data(shape_name, seed=1):
+    """Build the request data for a synthetic request of the given shape
+
+    Parameters:
+        shape_name (string): A key of request_shapes
+        seed (int): Seed for the random PSMs, so runs are repeatable
+
+    Returns:
+        list: The parts of the conversion request for each scan file
+    """
+
+    file_count, psm_count, psms_per_scan, _ = request_shapes[shape_name]
+    psm_random = random.Random(seed)
+    request_data = []
+
+    for file_number in range(file_count):
+        psms = []
+
+        for psm_number in range(psm_count):
+            # spread the scans of the PSMs across the scan file, as in a real search
+            scan_number = psm_number // psms_per_scan * 7 + 3
+            modifications = {'3': 15.9949} if psm_random.random() < 0.3 else {}
+
+            psms.append({
+                'scan_number': scan_number,
+                'charge': psm_random.choice((2, 3)),
+                'peptide_sequence': psm_random.choice(_peptide_sequences),
+                'modifications': modifications,
+                'score': round(psm_random.random() * 0.05, 6)
+            })
+
+        request_data.append({
+            'spectr_file_id': 'benchmark_file_' + str(file_number),
+            'score_type': 'PERCOLATOR QVALUE',
+            'psms': psms
+        })
+
+    return request_data
+
+
+def run_shape(shape_name, spectr_url, seed):
+    """Run one request of the given shape in a fresh process
+
+    Parameters:
+        shape_name (string): A key of request_shapes
+        spectr_url (string): URL of the mock spectr server
+        seed (int): Seed for the random PSMs
+
+    Returns:
+        dict: The result of the run, see _run_single
+    """
+
+    with tempfile.TemporaryDirectory(prefix='blib_benchmark_') as run_dir:
+        env = dict(os.environ)
+        env[__spectr_get_scan_data_env_key__] = spectr_url
+        env[__workdir_env_key__] = os.path.join(run_dir, 'work')
+        env[__blib_dir_env_key__] = os.path.join(run_dir, 'blib')
+        env[__blib_build_executable_path_env_key__] = os.path.join(stub_bin_dir, 'BlibBuild')
+        env[__blib_filter_executable_path_env_key__] = os.path.join(stub_bin_dir, 'BlibFilter')
+
+        os.makedirs(env[__workdir_env_key__])
+        os.makedirs(env[__blib_dir_env_key__])
+
+        result = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.run_end_to_end', '--single', shape_name, '--seed', str(seed)],
+            cwd=repo_dir,
+            env=env,
+            capture_output=True,
+            text=True
+        )
+
+    if result.returncode != 0:
+        raise ValueError('Benchmark run failed:', shape_name, result.stderr)
+
+    # the result is the last line, after anything printed by the export
+    return json.loads(result.stdout.strip().split('\n')[-1])
+
+
+def _run_single(shape_name, seed):
+    """Run one request of the given shape in this process, see run_shape
+
+    Returns:
+        dict: {
+            'shape': <shape name>, 'status': <request status>, 'wall_seconds': <seconds>, 'scan_count': <scans>,
+            'scans_per_second': <scans per second, None if the request failed>,
+            'stage_seconds': {<stage name>: <seconds>},
+            'peak_rss_mb': <peak RSS of this process>, 'peak_child_rss_mb': <largest peak RSS of a child process>
+        }
+    """
+
+    request_id = 'benchmark_' + shape_name
+    request_data = build_request_data(shape_name, seed)
+    request_status_dict = {request_id: {'project_id': 1, 'status': 'queued', 'message': None}}
+
+    scan_count = sum(len(request_handler.get_distinct_scans_from_request_data(spectr_dict))
+                     for spectr_dict in request_data)
+
+    start_time = time.perf_counter()
+    request_handler.process_request({'id': request_id, 'data': request_data}, request_status_dict)
+    wall_seconds = time.perf_counter() - start_time
+
+    request_status = request_status_dict[request_id]
+    trace_summary = request_status.get('trace_summary', {})
+
+    # ru_maxrss is in KB on Linux. Forked children (ms2 workers, BlibBuild) start with the memory of this process
+    return {
+        'shape': shape_name,
+        'status': request_status['status'],
+        'message': request_status['message'],
+        'wall_seconds': round(wall_seconds, 3),
+        'scan_count': scan_count,
+        'scans_per_second': round(scan_count / wall_seconds, 1) if request_status['status'] == 'success'
+        else None,
+        'stage_seconds': trace_summary.get('stage_seconds', {}),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'peak_child_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+    }
+
+
+def _format_result(result):
+    stage_text = ', '.join(name + ' ' + str(seconds) for name, seconds in result['stage_seconds'].items())
+
+    return (
+        result['shape'].ljust(12) + ' ' + result['status'].ljust(8) +
+        str(result['wall_seconds']).rjust(9) + ' s' +
+        str(result['scan_count']).rjust(8) + ' scans' +
+        str(result['scans_per_second']).rjust(10) + ' scans/s' +
+        str(result['peak_rss_mb']).rjust(8) + ' MB' +
+        str(result['peak_child_rss_mb']).rjust(8) + ' MB children' +
+        '   ' + stage_text
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the end-to-end export benchmark.')
+    parser.add_argument('--shapes', nargs='+', choices=list(request_shapes), default=list(request_shapes))
+    parser.add_argument('--repeat', type=int, default=1, help='runs of each shape')
+    parser.add_argument('--latency', type=float, default=0.0, help='mock spectr seconds to wait for each request')
+    parser.add_argument('--latency-per-scan', type=float, default=0.0,
+                        help='mock spectr seconds to wait for each scan')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of mock spectr requests answered with a 503')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--single', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single is not None:
+        print(json.dumps(_run_single(args.single, args.seed)))
+        return
+
+    settings = {env_key: os.getenv(env_key) for env_key in _reported_env_keys}
+    print('Settings:', json.dumps(settings), flush=True)
+
+    results = []
+
+    for shape_name in args.shapes:
+        server = MockSpectrServer(MockSpectrSettings(
+            peaks_per_scan=request_shapes[shape_name][3],
+            latency_seconds=args.latency,
+            latency_seconds_per_scan=args.latency_per_scan,
+            error_rate=args.error_rate,
+            seed=args.seed
+        ))
+
+        try:
+            for _ in range(args.repeat):
+                result = run_shape(shape_name, server.url, args.seed)
+                results.append(result)
+                print(_format_result(result), flush=True)
+        finally:
+            server.stop()
+
+    if args.json is not None:
+        with open(args.json, 'w') as json_file:
+            json.dump({'settings': settings, 'results': results}, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
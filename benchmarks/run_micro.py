@@ -0,0 +1,224 @@
+"""Micro-benchmarks of the per-scan and per-PSM hot paths, on fixed synthetic inputs of realistic size.
+Results can be saved as JSON and compared against a saved baseline, flagging regressions:
+    python -m benchmarks.run_micro --save baseline.json
+    python -m benchmarks.run_micro --compare baseline.json
+"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import tempfile
+import requests
+from benchmarks.mock_spectr import build_spectr_response_body, generate_peak_lists
+from benchmarks.run_end_to_end import build_request_data
+from app import request_handler, spectr_utils, ms2_lib, ssl_lib, general_utils
+
+# a run is flagged as a regression if it is this much slower than the baseline
+_default_regression_threshold = 0.1
+
+# scans in one spectr response, peaks per scan
+_spectr_response_scan_count = 100
+_peaks_per_scan = 300
+
+
+def _setup_handle_spectr_success():
+    peak_lists = generate_peak_lists(_peaks_per_scan, 1)
+    body = build_spectr_response_body(list(range(1, _spectr_response_scan_count + 1)), peak_lists)
+
+    def run():
+        response = requests.Response()
+        response.status_code = 200
+        response._content = body
+        response._content_consumed = True
+        spectr_utils.handle_spectr_success(response, 'benchmark_file')
+
+    return run, _spectr_response_scan_count
+
+
+def _setup_write_scan_to_ms2_file(output_dir):
+    peak_lists = generate_peak_lists(_peaks_per_scan, 1)
+    response = requests.Response()
+    response.status_code = 200
+    response._content = build_spectr_response_body(list(range(1, 1001)), peak_lists)
+    response._content_consumed = True
+    ms2_scans = spectr_utils.handle_spectr_success(response, 'benchmark_file')
+
+    def run():
+        ms2_file = ms2_lib.initialize_ms2_file(output_dir, 'benchmark.ms2')
+        for ms2_scan in ms2_scans:
+            ms2_lib.write_scan_to_ms2_file(ms2_file, ms2_scan.scan_number, ms2_scan.precursor_mz,
+                                           ms2_scan.precursor_charge, ms2_scan.peak_list_mz,
+                                           ms2_scan.peak_list_intensity, 4, 1)
+        ms2_lib.close_ms2_file(ms2_file)
+
+    return run, len(ms2_scans)
+
+
+def _setup_write_psm_to_ssl_file(output_dir):
+    psms = build_request_data('large_files')[0]['psms']
+
+    def run():
+        ssl_file = ssl_lib.initialize_ssl_file(output_dir, 'benchmark.ssl')
+        for psm in psms:
+            ssl_lib.write_psm_to_ssl_file(ssl_file, '1.ms2', psm['scan_number'], psm['charge'],
+                                          psm['peptide_sequence'], psm['scan_number'] / 240, 'PERCOLATOR QVALUE',
+                                          psm['score'])
+        ssl_lib.close_ssl_file(ssl_file)
+
+    return run, len(psms)
+
+
+def _setup_build_peptide_string_with_mods():
+    psms = [psm for spectr_dict in build_request_data('many_files') for psm in spectr_dict['psms']]
+
+    def run():
+        # start each run with an empty cache, so runs are comparable
+        general_utils._build_peptide_string_with_mods.cache_clear()
+        for psm in psms:
+            general_utils.build_peptide_string_with_mods(psm['peptide_sequence'], psm['modifications'])
+
+    return run, len(psms)
+
+
+def _setup_get_distinct_scans_from_request_data():
+    spectr_dict = build_request_data('large_files')[0]
+
+    def run():
+        request_handler.get_distinct_scans_from_request_data(spectr_dict)
+
+    return run, len(spectr_dict['psms'])
+
+
+def get_benchmarks(output_dir):
+    """Get the micro-benchmarks
+
+    Parameters:
+        output_dir (string): Directory for the files written by the benchmarks
+
+    Returns:
+        dict: name => (function running the benchmark once, the number of operations in one run)
+    """
+
+    return {
+        'spectr_utils.handle_spectr_success': _setup_handle_spectr_success(),
+        'ms2_lib.write_scan_to_ms2_file': _setup_write_scan_to_ms2_file(output_dir),
+        'ssl_lib.write_psm_to_ssl_file': _setup_write_psm_to_ssl_file(output_dir),
+        'general_utils.build_peptide_string_with_mods': _setup_build_peptide_string_with_mods(),
+        'request_handler.get_distinct_scans_from_request_data': _setup_get_distinct_scans_from_request_data()
+    }
+
+
+def run_benchmark(run, operation_count, repeat):
+    """Time repeat runs of a benchmark, after one warm up run. The time per operation is taken from the
+    fastest run, which is the least disturbed by other work on the machine.
+
+    Returns:
+        dict: {'operations': <per run>, 'min_seconds': <seconds>, 'median_seconds': <seconds>,
+               'ns_per_operation': <nanoseconds per operation in the fastest run>}
+    """
+
+    run()
+
+    run_seconds = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        run()
+        run_seconds.append(time.perf_counter() - start_time)
+
+    return {
+        'operations': operation_count,
+        'min_seconds': round(min(run_seconds), 6),
+        'median_seconds': round(statistics.median(run_seconds), 6),
+        'ns_per_operation': round(min(run_seconds) / operation_count * 1e9, 1)
+    }
+
+
+def compare_results(results, baseline_results, threshold):
+    """Compare results against a baseline by the time per operation
+
+    Parameters:
+        results (dict): name => result, see run_benchmark
+        baseline_results (dict): name => result, from a saved run
+        threshold (float): Fraction slower than the baseline that counts as a regression
+
+    Returns:
+        list: (name, baseline ns per operation, ns per operation, change as a fraction, is regression) tuples
+            for each benchmark in both
+    """
+
+    comparisons = []
+
+    for name, result in results.items():
+        if name not in baseline_results:
+            continue
+
+        baseline_ns = baseline_results[name]['ns_per_operation']
+        change = (result['ns_per_operation'] - baseline_ns) / baseline_ns
+        comparisons.append((name, baseline_ns, result['ns_per_operation'], change, change > threshold))
+
+    return comparisons
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the micro-benchmarks of the export hot paths.')
+    parser.add_argument('--repeat', type=int, default=7, help='timed runs of each benchmark')
+    parser.add_argument('--only', nargs='+', help='run only the benchmarks with these names')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--compare', help='compare the results against a file written with --save')
+    parser.add_argument('--threshold', type=float, default=_default_regression_threshold,
+                        help='fraction slower than the baseline that counts as a regression')
+    args = parser.parse_args()
+
+    results = {}
+
+    with tempfile.TemporaryDirectory(prefix='blib_micro_benchmark_') as output_dir:
+        for name, (run, operation_count) in get_benchmarks(output_dir).items():
+            if args.only is not None and name not in args.only:
+                continue
+
+            results[name] = run_benchmark(run, operation_count, args.repeat)
+            print(name.ljust(54) + str(results[name]['ns_per_operation']).rjust(12) + ' ns/op' +
+                  str(results[name]['min_seconds']).rjust(12) + ' s/run', flush=True)
+
+    if args.save is not None:
+        with open(args.save, 'w') as save_file:
+            json.dump({'python': platform.python_version(), 'results': results}, save_file, indent=2)
+
+    if args.compare is None:
+        return
+
+    with open(args.compare) as baseline_file:
+        baseline_results = json.load(baseline_file)['results']
+
+    regression_count = 0
+    print('\nCompared to', args.compare)
+
+    for name, baseline_ns, ns, change, is_regression in compare_results(results, baseline_results, args.threshold):
+        regression_count += is_regression
+        print(name.ljust(54) + str(baseline_ns).rjust(12) + ' -> ' + str(ns).rjust(12) + ' ns/op' +
+              ('%+.1f%%' % (change * 100)).rjust(10) + ('  REGRESSION' if is_regression else ''))
+
+    # a non-zero exit status lets scripts fail on regressions
+    if regression_count > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
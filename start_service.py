@@ -15,12 +15,12 @@
 #   limitations under the License.
 
 import os
-from flask import Flask, request
+from flask import Flask, Response, request
 from flask_restful import Resource, Api
 from datetime import datetime
 import threading
-from app import general_utils, web_service_utils, request_handler, request_status_dict, request_queue, \
-    request_queue_status, __webapp_port_env_key__
+from app import general_utils, web_service_utils, request_handler, metrics, request_status_dict, request_queue, \
+    request_hash_dict, request_queue_status, request_lock, __webapp_port_env_key__
 
 app = Flask(__name__)
 api = Api(app)
@@ -35,7 +35,13 @@ class CancelConversionRequest(Resource):
         if 'request_id' not in json_data or 'project_id' not in json_data:
             return 'Required data not present', 400
 
-        return web_service_utils.cancel_conversion_request(json_data, request_queue, request_status_dict), 200
+        with request_lock:
+            return web_service_utils.cancel_conversion_request(
+                json_data,
+                request_queue,
+                request_status_dict,
+                request_hash_dict
+            ), 200
 
 
 class RequestConversionStatus(Resource):
@@ -47,7 +53,8 @@ class RequestConversionStatus(Resource):
         if 'request_id' not in json_data or 'project_id' not in json_data:
             return 'Required data not present', 400
 
-        return web_service_utils.get_json_for_status_request(json_data, request_queue, request_status_dict), 200
+        with request_lock:
+            return web_service_utils.get_json_for_status_request(json_data, request_queue, request_status_dict), 200
 
 
 class RequestBlibConversion(Resource):
@@ -59,42 +66,75 @@ class RequestBlibConversion(Resource):
         if 'project_id' not in json_data or 'spectral_data' not in json_data:
             return 'Required data not present', 400
 
-        request_id = general_utils.generate_request_id()
         project_id = json_data['project_id']
         spectral_data = json_data['spectral_data']
 
-        print('Conversion request:')
-        print('\tDate:', datetime.today().strftime('%Y-%m-%d'))
-        print('\tproject_id:', project_id)
-        print('\trequest_id:', request_id)
-
-        request_queue.append({'id': request_id, 'data': spectral_data})
-        request_status_dict[request_id] = {
-            'project_id': project_id,
-            'status': 'queued',
-            'message': None
-        }
-
-        if not request_queue_status['started']:
-            request_queue_status['started'] = True
-
-            # start request processor in a separate thread
-            thread = threading.Thread(
-                target=request_handler.process_request_queue,
-                args=(request_queue, request_status_dict)
+        if not general_utils.is_spectral_data_valid(spectral_data):
+            return 'Required data not present', 400
+
+        request_hash = general_utils.hash_request_data(project_id, spectral_data)
+
+        with request_lock:
+            request_id, is_shared = web_service_utils.submit_conversion_request(
+                project_id,
+                spectral_data,
+                request_hash,
+                request_queue,
+                request_status_dict,
+                request_hash_dict
             )
-            thread.start()
+
+            print('Conversion request:')
+            print('\tDate:', datetime.today().strftime('%Y-%m-%d'))
+            print('\tproject_id:', project_id)
+            print('\trequest_id:', request_id)
+            if is_shared:
+                print('\tShared with identical existing request')
+
+            start_request_processing()
 
         return {'request_id': request_id}, 200
 
 
+class Metrics(Resource):
+    """Web service for retrieving metrics in the Prometheus text format"""
+
+    def get(self):
+        with request_lock:
+            gauges = web_service_utils.get_gauges_for_metrics(request_queue, request_status_dict)
+
+        return Response(metrics.render_metrics(gauges), mimetype='text/plain; version=0.0.4')
+
+
+def start_request_processing():
+    """Start processing the request queue in a separate thread, if not already started. The request
+    lock must be held."""
+
+    if not request_queue_status['started']:
+        request_queue_status['started'] = True
+
+        # start request processor in a separate thread
+        thread = threading.Thread(
+            target=request_handler.process_request_queue,
+            args=(request_queue, request_status_dict)
+        )
+        thread.start()
+
+
 api.add_resource(RequestBlibConversion, '/requestNewBlibConversion')
 api.add_resource(RequestConversionStatus, '/requestConversionStatus')
 api.add_resource(CancelConversionRequest, '/cancelConversionRequest')
+api.add_resource(Metrics, '/metrics')
 
 if __name__ == '__main__':
 
     port = os.getenv(__webapp_port_env_key__)
     if port is None:
         raise ValueError('No port is defined by env. var.: ' + __webapp_port_env_key__)
+
+    # requests queued before a restart, if the request store is used
+    with request_lock:
+        if len(request_queue) > 0:
+            start_request_processing()
+
     app.run(debug=False, host="0.0.0.0", port=int(port))
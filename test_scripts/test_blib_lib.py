@@ -0,0 +1,172 @@
+"""Simple script to test app/blib_lib by comparing a library it writes to one built by BlibBuild
+from the same scans and PSMs"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import sqlite3
+import tempfile
+from app import __spectr_get_scan_data_env_key__, spectr_utils, ms2_lib, ssl_lib, blib_lib, general_utils, \
+    request_handler
+from dotenv import load_dotenv
+
+# load values from .env into env
+load_dotenv()
+
+spectr_get_url = os.getenv('SPECTR_GET_SCAN_DATA_URL')
+scan_number_list = [int(scan_number) for scan_number in os.getenv('TEST_SCAN_NUMBERS').strip('][').split(', ')]
+spectr_file_id = os.getenv('TEST_SPECTR_FILE_ID')
+
+test_psm_peptides = ['VGAGAPVYLAAVLEYLAAEVLELAGNAAR', 'LAESITIEQGK', 'ELAEDGCSGVEVR']
+test_psm_modifications = [{}, {'n': 42.010565}, {'7': 57.021464, 'c': 0.984016}]
+
+# columns of RefSpectra that must be the same in both libraries
+compared_columns = ['peptideSeq', 'precursorCharge', 'peptideModSeq', 'copies', 'numPeaks', 'SpecIDinFile']
+
+# columns of RefSpectra that must agree to within a tolerance
+compared_numeric_columns = ['precursorMZ', 'retentionTime']
+
+
+def main():
+
+    # set the env var needed to get data from spectr
+    os.environ[__spectr_get_scan_data_env_key__] = spectr_get_url
+
+    workdir = tempfile.mkdtemp()
+    ms2_scans = spectr_utils.get_scan_data_for_scan_numbers(spectr_file_id, scan_number_list)
+
+    # one PSM per scan, cycling through the test peptides
+    psms = []
+    for index, ms2_scan in enumerate(ms2_scans):
+        psms.append({
+            'scan_number': ms2_scan.scan_number,
+            'charge': 2 + index % 2,
+            'peptide_sequence': test_psm_peptides[index % len(test_psm_peptides)],
+            'modifications': test_psm_modifications[index % len(test_psm_modifications)]
+        })
+
+    build_blibbuild_library(workdir, 'blibbuild.blib', ms2_scans, psms)
+    build_native_library(workdir, 'native.blib', ms2_scans, psms)
+
+    differences = compare_libraries(os.path.join(workdir, 'blibbuild.blib'), os.path.join(workdir, 'native.blib'))
+
+    for difference in differences:
+        print(difference)
+
+    print('Libraries in:', workdir)
+    print('Found', len(differences), 'differences')
+
+
+def build_blibbuild_library(workdir, library_name, ms2_scans, psms):
+    ms2_file = ms2_lib.initialize_ms2_file(workdir, '1.ms2')
+    for ms2_scan in ms2_scans:
+        ms2_lib.write_scan_to_ms2_file(ms2_file, ms2_scan.scan_number, ms2_scan.precursor_mz,
+                                       ms2_scan.precursor_charge, ms2_scan.peak_list_mz,
+                                       ms2_scan.peak_list_intensity)
+    ms2_lib.close_ms2_file(ms2_file)
+
+    retention_times = {ms2_scan.scan_number: ms2_scan.retention_time_seconds for ms2_scan in ms2_scans}
+
+    ssl_file = ssl_lib.initialize_ssl_file(workdir, '1.ssl')
+    for psm in psms:
+        peptide_sequence = general_utils.build_peptide_string_with_mods(
+            psm['peptide_sequence'],
+            psm['modifications']
+        )
+        ssl_lib.write_psm_to_ssl_file(ssl_file, '1.ms2', psm['scan_number'], psm['charge'], peptide_sequence,
+                                      retention_times[psm['scan_number']] / 60)
+    ssl_lib.close_ssl_file(ssl_file)
+
+    request_handler.execute_blib_build_conversion(library_name, '1.ssl', workdir)
+
+
+def build_native_library(workdir, library_name, ms2_scans, psms):
+    blib_connection = blib_lib.initialize_blib_file(workdir, library_name)
+    file_id = blib_lib.add_source_file_to_blib_file(
+        blib_connection,
+        os.path.join(workdir, '1.ms2'),
+        os.path.join(workdir, '1.ssl')
+    )
+
+    psms_by_scan_number = {psm['scan_number']: [psm] for psm in psms}
+    blib_lib.write_spectra_to_blib_file(
+        blib_connection,
+        file_id,
+        [(ms2_scan, psms_by_scan_number[ms2_scan.scan_number]) for ms2_scan in ms2_scans]
+    )
+    blib_lib.close_blib_file(blib_connection)
+
+
+def compare_libraries(expected_path, actual_path):
+    """Compare the spectra of two libraries, matched by scan number
+
+    Returns:
+        list: Descriptions of the differences found
+    """
+
+    expected_spectra = read_spectra(expected_path)
+    actual_spectra = read_spectra(actual_path)
+    differences = []
+
+    if expected_spectra.keys() != actual_spectra.keys():
+        differences.append('Different scans: ' + str(sorted(expected_spectra.keys() ^ actual_spectra.keys())))
+
+    for scan_id in sorted(expected_spectra.keys() & actual_spectra.keys()):
+        expected = expected_spectra[scan_id]
+        actual = actual_spectra[scan_id]
+
+        for column in compared_columns:
+            if expected[column] != actual[column]:
+                differences.append(scan_id + ' ' + column + ': ' + str(expected[column]) + ' != ' + str(actual[column]))
+
+        for column in compared_numeric_columns:
+            if abs(expected[column] - actual[column]) > 1e-6:
+                differences.append(scan_id + ' ' + column + ': ' + str(expected[column]) + ' != ' + str(actual[column]))
+
+        if expected['modifications'] != actual['modifications']:
+            differences.append(scan_id + ' modifications: ' + str(expected['modifications']) + ' != ' +
+                               str(actual['modifications']))
+
+        for peak_index in range(2):
+            if list(expected['peaks'][peak_index]) != list(actual['peaks'][peak_index]):
+                differences.append(scan_id + ' peaks differ')
+                break
+
+    return differences
+
+
+def read_spectra(library_path):
+    connection = sqlite3.connect(library_path)
+    connection.row_factory = sqlite3.Row
+    spectra = {}
+
+    for row in connection.execute('SELECT * FROM RefSpectra JOIN RefSpectraPeaks ON RefSpectraID = id'):
+        spectrum = dict(row)
+        spectrum['peaks'] = blib_lib.decode_peaks(row['peakMZ'], row['peakIntensity'], row['numPeaks'])
+        spectrum['modifications'] = [
+            (position, round(mass, 4)) for position, mass in connection.execute(
+                'SELECT position, mass FROM Modifications WHERE RefSpectraID = ? ORDER BY position',
+                (row['id'],)
+            )
+        ]
+        spectra[row['SpecIDinFile']] = spectrum
+
+    connection.close()
+
+    return spectra
+
+
+if __name__ == "__main__":
+    main()
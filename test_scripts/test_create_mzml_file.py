@@ -0,0 +1,146 @@
+"""Simple script to test functionality of app/mzml_lib. Writes the scans to an mzML file, then reads
+it back and checks the scan numbers and peaks a reader would get from it"""
+
+#   Copyright 2022 Michael Riffle
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import sys
+import zlib
+import base64
+from array import array
+import xml.etree.ElementTree as ElementTree
+from app import __spectr_get_scan_data_env_key__, spectr_utils, mzml_lib
+from dotenv import load_dotenv
+
+# load values from .env into env
+load_dotenv()
+
+spectr_get_url = os.getenv('SPECTR_GET_SCAN_DATA_URL')
+scan_number_list = os.getenv('TEST_SCAN_NUMBERS').strip('][').split(', ')
+spectr_file_id = os.getenv('TEST_SPECTR_FILE_ID')
+mzml_file_name = os.getenv('TEST_MZML_FILE_NAME')
+
+namespaces = {'mzml': 'http://psi.hupo.org/ms/mzml'}
+
+
+def main():
+
+    # set the env var needed to get data from spectr
+    os.environ[__spectr_get_scan_data_env_key__] = spectr_get_url
+
+    # do the work
+    results = spectr_utils.get_scan_data_for_scan_numbers(spectr_file_id, scan_number_list)
+
+    for use_zlib in (False, True):
+        mzml_file = mzml_lib.initialize_mzml_file('..', mzml_file_name, use_zlib)
+
+        for ms2_scan in results:
+            mzml_lib.write_scan_to_mzml_file(mzml_file, ms2_scan.scan_number, ms2_scan.precursor_mz,
+                                             ms2_scan.precursor_charge, ms2_scan.retention_time_seconds,
+                                             ms2_scan.peak_list_mz, ms2_scan.peak_list_intensity)
+
+        mzml_lib.close_mzml_file(mzml_file)
+
+        check_mzml_file(os.path.join('..', mzml_file_name), results, use_zlib)
+
+    print('mzML file is readable and matches the scans from spectr')
+
+
+def check_mzml_file(mzml_file_path, ms2_scans, use_zlib):
+    """Read the mzML file back and check it declares the "scan=N" nativeID format for its spectra,
+    and holds a spectrum with the scan number and peaks of each scan
+
+    Parameters:
+        mzml_file_path (string): Full path to the mzML file
+        ms2_scans (list): The MS2ScanData objects written to the file
+        use_zlib (bool): Whether the peak arrays were zlib compressed
+
+    Returns:
+        NoneType
+    """
+
+    root = ElementTree.parse(mzml_file_path).getroot()
+
+    source_file = root.find('mzml:fileDescription/mzml:sourceFileList/mzml:sourceFile', namespaces)
+    run = root.find('mzml:run', namespaces)
+
+    if source_file is None or run.get('defaultSourceFileRef') != source_file.get('id'):
+        fail('The run does not refer to a source file')
+
+    native_id_formats = [
+        cv_param.get('accession') for cv_param in source_file.findall('mzml:cvParam', namespaces)
+        if cv_param.get('accession') == 'MS:1000776'
+    ]
+
+    if len(native_id_formats) != 1:
+        fail('The source file does not declare the scan number only nativeID format')
+
+    spectrum_list = run.find('mzml:spectrumList', namespaces)
+    spectra = spectrum_list.findall('mzml:spectrum', namespaces)
+
+    if int(spectrum_list.get('count')) != len(ms2_scans) or len(spectra) != len(ms2_scans):
+        fail('Got wrong spectrum count:', spectrum_list.get('count'), len(spectra))
+
+    for index, (spectrum, ms2_scan) in enumerate(zip(spectra, ms2_scans)):
+        if int(spectrum.get('index')) != index:
+            fail('Got wrong spectrum index:', spectrum.get('index'))
+
+        # the scan number only nativeID format is "scan=N"
+        native_id_name, scan_number = spectrum.get('id').split('=')
+        if native_id_name != 'scan' or int(scan_number) != ms2_scan.scan_number:
+            fail('Spectrum id does not give the scan number:', spectrum.get('id'), ms2_scan.scan_number)
+
+        peak_list_mz, peak_list_intensity = [
+            decode_binary_data_array(binary_data_array, use_zlib)
+            for binary_data_array in spectrum.findall('mzml:binaryDataArrayList/mzml:binaryDataArray', namespaces)
+        ]
+
+        if list(peak_list_mz) != list(ms2_scan.peak_list_mz):
+            fail('Got wrong m/z values for scan:', ms2_scan.scan_number)
+
+        if list(peak_list_intensity) != list(array('f', ms2_scan.peak_list_intensity)):
+            fail('Got wrong intensities for scan:', ms2_scan.scan_number)
+
+
+def decode_binary_data_array(binary_data_array, use_zlib):
+    """Decode the values of a binaryDataArray element
+
+    Returns:
+        array: The values, as 64-bit floats for m/z arrays and 32-bit floats for intensity arrays
+    """
+
+    accessions = {cv_param.get('accession') for cv_param in binary_data_array.findall('mzml:cvParam', namespaces)}
+
+    data = base64.b64decode(binary_data_array.find('mzml:binary', namespaces).text)
+    if use_zlib:
+        data = zlib.decompress(data)
+
+    values = array('d' if 'MS:1000523' in accessions else 'f')
+    values.frombytes(data)
+
+    # mzML binary data is little-endian
+    if sys.byteorder != 'little':
+        values.byteswap()
+
+    return values
+
+
+def fail(*args):
+    print('Failed:', *args)
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()